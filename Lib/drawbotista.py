@@ -1,47 +1,49 @@
 import os
 import io
 import math
+import array
+import struct
+import zlib
 import random
+import time
 import warnings
-import tempfile
-import shutil
-from PIL import Image as PILImage
-import ui
-import dialogs
-import console
-import images2gif
+import collections
+import heapq
+import re
+import hashlib
+import itertools
+import importlib
+import importlib.util
 
-# ------
-# Bridge
-# ------
-#
-# Great examples here:
-# https://github.com/zacbir/geometriq/blob/master/geometriq/backends/_quartz.py
 
-import ctypes
-import objc_util
-from objc_util import ObjCClass, ObjCInstance
+class _LazyModule(object):
 
-cBool = ctypes.c_bool
-cInt = ctypes.c_size_t
-cUInt = ctypes.c_uint
-cUInt32 = ctypes.c_uint32
-cStrOrVoid = ctypes.c_wchar_p
-cIntOrVoid = ctypes.c_void_p
+    # stands in for a module until one of its attributes
+    # is first used, then imports it and puts the real
+    # module in its place in the module globals.
 
-def ObjCConstant(name):
-    return ObjCInstance(ctypes.c_void_p.in_dll(objc_util.c, name))
+    def __init__(self, name):
+        self._name = name
 
-# Quartz
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
 
-quartz = objc_util.c
 
-CGFloat = objc_util.CGFloat
-CGPoint = objc_util.CGPoint
-CGSize = objc_util.CGSize
-CGRect = objc_util.CGRect
-CGAffineTransform = objc_util.CGAffineTransform
-CGBitmapInfo = cUInt32
+numpy = _LazyModule("numpy")
+
+# ------
+# Bridge
+# ------
+#
+# Great examples here:
+# https://github.com/zacbir/geometriq/blob/master/geometriq/backends/_quartz.py
+#
+# Binding the Quartz, Foundation and UIKit functions needs
+# objc_util, which only exists in Pythonista. It happens
+# the first time the uikit backend or a native path is
+# used, and the bound names become module globals.
 
 kCGLineJoinMiter = 0
 kCGLineJoinRound = 1
@@ -50,56 +52,162 @@ kCGLineCapButt = 0
 kCGLineCapRound = 1
 kCGLineCapSquare = 2
 
-CGContextConcatCTM = quartz.CGContextConcatCTM
-CGContextConcatCTM.restype = None
-CGContextConcatCTM.argtypes = [
-    cIntOrVoid,
-    CGAffineTransform
-]
+kCGPathElementMoveToPoint = 0
+kCGPathElementAddLineToPoint = 1
+kCGPathElementAddQuadCurveToPoint = 2
+kCGPathElementAddCurveToPoint = 3
+kCGPathElementCloseSubpath = 4
+
+kCGBitmapAlphaInfoMask = 0x1F
+kCGBitmapByteOrder32Little = 2 << 12
+kCGImageAlphaPremultipliedLast = 1
+kCGImageAlphaPremultipliedFirst = 2
+kCGImageAlphaLast = 3
+kCGImageAlphaFirst = 4
+kCGImageAlphaNoneSkipLast = 5
+kCGImageAlphaNoneSkipFirst = 6
+
+_bridgeLoaded = False
+
+
+def _loadBridge():
+    global _bridgeLoaded
+    if _bridgeLoaded:
+        return
+
+    import ctypes
+    import objc_util
+    from objc_util import ObjCClass, ObjCInstance
+
+    cBool = ctypes.c_bool
+    cInt = ctypes.c_size_t
+    cUInt = ctypes.c_uint
+    cUInt32 = ctypes.c_uint32
+    cStrOrVoid = ctypes.c_wchar_p
+    cIntOrVoid = ctypes.c_void_p
+
+    def ObjCConstant(name):
+        return ObjCInstance(ctypes.c_void_p.in_dll(objc_util.c, name))
+
+    # Quartz
+
+    quartz = objc_util.c
+
+    CGFloat = objc_util.CGFloat
+    CGPoint = objc_util.CGPoint
+    CGSize = objc_util.CGSize
+    CGRect = objc_util.CGRect
+    CGAffineTransform = objc_util.CGAffineTransform
+    CGBitmapInfo = cUInt32
+
+    CGContextConcatCTM = quartz.CGContextConcatCTM
+    CGContextConcatCTM.restype = None
+    CGContextConcatCTM.argtypes = [
+        cIntOrVoid,
+        CGAffineTransform
+    ]
+
+    CGContextSaveGState = quartz.CGContextSaveGState
+    CGContextSaveGState.restype = None
+    CGContextSaveGState.argtypes = [cIntOrVoid]
+
+    CGContextRestoreGState = quartz.CGContextRestoreGState
+    CGContextRestoreGState.restype = None
+    CGContextRestoreGState.argtypes = [cIntOrVoid]
+
+    class CGPathElement(ctypes.Structure):
+        _fields_ = [
+            ("type", ctypes.c_int32),
+            ("points", ctypes.POINTER(CGPoint))
+        ]
 
-CGContextSaveGState = quartz.CGContextSaveGState
-CGContextSaveGState.restype = None
-CGContextSaveGState.argtypes = [cIntOrVoid]
+    CGPathApplierFunction = ctypes.CFUNCTYPE(None, cIntOrVoid, ctypes.POINTER(CGPathElement))
 
-CGContextRestoreGState = quartz.CGContextRestoreGState
-CGContextRestoreGState.restype = None
-CGContextRestoreGState.argtypes = [cIntOrVoid]
+    CGPathApply = quartz.CGPathApply
+    CGPathApply.restype = None
+    CGPathApply.argtypes = [
+        cIntOrVoid,
+        cIntOrVoid,
+        CGPathApplierFunction
+    ]
 
-# Foundation
+    CGImageGetWidth = quartz.CGImageGetWidth
+    CGImageGetWidth.restype = cInt
+    CGImageGetWidth.argtypes = [cIntOrVoid]
 
-NSMutableData = objc_util.NSMutableData
-NSColor = ObjCClass("NSColor")
-NSAttributedString = ObjCClass("NSAttributedString")
-NSFont = ObjCClass("NSFont")
-NSFontAttributeName = ObjCConstant("NSFontAttributeName")
-NSForegroundColorAttributeName = ObjCConstant("NSForegroundColorAttributeName")
+    CGImageGetHeight = quartz.CGImageGetHeight
+    CGImageGetHeight.restype = cInt
+    CGImageGetHeight.argtypes = [cIntOrVoid]
 
-# UIKit
+    CGImageGetBytesPerRow = quartz.CGImageGetBytesPerRow
+    CGImageGetBytesPerRow.restype = cInt
+    CGImageGetBytesPerRow.argtypes = [cIntOrVoid]
 
-UIBezierPath = ObjCClass("UIBezierPath")
-UIImage = ObjCClass("UIImage")
+    CGImageGetBitmapInfo = quartz.CGImageGetBitmapInfo
+    CGImageGetBitmapInfo.restype = CGBitmapInfo
+    CGImageGetBitmapInfo.argtypes = [cIntOrVoid]
 
-UIGraphicsBeginImageContext = quartz.UIGraphicsBeginImageContext
-UIGraphicsBeginImageContext.restype = None
-UIGraphicsBeginImageContext.argtypes = [CGSize]
+    CGImageGetDataProvider = quartz.CGImageGetDataProvider
+    CGImageGetDataProvider.restype = cIntOrVoid
+    CGImageGetDataProvider.argtypes = [cIntOrVoid]
 
-UIGraphicsEndImageContext = quartz.UIGraphicsEndImageContext
-UIGraphicsEndImageContext.restype = None
-UIGraphicsEndImageContext.argtypes = []
+    CGDataProviderCopyData = quartz.CGDataProviderCopyData
+    CGDataProviderCopyData.restype = cIntOrVoid
+    CGDataProviderCopyData.argtypes = [cIntOrVoid]
 
-UIGraphicsGetCurrentContext = quartz.UIGraphicsGetCurrentContext
-UIGraphicsGetCurrentContext.restype = cIntOrVoid
-UIGraphicsGetCurrentContext.argtypes = []
+    # Core Foundation
 
-UIGraphicsGetImageFromCurrentImageContext = quartz.UIGraphicsGetImageFromCurrentImageContext
-UIGraphicsGetImageFromCurrentImageContext.restype = cIntOrVoid
-UIGraphicsGetImageFromCurrentImageContext.argtypes = []
+    CFDataGetBytePtr = quartz.CFDataGetBytePtr
+    CFDataGetBytePtr.restype = cIntOrVoid
+    CFDataGetBytePtr.argtypes = [cIntOrVoid]
 
-def UIImagePNGRepresentation(image):
-    return ObjCInstance(quartz.UIImagePNGRepresentation(image))
+    CFDataGetLength = quartz.CFDataGetLength
+    CFDataGetLength.restype = ctypes.c_long
+    CFDataGetLength.argtypes = [cIntOrVoid]
+
+    CFRelease = quartz.CFRelease
+    CFRelease.restype = None
+    CFRelease.argtypes = [cIntOrVoid]
+
+    # Foundation
+
+    NSMutableData = objc_util.NSMutableData
+    NSColor = ObjCClass("NSColor")
+    NSAttributedString = ObjCClass("NSAttributedString")
+    NSFont = ObjCClass("NSFont")
+    NSFontAttributeName = ObjCConstant("NSFontAttributeName")
+    NSForegroundColorAttributeName = ObjCConstant("NSForegroundColorAttributeName")
+
+    # UIKit
+
+    UIBezierPath = ObjCClass("UIBezierPath")
+    UIImage = ObjCClass("UIImage")
+
+    UIGraphicsBeginImageContext = quartz.UIGraphicsBeginImageContext
+    UIGraphicsBeginImageContext.restype = None
+    UIGraphicsBeginImageContext.argtypes = [CGSize]
+
+    UIGraphicsEndImageContext = quartz.UIGraphicsEndImageContext
+    UIGraphicsEndImageContext.restype = None
+    UIGraphicsEndImageContext.argtypes = []
+
+    UIGraphicsGetCurrentContext = quartz.UIGraphicsGetCurrentContext
+    UIGraphicsGetCurrentContext.restype = cIntOrVoid
+    UIGraphicsGetCurrentContext.argtypes = []
+
+    UIGraphicsGetImageFromCurrentImageContext = quartz.UIGraphicsGetImageFromCurrentImageContext
+    UIGraphicsGetImageFromCurrentImageContext.restype = cIntOrVoid
+    UIGraphicsGetImageFromCurrentImageContext.argtypes = []
+
+    def UIImagePNGRepresentation(image):
+        return ObjCInstance(quartz.UIImagePNGRepresentation(image))
+
+    quartz.UIImagePNGRepresentation.restype = cIntOrVoid
+    quartz.UIImagePNGRepresentation.argtypes = [cIntOrVoid]
+
+    globals().update(locals())
+    _bridgeLoaded = True
 
-quartz.UIImagePNGRepresentation.restype = cIntOrVoid
-quartz.UIImagePNGRepresentation.argtypes = [cIntOrVoid]
 
 # ---------
 # API Magic
@@ -114,13 +222,37 @@ def _getmodulecontents(module, names=None):
     return d
 
 
+# ------
+# Errors
+# ------
+
+class DrawBotError(Exception):
+    pass
+
+
 # ------------
 # Drawing Tool
 # ------------
 
+# how many pages each worker of a parallel render
+# may have rendering or waiting to be yielded
+_parallelPagesPerWorker = 2
+
+# the most bytes of frames imagePixels keeps
+# for the pages of the current drawing
+_pagePixelsMemoryLimit = 32 * 1024 * 1024
+
+
 class DrawBotDrawingTool(object):
 
     def __init__(self):
+        self._renderCache = {}
+        self._renderCacheHits = 0
+        self._renderCacheMisses = 0
+        self._culledCount = 0
+        self._drawnCount = 0
+        self._imageDataCache = ImageDataCache()
+        self._profiler = None
         self._reset()
 
     def _get__all__(self):
@@ -139,69 +271,423 @@ class DrawBotDrawingTool(object):
 
     def _reset(self):
         self._instructionStack = []
+        self._objects = []
+        self._objectIndexes = {}
+        self._internedPaths = {}
+        self._pagePixelsCache = collections.OrderedDict()
+        self._pagePixelsBytes = 0
         self._width = 500
         self._height = 500
         self._frameDuration = 0.1
-
-    def _addInstruction(self, callback, *args, **kwargs):
-        if callback == "newPage":
-            self._instructionStack.append([])
-        if not self._instructionStack:
-            self._instructionStack.append([])
-        self._instructionStack[-1].append((callback, args, kwargs))
+        self._resetRecordingState()
+
+    def _resetRecordingState(self):
+        # the parts of the graphics state that recording
+        # itself needs, like contexts reset at every page
+        self._ctm = _identityTransform
+        self._fontName = None
+        self._fontSize = 10
+        self._recordingStateStack = []
+
+    def _addInstruction(self, opcode, *operands):
+        if opcode == _opNewPage or not self._instructionStack:
+            self._instructionStack.append(DisplayList(self._objects))
+        page = self._instructionStack[-1]
+        page.opcodes.append(opcode)
+        page.operands.extend(operands)
+
+    def _addObject(self, obj):
+        index = self._objectIndexes.get(obj)
+        if index is None:
+            index = len(self._objects)
+            self._objects.append(obj)
+            self._objectIndexes[obj] = index
+        return index
 
     def _drawInContext(self, context):
-        if self._instructionStack:
-            page = self._instructionStack[0]
-            if page and page[0][0] != "newPage":
-                page.insert(
-                    0,
-                    (
-                        "newPage",
-                        [],
-                        {}
-                    )
-                )
-        for instructionSet in self._instructionStack:
-            for callback, args, kwargs in instructionSet:
-                if callback == "newPage":
-                    args = (self._width, self._height)
-                method = getattr(context, callback)
-                method(*args, **kwargs)
+        methods = [getattr(context, methodName) for methodName in _instructionMethodNames]
+        profiler = context.profiler = self._profiler
+        for pageIndex, page in enumerate(self._instructionStack):
+            if not page.opcodes or page.opcodes[0] != _opNewPage:
+                context.newPage(self._width, self._height)
+            if profiler is not None:
+                profiler.beginPage(pageIndex)
+            page.replay(methods, profiler)
+        self._countCulling(context.culledCount, context.drawnCount)
+
+    def _countCulling(self, culled, drawn):
+        self._culledCount += culled
+        self._drawnCount += drawn
+
+    def _pageSize(self, page):
+        # optimizeDisplayList can leave a page empty
+        if page.opcodes and page.opcodes[0] == _opNewPage:
+            return page.operands[0], page.operands[1]
+        return self._width, self._height
+
+    def _renderPagesInParallel(self, pages, workers):
+        # contexts start every page with a fresh graphics
+        # state, so a page's own display list and size are
+        # all that a worker needs to render it. the frames
+        # are yielded in page order as they finish. only a few
+        # pages per worker are rendering or waiting to be
+        # yielded, so a slow consumer holds the workers back.
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        pending = collections.deque()
+
+        def result(future):
+            pixels, (culled, drawn) = future.result()
+            self._countCulling(culled, drawn)
+            return pixels
+
+        try:
+            for page in pages:
+                if len(pending) == workers * _parallelPagesPerWorker:
+                    yield result(pending.popleft())
+                width, height = self._pageSize(page)
+                pending.append(executor.submit(_renderRasterPage, page.standalone(), width, height))
+            while pending:
+                yield result(pending.popleft())
+        finally:
+            # pages that haven't started are dropped
+            # when the consumer stops early
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
 
     # ----------
     # Image Data
     # ----------
 
     def imageData(self, format, *args, **kwargs):
+        backend = kwargs.get("backend")
+        if backend is None:
+            backend = _defaultBackend()
+        workers = kwargs.get("workers")
+        cache = self._imageDataCache
+        if cache is None or self._profiler is not None or not self._instructionStack:
+            return self._renderImageData(format, backend, workers)
+        key = self._imageDataKey(format, backend)
+        data = cache.get(key)
+        if data is None:
+            data = self._renderImageData(format, backend, workers)
+            if data is not None:
+                cache.set(key, data)
+        return data
+
+    def saveImage(self, path, *args, **kwargs):
+        # PDF and SVG pages are streamed into their files, a
+        # drawing with several pages is saved as path_1.svg,
+        # path_2.svg and so on. other formats are saved as
+        # their imageData.
+        root, extension = os.path.splitext(path)
+        format = extension[1:].upper()
+        if format == "PDF":
+            with open(path, "wb") as f:
+                context = PDFContext(self._width, self._height, f)
+                if self._instructionStack:
+                    self._drawInContext(context)
+                else:
+                    context.newPage(self._width, self._height)
+                context.close()
+            return
+        if format != "SVG":
+            data = self.imageData(format, *args, **kwargs)
+            with open(path, "wb") as f:
+                f.write(data)
+            return
+        pageCount = len(self._instructionStack)
+
+        def openPage(pageIndex):
+            if pageCount > 1:
+                return open("%s_%d%s" % (root, pageIndex + 1, extension), "wb")
+            return open(path, "wb")
+
+        context = SVGContext(self._width, self._height, openPage)
+        try:
+            if pageCount:
+                self._drawInContext(context)
+            else:
+                context.newPage(self._width, self._height)
+        finally:
+            context.close()
+
+    def _imageDataKey(self, format, backend):
+        # workers don't change the output, so they
+        # aren't part of the key
+        digest = hashlib.sha1(repr((format, backend, self._width, self._height, self._frameDuration)).encode("utf-8"))
+        for page in self._instructionStack:
+            digest.update(page.contentHash(self._pageSize(page)).encode("ascii"))
+        return digest.hexdigest()
+
+    def _renderImageData(self, format, backend, workers):
+        if workers is not None and self._instructionStack:
+            if backend != "raster":
+                raise DrawBotError("parallel rendering requires the raster backend")
+            return self._parallelImageData(format, workers)
+        if format in _vectorContexts:
+            # vector output doesn't depend on the backend
+            context = _vectorContexts[format](self._width, self._height)
+            if self._instructionStack:
+                self._drawInContext(context)
+            else:
+                context.newPage(self._width, self._height)
+            return context.imageData()
+        contextClasses = _getBackend(backend)
         if format == "PNG":
-            context = PNGContext(self._width, self._height)
+            context = contextClasses[format](self._width, self._height)
         elif format == "GIF":
-            context = GIFContext(self._width, self._height, self._frameDuration)
+            context = contextClasses[format](self._width, self._height, self._frameDuration)
         else:
-            raise NotImplementedError("format '%s' is not supported" % fileType)
+            raise NotImplementedError("format '%s' is not supported" % format)
         self._drawInContext(context)
         return context.imageData()
 
+    def _parallelImageData(self, format, workers):
+        if format == "PNG":
+            # a PNG holds the last page
+            frames = list(self._renderPagesInParallel(self._instructionStack[-1:], workers))
+            return _encodePNG(_unpremultiply(frames[-1]))
+        elif format == "GIF":
+            context = RasterGIFContext(self._width, self._height, self._frameDuration)
+            for pixels in self._renderPagesInParallel(self._instructionStack, workers):
+                context._storeFrame(pixels)
+            return context._writeFrames()
+        raise NotImplementedError("format '%s' is not supported" % format)
+
+    # ------------
+    # Render Cache
+    # ------------
+
+    def _renderPage(self, page, pageIndex, backend):
+        width, height = self._pageSize(page)
+        context = _getBackend(backend)["PNG"](width, height)
+        profiler = context.profiler = self._profiler
+        if profiler is not None:
+            profiler.beginPage(pageIndex)
+        page.replay([getattr(context, methodName) for methodName in _instructionMethodNames], profiler)
+        self._countCulling(context.culledCount, context.drawnCount)
+        return context._endPixels()
+
+    def _cachedFrames(self, backend):
+        # pages that hash the same as a page from the previous
+        # call reuse its frame, everything else is rendered.
+        # the cache only keeps the frames of the latest call.
+        previousCache = self._renderCache
+        cache = {}
+        for pageIndex, page in enumerate(self._instructionStack):
+            key = page.contentHash(self._pageSize(page), backend)
+            pixels = cache.get(key)
+            if pixels is None:
+                pixels = previousCache.get(key)
+            if pixels is None:
+                self._renderCacheMisses += 1
+                pixels = self._renderPage(page, pageIndex, backend)
+            else:
+                self._renderCacheHits += 1
+            cache[key] = pixels
+            yield pixels
+        self._renderCache = cache
+
+    def _cachedImageData(self, format, backend=None):
+        if not self._instructionStack:
+            return None
+        if backend is None:
+            backend = _defaultBackend()
+        profiler = self._profiler
+        if format == "PNG":
+            for pixels in self._cachedFrames(backend):
+                pass
+            return _profiledEncode(profiler, _encodePNG, _unpremultiply(pixels))
+        elif format == "GIF":
+            f = io.BytesIO()
+            encoder = GIFEncoder(f, self._frameDuration)
+            for pixels in self._cachedFrames(backend):
+                _profiledEncode(profiler, encoder.addFrame, pixels)
+            _profiledEncode(profiler, encoder.close)
+            return f.getvalue()
+        raise NotImplementedError("format '%s' is not supported" % format)
+
+    # ------
+    # Pixels
+    # ------
+
+    def _pagePixels(self, pageIndex, backend):
+        # the frame of a page from the displayImage frames or
+        # from the frames imagePixels rendered for the current
+        # drawing. those are dropped by newDrawing, and the
+        # least recently used ones beyond the memory limit
+        # are dropped as new ones are added.
+        page = self._instructionStack[pageIndex]
+        key = page.contentHash(self._pageSize(page), backend)
+        pixels = self._renderCache.get(key)
+        if pixels is None:
+            pixels = self._pagePixelsCache.get(key)
+        if pixels is not None:
+            self._renderCacheHits += 1
+            if key in self._pagePixelsCache:
+                self._pagePixelsCache.move_to_end(key)
+            return pixels
+        self._renderCacheMisses += 1
+        pixels = self._pagePixelsCache[key] = self._renderPage(page, pageIndex, backend)
+        self._pagePixelsBytes += pixels.nbytes
+        while self._pagePixelsBytes > _pagePixelsMemoryLimit and len(self._pagePixelsCache) > 1:
+            key, dropped = self._pagePixelsCache.popitem(last=False)
+            self._pagePixelsBytes -= dropped.nbytes
+        return pixels
+
+    def imagePixels(self, pageIndex=-1, backend=None):
+        if not self._instructionStack:
+            return None
+        pageCount = len(self._instructionStack)
+        if not -pageCount <= pageIndex < pageCount:
+            raise DrawBotError("there is no page %d, the drawing has %d pages" % (pageIndex, pageCount))
+        if backend is None:
+            backend = _defaultBackend()
+        return _frameView(self._pagePixels(pageIndex % pageCount, backend))
+
+    def imagePixelColor(self, image, xy):
+        pixels = numpy.asarray(image)
+        if pixels.ndim != 3 or pixels.shape[2] != 4:
+            raise DrawBotError("imagePixelColor needs the pixels returned by imagePixels")
+        height, width = pixels.shape[:2]
+        x, y = xy
+        column = int(math.floor(x))
+        row = height - 1 - int(math.floor(y))
+        if not (0 <= column < width and 0 <= row < height):
+            return None
+        r, g, b, a = pixels[row, column].tolist()
+        if not a:
+            return (0, 0, 0, 0)
+        return (r / a, g / a, b / a, a / 255)
+
+    # ------
+    # Frames
+    # ------
+
+    def iterFrames(self, format=None, backend=None, workers=None):
+        # pages are rendered as their frames are asked for
+        if format not in (None, "PNG"):
+            raise NotImplementedError("format '%s' is not supported" % format)
+        if backend is None:
+            backend = _defaultBackend()
+        if workers is not None:
+            if backend != "raster":
+                raise DrawBotError("parallel rendering requires the raster backend")
+            frames = self._renderPagesInParallel(self._instructionStack, workers)
+        else:
+            frames = self._cachedFrames(backend)
+        return self._iterFrames(frames, format)
+
+    def _iterFrames(self, frames, format):
+        try:
+            for pixels in frames:
+                if format == "PNG":
+                    yield _profiledEncode(self._profiler, _encodePNG, _unpremultiply(pixels))
+                else:
+                    yield _frameView(pixels)
+        finally:
+            frames.close()
+
+    async def renderAsync(self, format=None, backend=None, workers=None):
+        # frames are rendered on a thread, one frame ahead of
+        # the consumer. the frame iterator is only ever used
+        # on that thread, so closing it waits for the page
+        # that is rendering without blocking the event loop.
+        import asyncio
+        import concurrent.futures
+        frames = self.iterFrames(format, backend, workers)
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        future = executor.submit(next, frames, None)
+        try:
+            while True:
+                frame = await asyncio.wrap_future(future)
+                if frame is None:
+                    break
+                future = executor.submit(next, frames, None)
+                yield frame
+        finally:
+            future.cancel()
+            executor.submit(frames.close)
+            executor.shutdown(wait=False)
+
+    def renderCacheInfo(self):
+        return dict(
+            hits=self._renderCacheHits,
+            misses=self._renderCacheMisses,
+            pages=len(self._renderCache)
+        )
+
+    def cullingInfo(self):
+        return dict(
+            culled=self._culledCount,
+            drawn=self._drawnCount
+        )
+
+    def setImageDataCache(self, enabled=True, memoryLimit=32 * 1024 * 1024, directory=None, diskLimit=256 * 1024 * 1024):
+        if enabled:
+            self._imageDataCache = ImageDataCache(memoryLimit, directory, diskLimit)
+        else:
+            self._imageDataCache = None
+
+    def clearImageDataCache(self):
+        if self._imageDataCache is not None:
+            self._imageDataCache.clear()
+
+    def imageDataCacheInfo(self):
+        if self._imageDataCache is None:
+            return None
+        return self._imageDataCache.info()
+
+    # ---------
+    # Optimizer
+    # ---------
+
+    def optimizeDisplayList(self):
+        # rewrites the recorded pages in place
+        removed = dict(stateChanges=0, transforms=0, saveRestore=0)
+        before = sum(len(page) for page in self._instructionStack)
+        self._instructionStack = [_optimizeDisplayList(page, removed) for page in self._instructionStack]
+        after = sum(len(page) for page in self._instructionStack)
+        report = dict(removed)
+        report["before"] = before
+        report["after"] = after
+        return report
+
+    # ---------
+    # Profiling
+    # ---------
+
+    def setRenderProfiler(self, profiler):
+        # the imageData cache is skipped while a
+        # profiler is set, so every call renders
+        self._profiler = profiler
+
     # -------------
     # Display Image
     # -------------
 
     def displayImage(self):
+        # only pages that changed since the last
+        # call to displayImage are rendered again
         if len(self._instructionStack) == 1:
-            data = self.imageData("PNG")
+            data = self._cachedImageData("PNG")
             suffix = ".png"
         else:
-            data = self.imageData("GIF")
+            data = self._cachedImageData("GIF")
             suffix = ".gif"
         if data is None:
             return
+        import tempfile
+        import shutil
         directory = tempfile.mkdtemp()
         fileName = "DrawBotista Preview" + suffix
         path = os.path.join(directory, fileName)
         f = open(path, "wb")
         f.write(data)
         f.close()
+        import console
         console.quicklook(path)
         shutil.rmtree(directory)
 
@@ -237,12 +723,14 @@ class DrawBotDrawingTool(object):
             width = self.width()
             height = self.height()
         if width == "screen":
+            import ui
             width, height = ui.get_screen_size()
         if height is None:
             height = width
         self._width = width
         self._height = height
-        self._addInstruction("newPage")
+        self._resetRecordingState()
+        self._addInstruction(_opNewPage, width, height)
 
     # ---------
     # Animation
@@ -256,10 +744,13 @@ class DrawBotDrawingTool(object):
     # ------
 
     def save(self):
-        self._addInstruction("save")
+        self._recordingStateStack.append((self._ctm, self._fontName, self._fontSize))
+        self._addInstruction(_opSave)
 
     def restore(self):
-        self._addInstruction("restore")
+        if self._recordingStateStack:
+            self._ctm, self._fontName, self._fontSize = self._recordingStateStack.pop()
+        self._addInstruction(_opRestore)
 
     def savedState(self):
         return SavedStateContextManager(self)
@@ -284,29 +775,42 @@ class DrawBotDrawingTool(object):
 
     def fill(self, r, g=None, b=None, alpha=1):
         r, g, b, alpha = self._normalizeColor(r, g, b, alpha)
-        self._addInstruction("fill", r, g, b, alpha)
+        if r is None:
+            self._addInstruction(_opFill, _noValue, 0, 0, 0)
+        else:
+            self._addInstruction(_opFill, r, g, b, alpha)
 
     def stroke(self, r, g=None, b=None, alpha=1):
         r, g, b, alpha = self._normalizeColor(r, g, b, alpha)
-        self._addInstruction("stroke", r, g, b, alpha)
+        if r is None:
+            self._addInstruction(_opStroke, _noValue, 0, 0, 0)
+        else:
+            self._addInstruction(_opStroke, r, g, b, alpha)
 
     # ------
     # Shapes
     # ------
 
+    def _internPath(self, path):
+        # paths are recorded by content. identical geometry is
+        # stored once, as a copy that later changes to path
+        # don't reach, and every drawing of it shares the copy
+        # and whatever the contexts cache on it.
+        key = path._contentDigest()
+        interned = self._internedPaths.get(key)
+        if interned is None:
+            interned = self._internedPaths[key] = path.copy()
+        return interned
+
     def drawPath(self, path=None):
         assert path is not None
-        self._addInstruction("drawPath", path)
+        self._addInstruction(_opDrawPath, self._addObject(self._internPath(path)))
 
     def rect(self, x, y, w, h):
-        path = BezierPath()
-        path.rect(x, y, w, h)
-        self.drawPath(path)
+        self._addInstruction(_opRect, x, y, w, h)
 
     def oval(self, x, y, w, h):
-        path = BezierPath()
-        path.oval(x, y, w, h)
-        self.drawPath(path)
+        self._addInstruction(_opOval, x, y, w, h)
 
     def polygon(self, *points, **kwargs):
         path = BezierPath()
@@ -314,46 +818,101 @@ class DrawBotDrawingTool(object):
         self.drawPath(path)
 
     def line(self, point1, point2):
-        path = BezierPath()
-        path.line(point1, point2)
-        self.drawPath(path)
+        (x1, y1), (x2, y2) = point1, point2
+        self._addInstruction(_opLine, x1, y1, x2, y2)
+
+    # Batches
+
+    def _drawBatch(self, kind, coordinates, colors):
+        if colors is not None:
+            colors = _normalizeBatchColors(colors)
+            if len(colors) != len(coordinates):
+                raise DrawBotError("expected %d colors, got %d" % (len(coordinates), len(colors)))
+        batch = PrimitiveBatch(kind, coordinates, colors)
+        self._addInstruction(_opDrawBatch, self._addObject(batch))
+
+    def rects(self, boxes, colors=None):
+        self._drawBatch("rect", _packBatchCoordinates(boxes), colors)
+
+    def ovals(self, boxes, colors=None):
+        self._drawBatch("oval", _packBatchCoordinates(boxes), colors)
+
+    def lines(self, segments, colors=None):
+        self._drawBatch("line", _packBatchCoordinates(segments), colors)
+
+    def points(self, points, size=1, colors=None):
+        points = numpy.array(points, dtype=float).reshape(-1, 2)
+        boxes = numpy.empty((len(points), 4))
+        boxes[:, :2] = points - size / 2
+        boxes[:, 2:] = size
+        self._drawBatch("rect", boxes, colors)
 
     # Path Properties
 
     def strokeWidth(self, value):
-        self._addInstruction("strokeWidth", value)
+        self._addInstruction(_opStrokeWidth, value)
 
     def miterLimit(self, value):
-        self._addInstruction("miterLimit", value)
+        self._addInstruction(_opMiterLimit, value)
 
     def lineJoin(self, value):
-        self._addInstruction("lineJoin", value)
+        self._addInstruction(_opLineJoin, self._addObject(value))
 
     def lineCap(self, value):
-        self._addInstruction("lineCap", value)
+        self._addInstruction(_opLineCap, self._addObject(value))
 
     def lineDash(self, *value):
         if not value:
             raise DrawBotError("lineDash must be a list of dashes or None")
         if isinstance(value[0], (list, tuple)):
             value = value[0]
-        self._addInstruction("lineDash", value)
+        if value[0] is None:
+            self._addInstruction(_opLineDash, -1)
+        else:
+            self._addInstruction(_opLineDash, self._addObject(tuple(value)))
 
     # ----
     # Text
     # ----
 
     def font(self, fontName, fontSize=None):
-        self._addInstruction("font", fontName, fontSize)
+        self._fontName = fontName
+        if fontSize is None:
+            fontSize = _noValue
+        else:
+            self._fontSize = fontSize
+        self._addInstruction(_opFont, self._addObject(fontName), fontSize)
 
     def fontSize(self, fontSize):
-        self._addInstruction("fontSize", fontSize)
+        self._fontSize = fontSize
+        self._addInstruction(_opFontSize, fontSize)
 
     def textBox(self, txt, box, align=None):
+        # draws the lines that fit in the box and
+        # returns the text that doesn't
         if not isinstance(txt, str):
             raise TypeError("expected 'str', got '%s'" % type(txt).__name__)
-        assert align is None
-        self._addInstruction("textBox", txt, box)
+        alignment = _textAlignment(align)
+        x, y, w, h = box
+        lines, overflow = _textLayout.fit(txt, self._fontName, self._fontSize, w, h)
+        if lines:
+            start, end, lineWidth = lines[-1]
+            self._addInstruction(_opTextBox, self._addObject(txt[:end]), x, y, w, h, alignment)
+        return overflow
+
+    def textOverflow(self, txt, box, align=None):
+        _textAlignment(align)
+        x, y, w, h = box
+        lines, overflow = _textLayout.fit(txt, self._fontName, self._fontSize, w, h)
+        return overflow
+
+    def textSize(self, txt, align=None, width=None, height=None):
+        # the width of the widest line and the height of all
+        # lines, wrapped to width if it is given
+        _textAlignment(align)
+        lines = _textLayout.lines(txt, self._fontName, self._fontSize, width)
+        textWidth = max(lineWidth for start, end, lineWidth in lines)
+        return textWidth, len(lines) * self._fontSize * _lineHeightFactor
 
     # ---------------
     # Transformations
@@ -361,8 +920,14 @@ class DrawBotDrawingTool(object):
 
     def transform(self, matrix, center=(0, 0)):
         if center != (0, 0):
-            warnings.warn("center is not implemented.")
-        self._addInstruction("transform", matrix)
+            matrix = _centeredTransform(matrix, center)
+        self._ctm = _multiplyTransforms(matrix, self._ctm)
+        self._addInstruction(_opTransform, *matrix)
+
+    def currentTransform(self):
+        # the transform from the current user space to
+        # the page, with the origin at the bottom left
+        return self._ctm
 
     def translate(self, x=0, y=0):
         self.transform((1, 0, 0, 1, x, y))
@@ -384,6 +949,572 @@ class DrawBotDrawingTool(object):
         self.transform((1, math.tan(angle2), math.tan(angle1), 1, 0, 0), center)
 
 
+# ------------
+# Display List
+# ------------
+#
+# Each page of a drawing is recorded as an array of
+# integer opcodes and a packed array of float operands.
+# Anything that isn't a number (paths, strings, dashes)
+# is stored once in a table shared by all pages and
+# referenced by its index. A missing value is NaN.
+
+_noValue = float("nan")
+
+
+def _decodeNoOperands(method, nextOperand, objects):
+    method()
+
+
+def _decodeValue(method, nextOperand, objects):
+    method(nextOperand())
+
+
+def _decodeObject(method, nextOperand, objects):
+    method(objects[int(nextOperand())])
+
+
+def _decodeNewPage(method, nextOperand, objects):
+    method(nextOperand(), nextOperand())
+
+
+def _decodeColor(method, nextOperand, objects):
+    r, g, b, alpha = nextOperand(), nextOperand(), nextOperand(), nextOperand()
+    if r != r:
+        method(None)
+    else:
+        method(r, g, b, alpha)
+
+
+def _decodeShape(method, nextOperand, objects):
+    method(nextOperand(), nextOperand(), nextOperand(), nextOperand())
+
+
+def _decodeLineDash(method, nextOperand, objects):
+    index = nextOperand()
+    if index < 0:
+        method(None)
+    else:
+        method(objects[int(index)])
+
+
+def _decodeFont(method, nextOperand, objects):
+    fontName = objects[int(nextOperand())]
+    fontSize = nextOperand()
+    if fontSize != fontSize:
+        fontSize = None
+    method(fontName, fontSize)
+
+
+def _decodeTextBox(method, nextOperand, objects):
+    txt = objects[int(nextOperand())]
+    box = (nextOperand(), nextOperand(), nextOperand(), nextOperand())
+    method(txt, box, _textAlignments[int(nextOperand())])
+
+
+def _decodeTransform(method, nextOperand, objects):
+    method((nextOperand(), nextOperand(), nextOperand(), nextOperand(), nextOperand(), nextOperand()))
+
+
+_instructionTable = (
+    # opcode name, context method, operand count, decoder, object operands
+    ("newPage", "newPage", 2, _decodeNewPage, ()),
+    ("save", "save", 0, _decodeNoOperands, ()),
+    ("restore", "restore", 0, _decodeNoOperands, ()),
+    ("fill", "fill", 4, _decodeColor, ()),
+    ("stroke", "stroke", 4, _decodeColor, ()),
+    ("drawPath", "drawPath", 1, _decodeObject, (0,)),
+    ("rect", "rect", 4, _decodeShape, ()),
+    ("oval", "oval", 4, _decodeShape, ()),
+    ("line", "line", 4, _decodeShape, ()),
+    ("drawBatch", "drawBatch", 1, _decodeObject, (0,)),
+    ("strokeWidth", "strokeWidth", 1, _decodeValue, ()),
+    ("miterLimit", "miterLimit", 1, _decodeValue, ()),
+    ("lineJoin", "lineJoin", 1, _decodeObject, (0,)),
+    ("lineCap", "lineCap", 1, _decodeObject, (0,)),
+    ("lineDash", "lineDash", 1, _decodeLineDash, (0,)),
+    ("font", "font", 2, _decodeFont, (0,)),
+    ("fontSize", "fontSize", 1, _decodeValue, ()),
+    ("textBox", "textBox", 6, _decodeTextBox, (0,)),
+    ("transform", "transform", 6, _decodeTransform, ()),
+)
+
+(
+    _opNewPage,
+    _opSave,
+    _opRestore,
+    _opFill,
+    _opStroke,
+    _opDrawPath,
+    _opRect,
+    _opOval,
+    _opLine,
+    _opDrawBatch,
+    _opStrokeWidth,
+    _opMiterLimit,
+    _opLineJoin,
+    _opLineCap,
+    _opLineDash,
+    _opFont,
+    _opFontSize,
+    _opTextBox,
+    _opTransform
+) = range(len(_instructionTable))
+
+_instructionNames = tuple(instruction[0] for instruction in _instructionTable)
+_instructionMethodNames = tuple(instruction[1] for instruction in _instructionTable)
+_instructionOperandCounts = tuple(instruction[2] for instruction in _instructionTable)
+_instructionDecoders = tuple(instruction[3] for instruction in _instructionTable)
+_instructionObjectOperands = tuple(instruction[4] for instruction in _instructionTable)
+
+
+def _hashObject(digest, obj):
+    digest.update(type(obj).__name__.encode("utf-8"))
+    updateHash = getattr(obj, "_updateHash", None)
+    if updateHash is not None:
+        updateHash(digest)
+    else:
+        digest.update(repr(obj).encode("utf-8"))
+
+
+class DisplayList(object):
+
+    def __init__(self, objects):
+        self.opcodes = array.array("B")
+        self.operands = array.array("d")
+        self.objects = objects
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __iter__(self):
+        operands = self.operands
+        position = 0
+        for opcode in self.opcodes:
+            count = _instructionOperandCounts[opcode]
+            yield opcode, operands[position:position + count]
+            position += count
+
+    def contentHash(self, *extra):
+        # a digest of everything the page draws. objects are
+        # hashed by content instead of by index, so the same
+        # page hashes the same way in every drawing. extra
+        # holds state the page inherits, like its size.
+        digest = hashlib.sha1(repr(extra).encode("utf-8"))
+        operands = array.array("d", self.operands)
+        position = 0
+        for opcode in self.opcodes:
+            for offset in _instructionObjectOperands[opcode]:
+                index = int(operands[position + offset])
+                if index < 0:
+                    continue
+                operands[position + offset] = 0
+                _hashObject(digest, self.objects[index])
+            position += _instructionOperandCounts[opcode]
+        digest.update(self.opcodes.tobytes())
+        digest.update(operands.tobytes())
+        return digest.hexdigest()
+
+    def standalone(self):
+        # a copy that only holds the objects it refers to,
+        # for sending a single page to another process
+        page = DisplayList([])
+        page.opcodes = array.array("B", self.opcodes)
+        page.operands = operands = array.array("d", self.operands)
+        indexes = {}
+        position = 0
+        for opcode in self.opcodes:
+            for offset in _instructionObjectOperands[opcode]:
+                index = int(operands[position + offset])
+                if index < 0:
+                    continue
+                if index not in indexes:
+                    indexes[index] = len(page.objects)
+                    page.objects.append(self.objects[index])
+                operands[position + offset] = indexes[index]
+            position += _instructionOperandCounts[opcode]
+        return page
+
+    def replay(self, methods, profiler=None):
+        # methods holds the context method for each opcode,
+        # the decoders take their operands from the iterator
+        nextOperand = iter(self.operands).__next__
+        objects = self.objects
+        decoders = _instructionDecoders
+        if profiler is None:
+            # fill, stroke, shapes and transforms make up most
+            # pages, they are decoded here to save a call each
+            for opcode in self.opcodes:
+                if _opFill <= opcode <= _opLine:
+                    if opcode >= _opRect:
+                        methods[opcode](nextOperand(), nextOperand(), nextOperand(), nextOperand())
+                        continue
+                    if opcode != _opDrawPath:
+                        r = nextOperand()
+                        if r != r:
+                            nextOperand(), nextOperand(), nextOperand()
+                            methods[opcode](None)
+                        else:
+                            methods[opcode](r, nextOperand(), nextOperand(), nextOperand())
+                        continue
+                elif opcode == _opTransform:
+                    methods[opcode]((nextOperand(), nextOperand(), nextOperand(), nextOperand(), nextOperand(), nextOperand()))
+                    continue
+                decoders[opcode](methods[opcode], nextOperand, objects)
+            return
+        names = _instructionNames
+        clock = time.perf_counter
+        for opcode in self.opcodes:
+            start = clock()
+            decoders[opcode](methods[opcode], nextOperand, objects)
+            profiler.addInstruction(names[opcode], clock() - start)
+
+
+# ---------
+# Optimizer
+# ---------
+#
+# Rewrites a page without changing what it draws. State
+# changes that set the value the state already has are
+# dropped, consecutive transforms are folded into one and
+# identity transforms are dropped, and save/restore pairs
+# that don't draw anything are removed with everything in
+# between. Contexts start every page with a fresh state, so
+# pages are optimized on their own.
+
+_stateOpcodes = {
+    _opFill: (_opFill,),
+    _opStroke: (_opStroke,),
+    _opStrokeWidth: (_opStrokeWidth,),
+    _opMiterLimit: (_opMiterLimit,),
+    _opLineJoin: (_opLineJoin,),
+    _opLineCap: (_opLineCap,),
+    _opLineDash: (_opLineDash,),
+    # font and fontSize both change the font size, so
+    # each one forgets the value of the other
+    _opFont: (_opFont, _opFontSize),
+    _opFontSize: (_opFontSize, _opFont)
+}
+
+_drawingOpcodes = frozenset((_opDrawPath, _opRect, _opOval, _opLine, _opDrawBatch, _opTextBox))
+
+def _optimizeDisplayList(page, removed):
+    # returns the optimized page. removed counts the
+    # instructions that were taken out by kind.
+    instructions = []
+    state = {}
+    # (index of the save in instructions, state at the save, draws)
+    saves = []
+    position = 0
+    for opcode in page.opcodes:
+        count = _instructionOperandCounts[opcode]
+        operands = tuple(page.operands[position:position + count])
+        position += count
+        if opcode in _stateOpcodes:
+            value = array.array("d", operands).tobytes()
+            if state.get(opcode) == value:
+                removed["stateChanges"] += 1
+                continue
+            for forgotten in _stateOpcodes[opcode]:
+                state.pop(forgotten, None)
+            state[opcode] = value
+        elif opcode == _opTransform:
+            if operands == _identityTransform:
+                removed["transforms"] += 1
+                continue
+            if instructions and instructions[-1][0] == _opTransform:
+                removed["transforms"] += 1
+                operands = _multiplyTransforms(operands, instructions.pop()[1])
+                if operands == _identityTransform:
+                    removed["transforms"] += 1
+                    continue
+        elif opcode == _opSave:
+            saves.append((len(instructions), dict(state), False))
+        elif opcode == _opRestore:
+            if not saves:
+                # an unmatched restore fails in the context
+                state = {}
+            else:
+                index, state, draws = saves.pop()
+                if not draws:
+                    removed["saveRestore"] += len(instructions) - index + 1
+                    del instructions[index:]
+                    continue
+                if saves:
+                    saves[-1] = saves[-1][:2] + (True,)
+        elif opcode in _drawingOpcodes:
+            if saves and not saves[-1][2]:
+                saves[-1] = saves[-1][:2] + (True,)
+        instructions.append((opcode, operands))
+    optimized = DisplayList(page.objects)
+    for opcode, operands in instructions:
+        optimized.opcodes.append(opcode)
+        optimized.operands.extend(operands)
+    return optimized
+
+
+# ---------
+# Profiling
+# ---------
+
+class _Timing(object):
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.maxSeconds = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.maxSeconds:
+            self.maxSeconds = seconds
+
+    def asDict(self):
+        return dict(count=self.count, seconds=self.seconds, maxSeconds=self.maxSeconds)
+
+
+class RenderProfiler(object):
+
+    # collects the wall time of every instruction replayed
+    # into a context and of every encoding step. callback,
+    # if given, is called with (name, pageIndex, seconds)
+    # for each of them. encoding steps are named "encode".
+    # encoding that happens inside an instruction, like a
+    # GIF frame written on newPage, only counts as encoding.
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        self._instructions = {}
+        self._pages = []
+        self._encode = _Timing()
+        self._pageIndex = None
+        self._nestedEncodeSeconds = 0.0
+
+    def beginPage(self, pageIndex):
+        self._pageIndex = pageIndex
+        self._pages.append((pageIndex, _Timing()))
+        self._nestedEncodeSeconds = 0.0
+
+    def addInstruction(self, name, seconds):
+        seconds -= self._nestedEncodeSeconds
+        self._nestedEncodeSeconds = 0.0
+        timing = self._instructions.get(name)
+        if timing is None:
+            timing = self._instructions[name] = _Timing()
+        timing.add(seconds)
+        self._pages[-1][1].add(seconds)
+        if self.callback is not None:
+            self.callback(name, self._pageIndex, seconds)
+
+    def addEncode(self, seconds):
+        self._encode.add(seconds)
+        self._nestedEncodeSeconds += seconds
+        if self.callback is not None:
+            self.callback("encode", self._pageIndex, seconds)
+
+    def report(self):
+        instructions = dict((name, timing.asDict()) for name, timing in self._instructions.items())
+        pages = []
+        for pageIndex, timing in self._pages:
+            page = timing.asDict()
+            page["page"] = pageIndex
+            pages.append(page)
+        return dict(
+            instructions=instructions,
+            pages=pages,
+            encode=self._encode.asDict(),
+            seconds=sum(timing.seconds for timing in self._instructions.values()) + self._encode.seconds
+        )
+
+
+def _profiledEncode(profiler, function, *args):
+    if profiler is None:
+        return function(*args)
+    start = time.perf_counter()
+    result = function(*args)
+    profiler.addEncode(time.perf_counter() - start)
+    return result
+
+
+# ----------------
+# Image Data Cache
+# ----------------
+#
+# Encoded image data keyed by a hash of the drawing. The
+# memory tier and the optional disk tier both evict the
+# least recently used entries once they pass their byte
+# limit. Disk entries are written through and survive the
+# process, their modification time records their use.
+
+_imageDataCacheSuffix = ".drawbotista"
+
+
+class ImageDataCache(object):
+
+    def __init__(self, memoryLimit=32 * 1024 * 1024, directory=None, diskLimit=256 * 1024 * 1024):
+        self.memoryLimit = memoryLimit
+        self.directory = directory
+        self.diskLimit = diskLimit
+        self._memory = collections.OrderedDict()
+        self._memoryBytes = 0
+        self._disk = collections.OrderedDict()
+        self._diskBytes = 0
+        self._memoryHits = 0
+        self._diskHits = 0
+        self._misses = 0
+        self._evictions = 0
+        if directory is not None:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self._loadDiskEntries()
+
+    def _loadDiskEntries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_imageDataCacheSuffix):
+                info = entry.stat()
+                entries.append((info.st_mtime, entry.name[:-len(_imageDataCacheSuffix)], info.st_size))
+        for modified, key, size in sorted(entries):
+            self._disk[key] = size
+            self._diskBytes += size
+        self._evictDisk()
+
+    def _diskPath(self, key):
+        return os.path.join(self.directory, key + _imageDataCacheSuffix)
+
+    def get(self, key):
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self._memoryHits += 1
+            return data
+        if key in self._disk:
+            path = self._diskPath(key)
+            try:
+                f = open(path, "rb")
+                data = f.read()
+                f.close()
+                os.utime(path)
+            except OSError:
+                self._diskBytes -= self._disk.pop(key)
+            else:
+                self._disk.move_to_end(key)
+                self._diskHits += 1
+                self._storeInMemory(key, data)
+                return data
+        self._misses += 1
+        return None
+
+    def set(self, key, data):
+        self._storeInMemory(key, data)
+        if self.directory is not None and key not in self._disk and len(data) <= self.diskLimit:
+            path = self._diskPath(key)
+            temporaryPath = path + ".tmp"
+            f = open(temporaryPath, "wb")
+            f.write(data)
+            f.close()
+            os.replace(temporaryPath, path)
+            self._disk[key] = len(data)
+            self._diskBytes += len(data)
+            self._evictDisk()
+
+    def _storeInMemory(self, key, data):
+        if len(data) > self.memoryLimit:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memoryBytes -= len(previous)
+        self._memory[key] = data
+        self._memoryBytes += len(data)
+        while self._memoryBytes > self.memoryLimit:
+            oldKey, oldData = self._memory.popitem(last=False)
+            self._memoryBytes -= len(oldData)
+            self._evictions += 1
+
+    def _evictDisk(self):
+        while self._diskBytes > self.diskLimit:
+            oldKey, size = self._disk.popitem(last=False)
+            self._diskBytes -= size
+            self._evictions += 1
+            try:
+                os.remove(self._diskPath(oldKey))
+            except OSError:
+                pass
+
+    def clear(self):
+        self._memory.clear()
+        self._memoryBytes = 0
+        for key in self._disk:
+            try:
+                os.remove(self._diskPath(key))
+            except OSError:
+                pass
+        self._disk.clear()
+        self._diskBytes = 0
+
+    def info(self):
+        return dict(
+            hits=self._memoryHits + self._diskHits,
+            memoryHits=self._memoryHits,
+            diskHits=self._diskHits,
+            misses=self._misses,
+            evictions=self._evictions,
+            memoryEntries=len(self._memory),
+            memoryBytes=self._memoryBytes,
+            diskEntries=len(self._disk),
+            diskBytes=self._diskBytes
+        )
+
+
+# -----------------
+# Affine Transforms
+# -----------------
+#
+# Transforms are (a, b, c, d, tx, ty) tuples that map
+# x, y to a * x + c * y + tx, b * x + d * y + ty.
+
+_identityTransform = (1, 0, 0, 1, 0, 0)
+
+
+def _multiplyTransforms(first, second):
+    # the transform that applies first and then second
+    a1, b1, c1, d1, tx1, ty1 = first
+    a2, b2, c2, d2, tx2, ty2 = second
+    return (
+        a1 * a2 + b1 * c2,
+        a1 * b2 + b1 * d2,
+        c1 * a2 + d1 * c2,
+        c1 * b2 + d1 * d2,
+        tx1 * a2 + ty1 * c2 + tx2,
+        tx1 * b2 + ty1 * d2 + ty2
+    )
+
+
+def _centeredTransform(transformMatrix, center):
+    # the transform around center instead of the origin
+    a, b, c, d, tx, ty = transformMatrix
+    cx, cy = center
+    return (a, b, c, d, tx + cx - a * cx - c * cy, ty + cy - b * cx - d * cy)
+
+
+def _transformPoint(transformMatrix, x, y):
+    a, b, c, d, tx, ty = transformMatrix
+    return a * x + c * y + tx, b * x + d * y + ty
+
+
+def _transformBounds(transformMatrix, bounds):
+    # the bounds of the transformed corners of bounds
+    xMin, yMin, xMax, yMax = bounds
+    a, b, c, d, tx, ty = transformMatrix
+    xs = (a * xMin + c * yMin, a * xMax + c * yMin, a * xMin + c * yMax, a * xMax + c * yMax)
+    ys = (b * xMin + d * yMin, b * xMax + d * yMin, b * xMin + d * yMax, b * xMax + d * yMax)
+    return min(xs) + tx, min(ys) + ty, max(xs) + tx, max(ys) + ty
+
+
 # --------------
 # Graphics State
 # --------------
@@ -403,31 +1534,54 @@ class SavedStateContextManager(object):
 
 class GraphicsState(object):
 
+    # saving a state doesn't copy it, it only counts the
+    # saved states that share it. contexts get the state
+    # from _writableState() before changing it, and that
+    # copies the state first if it is shared.
+
+    __slots__ = (
+        "fillColor",
+        "strokeColor",
+        "strokeWidth",
+        "miterLimit",
+        "lineJoin",
+        "lineCap",
+        "lineDash",
+        "path",
+        "text_fontName",
+        "text_fontSize",
+        "ctm",
+        "shareCount"
+    )
+
     def __init__(self):
-        self._loadAttributes(None)
-
-    def _loadAttributes(self, other=None):
-        attributesAndFallbacks = dict(
-            fillColor=(0, 0, 0, 1),
-            strokeColor=None,
-            strokeWidth=1,
-            miterLimit=10,
-            lineJoin="miter",
-            lineCap="butt",
-            lineDash=None,
-            path=None,
-            text_fontName=None,
-            text_fontSize=10
-        )
-        for attr, fallback in attributesAndFallbacks.items():
-            value = fallback
-            if other is not None and hasattr(other, attr):
-                value = getattr(other, attr)
-            setattr(self, attr, value)
+        self.fillColor = (0, 0, 0, 1)
+        self.strokeColor = None
+        self.strokeWidth = 1
+        self.miterLimit = 10
+        self.lineJoin = "miter"
+        self.lineCap = "butt"
+        self.lineDash = None
+        self.path = None
+        self.text_fontName = None
+        self.text_fontSize = 10
+        self.ctm = _identityTransform
+        self.shareCount = 0
 
     def copy(self):
-        new = self.__class__()
-        new._loadAttributes(self)
+        new = object.__new__(self.__class__)
+        new.fillColor = self.fillColor
+        new.strokeColor = self.strokeColor
+        new.strokeWidth = self.strokeWidth
+        new.miterLimit = self.miterLimit
+        new.lineJoin = self.lineJoin
+        new.lineCap = self.lineCap
+        new.lineDash = self.lineDash
+        new.path = self.path
+        new.text_fontName = self.text_fontName
+        new.text_fontSize = self.text_fontSize
+        new.ctm = self.ctm
+        new.shareCount = 0
         return new
 
 
@@ -435,28 +1589,99 @@ class GraphicsState(object):
 # Bezier Path
 # -----------
 
+_segmentMoveTo = 0
+_segmentLineTo = 1
+_segmentCurveTo = 2
+_segmentClosePath = 3
+
+_segmentPointCounts = (1, 1, 3, 0)
+
+# the farthest a flattened curve may be from the
+# curve, in user space for hit-testing and in
+# pixels when rendering
+_flatteningTolerance = 0.25
+
+# the most line segments a single cubic is split into
+_maximumCurveSteps = 1024
+
+_ovalKappa = 0.5522847498307936
+
+
 class BezierPath(object):
 
     def __init__(self, path=None, glyphSet=None):
         assert glyphSet is None
-        if path is None:
-            path = UIBezierPath.bezierPath()
-        self._path = path
+        self._segmentTypes = array.array("B")
+        self._points = array.array("d")
+        self._native = None
+        self._pointBounds = None
+        self._flattened = {}
+        self._edges = None
+        self._strokes = {}
+        self._digest = None
+        if path is not None:
+            if isinstance(path, BezierPath):
+                self.appendPath(path)
+            else:
+                self._appendNativePath(path)
+
+    def _contentDigest(self):
+        if self._digest is None:
+            digest = hashlib.sha1(self._segmentTypes.tobytes())
+            digest.update(self._points.tobytes())
+            self._digest = digest.digest()
+        return self._digest
+
+    def _updateHash(self, digest):
+        digest.update(self._contentDigest())
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_native"] = None
+        state["_flattened"] = {}
+        state["_edges"] = None
+        state["_strokes"] = {}
+        return state
+
+    def _changed(self):
+        self._native = None
+        self._pointBounds = None
+        self._flattened = {}
+        self._edges = None
+        self._strokes = {}
+        self._digest = None
+
+    def _iterSegments(self):
+        points = self._points
+        index = 0
+        for segmentType in self._segmentTypes:
+            count = _segmentPointCounts[segmentType] * 2
+            yield segmentType, points[index:index + count]
+            index += count
 
     # Pen
 
     def moveTo(self, point):
-        self._path.moveToPoint_(CGPoint(*point))
+        x, y = point
+        self._segmentTypes.append(_segmentMoveTo)
+        self._points.extend((x, y))
+        self._changed()
 
     def lineTo(self, point):
-        self._path.addLineToPoint_(CGPoint(*point))
+        x, y = point
+        self._segmentTypes.append(_segmentLineTo)
+        self._points.extend((x, y))
+        self._changed()
 
     def curveTo(self, *points):
-        print(points)
-        self._path.addCurveToPoint_controlPoint1_controlPoint2_(CGPoint(*points[2]), CGPoint(*points[0]), CGPoint(*points[1]))
+        (x1, y1), (x2, y2), (x3, y3) = points
+        self._segmentTypes.append(_segmentCurveTo)
+        self._points.extend((x1, y1, x2, y2, x3, y3))
+        self._changed()
 
     def closePath(self):
-        self._path.closePath()
+        self._segmentTypes.append(_segmentClosePath)
+        self._changed()
 
     def endPath(self):
         pass
@@ -464,12 +1689,31 @@ class BezierPath(object):
     # Shapes
 
     def rect(self, x, y, w, h):
-        sub = UIBezierPath.bezierPathWithRect_(CGRect(CGPoint(x, y), CGSize(w, h)))
-        self._path.appendPath_(sub)
+        self._segmentTypes.extend((_segmentMoveTo, _segmentLineTo, _segmentLineTo, _segmentLineTo, _segmentClosePath))
+        self._points.extend((
+            x, y,
+            x + w, y,
+            x + w, y + h,
+            x, y + h
+        ))
+        self._changed()
 
     def oval(self, x, y, w, h):
-        sub = UIBezierPath.bezierPathWithOvalInRect_(CGRect(CGPoint(x, y), CGSize(w, h)))
-        self._path.appendPath_(sub)
+        rx = w / 2
+        ry = h / 2
+        cx = x + rx
+        cy = y + ry
+        ox = rx * _ovalKappa
+        oy = ry * _ovalKappa
+        self._segmentTypes.extend((_segmentMoveTo, _segmentCurveTo, _segmentCurveTo, _segmentCurveTo, _segmentCurveTo, _segmentClosePath))
+        self._points.extend((
+            cx + rx, cy,
+            cx + rx, cy + oy, cx + ox, cy + ry, cx, cy + ry,
+            cx - ox, cy + ry, cx - rx, cy + oy, cx - rx, cy,
+            cx - rx, cy - oy, cx - ox, cy - ry, cx, cy - ry,
+            cx + ox, cy - ry, cx + rx, cy - oy, cx + rx, cy
+        ))
+        self._changed()
 
     def line(self, point1, point2):
         self.moveTo(point1)
@@ -489,22 +1733,147 @@ class BezierPath(object):
 
     # Path Testing and Properties
 
-    def pointInside(self, point):
-        return self._path.containsPoint_(CGPoint(*point))
+    def _flattenedContours(self, tolerance=_flatteningTolerance):
+        # (points, closed) for every contour, with the points
+        # in an (n, 2) array. memoized until the path changes.
+        contours = self._flattened.get(tolerance)
+        if contours is None:
+            contours = self._flattened[tolerance] = _flattenPath(self._segmentTypes, self._points, tolerance)
+        return contours
+
+    def _windingEdges(self):
+        # the start and end points of every flattened edge,
+        # with every contour closed, as four arrays
+        if self._edges is None:
+            contours = [points for points, closed in self._flattenedContours()]
+            if contours:
+                ends = numpy.concatenate(contours)
+                starts = numpy.concatenate([numpy.roll(points, 1, axis=0) for points in contours])
+            else:
+                ends = starts = numpy.zeros((0, 2))
+            self._edges = (starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1])
+        return self._edges
+
+    def _winding(self, x, y):
+        x0, y0, x1, y1 = self._windingEdges()
+        cross = (x1 - x0) * (y - y0) - (x - x0) * (y1 - y0)
+        upward = (y0 <= y) & (y1 > y) & (cross > 0)
+        downward = (y0 > y) & (y1 <= y) & (cross < 0)
+        return int(upward.sum()) - int(downward.sum())
+
+    def pointInside(self, point, evenOdd=False):
+        x, y = point
+        winding = self._winding(x, y)
+        if evenOdd:
+            return winding % 2 != 0
+        return winding != 0
+
+    def _controlBounds(self):
+        # the bounds of all points, off-curve points included,
+        # which always contain the path. None for no points.
+        if self._pointBounds is None and self._points:
+            xs = self._points[0::2]
+            ys = self._points[1::2]
+            self._pointBounds = (min(xs), min(ys), max(xs), max(ys))
+        return self._pointBounds
 
     def bounds(self):
-        (x, y), (w, h) = self._path.bounds()
-        return (x, y, w, h)
+        if not self._points:
+            return None
+        xs = []
+        ys = []
+        lastX = lastY = 0
+        for segmentType, points in self._iterSegments():
+            if segmentType == _segmentCurveTo:
+                x1, y1, x2, y2, x3, y3 = points
+                xs.extend(_cubicExtrema(lastX, x1, x2, x3))
+                ys.extend(_cubicExtrema(lastY, y1, y2, y3))
+                lastX = x3
+                lastY = y3
+            elif points:
+                lastX, lastY = points
+                xs.append(lastX)
+                ys.append(lastY)
+        xMin = min(xs)
+        yMin = min(ys)
+        return (xMin, yMin, max(xs) - xMin, max(ys) - yMin)
 
     # Path Operations
 
     def copy(self):
+        # the copy has the same geometry, so it starts
+        # out with everything derived from it
         new = self.__class__()
-        new.appendPath(self)
+        new._segmentTypes = array.array("B", self._segmentTypes)
+        new._points = array.array("d", self._points)
+        new._native = self._native
+        new._pointBounds = self._pointBounds
+        new._flattened = dict(self._flattened)
+        new._edges = self._edges
+        new._strokes = dict(self._strokes)
+        new._digest = self._digest
         return new
 
     def appendPath(self, otherPath):
-        self._path.appendPath_(otherPath._path)
+        self._segmentTypes.extend(otherPath._segmentTypes)
+        self._points.extend(otherPath._points)
+        self._changed()
+
+    # Boolean Operations
+
+    def _booleanOperation(self, other, operation):
+        edges = [_booleanEdges(self)]
+        if other is not None:
+            edges.append(_booleanEdges(other))
+        new = self.__class__()
+        for contour in _booleanContours(edges, operation):
+            new.polygon(*contour)
+        return new
+
+    def union(self, other):
+        return self._booleanOperation(other, _booleanUnion)
+
+    def difference(self, other):
+        return self._booleanOperation(other, _booleanDifference)
+
+    def intersection(self, other):
+        return self._booleanOperation(other, _booleanIntersection)
+
+    def xor(self, other):
+        return self._booleanOperation(other, _booleanXor)
+
+    def removeOverlap(self):
+        return self._replaceWith(self._booleanOperation(None, _booleanUnion))
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def __xor__(self, other):
+        return self.xor(other)
+
+    def __ior__(self, other):
+        return self._replaceWith(self.union(other))
+
+    def __iand__(self, other):
+        return self._replaceWith(self.intersection(other))
+
+    def __isub__(self, other):
+        return self._replaceWith(self.difference(other))
+
+    def __ixor__(self, other):
+        return self._replaceWith(self.xor(other))
+
+    def _replaceWith(self, other):
+        self._segmentTypes = other._segmentTypes
+        self._points = other._points
+        self._changed()
+        return self
 
     # Transformations
 
@@ -529,19 +1898,1058 @@ class BezierPath(object):
 
     def transform(self, transformMatrix, center=(0, 0)):
         if center != (0, 0):
-            warnings.warn("center is not implemented.")
-        transform = CGAffineTransform(*transformMatrix)
-        self._path.applyTransform_(transform)
+            transformMatrix = _centeredTransform(transformMatrix, center)
+        a, b, c, d, tx, ty = transformMatrix
+        points = self._points
+        xs = points[0::2]
+        ys = points[1::2]
+        points[0::2] = array.array("d", [a * x + c * y + tx for x, y in zip(xs, ys)])
+        points[1::2] = array.array("d", [b * x + d * y + ty for x, y in zip(xs, ys)])
+        self._changed()
+
+    # Native
+
+    def _nativePath(self):
+        if self._native is None:
+            _loadBridge()
+            path = UIBezierPath.bezierPath()
+            for segmentType, points in self._iterSegments():
+                if segmentType == _segmentMoveTo:
+                    path.moveToPoint_(CGPoint(*points))
+                elif segmentType == _segmentLineTo:
+                    path.addLineToPoint_(CGPoint(*points))
+                elif segmentType == _segmentCurveTo:
+                    x1, y1, x2, y2, x3, y3 = points
+                    path.addCurveToPoint_controlPoint1_controlPoint2_(CGPoint(x3, y3), CGPoint(x1, y1), CGPoint(x2, y2))
+                elif segmentType == _segmentClosePath:
+                    path.closePath()
+            self._native = path
+        return self._native
+
+    def _appendNativePath(self, nativePath):
+        _loadBridge()
+        lastPoint = [(0, 0)]
+
+        def applier(info, element):
+            element = element.contents
+            elementType = element.type
+            points = element.points
+            if elementType == kCGPathElementMoveToPoint:
+                self.moveTo((points[0].x, points[0].y))
+            elif elementType == kCGPathElementAddLineToPoint:
+                self.lineTo((points[0].x, points[0].y))
+            elif elementType == kCGPathElementAddQuadCurveToPoint:
+                x0, y0 = lastPoint[0]
+                qx, qy = points[0].x, points[0].y
+                x3, y3 = points[1].x, points[1].y
+                self.curveTo(
+                    (x0 + (qx - x0) * 2 / 3, y0 + (qy - y0) * 2 / 3),
+                    (x3 + (qx - x3) * 2 / 3, y3 + (qy - y3) * 2 / 3),
+                    (x3, y3)
+                )
+            elif elementType == kCGPathElementAddCurveToPoint:
+                self.curveTo(
+                    (points[0].x, points[0].y),
+                    (points[1].x, points[1].y),
+                    (points[2].x, points[2].y)
+                )
+            elif elementType == kCGPathElementCloseSubpath:
+                self.closePath()
+            if self._points:
+                lastPoint[0] = tuple(self._points[-2:])
+
+        CGPathApply(nativePath.CGPath(), None, CGPathApplierFunction(applier))
+
+
+def _flattenPath(segmentTypes, points, tolerance):
+    # contours are collected as runs of points and curve
+    # indexes first, then all curves are flattened at once
+    curves = []
+    contours = []
+    pieces = None
+    lastX = lastY = 0
+    index = 0
+    for segmentType in segmentTypes:
+        count = _segmentPointCounts[segmentType] * 2
+        values = points[index:index + count]
+        index += count
+        if segmentType == _segmentMoveTo:
+            lastX, lastY = values
+            pieces = [(lastX, lastY)]
+            contours.append([pieces, False])
+            continue
+        if segmentType == _segmentClosePath:
+            if pieces:
+                lastX, lastY = pieces[0]
+                contours[-1][1] = True
+            pieces = None
+            continue
+        if pieces is None:
+            # drawing without a moveTo starts a new
+            # contour at the current point
+            pieces = [(lastX, lastY)]
+            contours.append([pieces, False])
+        if segmentType == _segmentLineTo:
+            lastX, lastY = values
+            pieces.append((lastX, lastY))
+        else:
+            pieces.append(len(curves))
+            curves.append((lastX, lastY) + tuple(values))
+            lastX, lastY = values[4:]
+    if curves:
+        curves = _flattenCubics(numpy.array(curves, dtype=float), tolerance)
+    flattened = []
+    for pieces, closed in contours:
+        parts = []
+        run = []
+        for piece in pieces:
+            if piece.__class__ is int:
+                if run:
+                    parts.append(numpy.array(run, dtype=float))
+                    run = []
+                parts.append(curves[piece])
+            else:
+                run.append(piece)
+        if run:
+            parts.append(numpy.array(run, dtype=float))
+        flattened.append((numpy.concatenate(parts) if len(parts) > 1 else parts[0], closed))
+    return flattened
+
+
+def _flattenCubics(curves, tolerance):
+    # the polylines of (n, 8) cubics without their start
+    # points. Wang's formula gives the steps that keep each
+    # polyline within tolerance of its curve.
+    p0 = curves[:, 0:2]
+    p1 = curves[:, 2:4]
+    p2 = curves[:, 4:6]
+    p3 = curves[:, 6:8]
+    deviation = numpy.maximum(
+        numpy.hypot(*(p0 - 2 * p1 + p2).T),
+        numpy.hypot(*(p1 - 2 * p2 + p3).T)
+    )
+    steps = numpy.ceil(numpy.sqrt(0.75 * deviation / tolerance))
+    steps = numpy.clip(steps, 1, _maximumCurveSteps).astype(numpy.intp)
+    curveIndexes = numpy.repeat(numpy.arange(len(curves)), steps)
+    ends = numpy.cumsum(steps)
+    stepCounts = steps[curveIndexes]
+    t = (numpy.arange(ends[-1]) - (ends - steps)[curveIndexes] + 1) / stepCounts
+    t = t[:, None]
+    mt = 1 - t
+    polylines = (
+        mt * mt * mt * p0[curveIndexes] +
+        3 * mt * mt * t * p1[curveIndexes] +
+        3 * mt * t * t * p2[curveIndexes] +
+        t * t * t * p3[curveIndexes]
+    )
+    return numpy.split(polylines, ends[:-1])
+
+
+def _deviceTolerance(transform):
+    # the user space flattening tolerance for rendering
+    # through transform, rounded down to a power of two so
+    # that nearby scales share a memoized flattening
+    a, b, c, d, tx, ty = transform
+    scale = math.sqrt(max(a * a + b * b, c * c + d * d))
+    if not scale:
+        return _flatteningTolerance
+    return 2.0 ** math.floor(math.log2(_flatteningTolerance / scale))
+
+
+def _cubicExtrema(p0, p1, p2, p3):
+    # the end points and any local extrema
+    # of a single cubic bezier coordinate
+    values = [p3]
+    a = 3 * (-p0 + 3 * p1 - 3 * p2 + p3)
+    b = 6 * (p0 - 2 * p1 + p2)
+    c = 3 * (p1 - p0)
+    if abs(a) < 1e-12:
+        if abs(b) < 1e-12:
+            roots = []
+        else:
+            roots = [-c / b]
+    else:
+        discriminant = b * b - 4 * a * c
+        if discriminant < 0:
+            roots = []
+        else:
+            discriminant = math.sqrt(discriminant)
+            roots = [(-b + discriminant) / (2 * a), (-b - discriminant) / (2 * a)]
+    for t in roots:
+        if 0 < t < 1:
+            mt = 1 - t
+            values.append(mt * mt * mt * p0 + 3 * mt * mt * t * p1 + 3 * mt * t * t * p2 + t * t * t * p3)
+    return values
+
+
+# ------------------
+# Boolean Operations
+# ------------------
+#
+# Both paths are flattened and their edges are split
+# wherever they cross or touch, so that edges only meet
+# at their end points. A sweep from left to right then
+# gets the winding numbers of both paths just above each
+# edge from the edge right below it. Edges with the result
+# inside on one side only are linked into new contours,
+# with the inside on their left. Fills use the nonzero
+# rule and the result only has straight segments.
+
+# curves are flattened finer than for hit-testing
+# because the polylines end up in the result
+_booleanFlatteningTolerance = 0.05
+
+# points are rounded to this many decimals, so
+# that split edges meet at exactly the same point
+_booleanDecimals = 7
+
+# split parameters this close to an end point
+# are the end point
+_booleanEpsilon = 1e-9
+
+# the most candidate edge pairs tested at once
+_booleanPairChunk = 1 << 18
+
+
+def _booleanUnion(a, b):
+    return a or b
+
+
+def _booleanDifference(a, b):
+    return a and not b
+
+
+def _booleanIntersection(a, b):
+    return a and b
+
+
+def _booleanXor(a, b):
+    return a != b
+
+
+def _booleanEdges(path):
+    # (n, 4) x0, y0, x1, y1 rows of the closed contours
+    contours = [points for points, closed in path._flattenedContours(_booleanFlatteningTolerance) if len(points) > 2]
+    if not contours:
+        return numpy.zeros((0, 4))
+    starts = numpy.concatenate(contours)
+    ends = numpy.concatenate([numpy.roll(points, -1, axis=0) for points in contours])
+    edges = numpy.round(numpy.column_stack((starts, ends)), _booleanDecimals)
+    return edges[(edges[:, 0] != edges[:, 2]) | (edges[:, 1] != edges[:, 3])]
+
+
+def _candidatePairs(edges):
+    # sweep and prune along x: every edge is paired with
+    # the edges that start before it ends, then pairs that
+    # don't overlap along y are dropped
+    x0, y0, x1, y1 = edges.T
+    xMin = numpy.minimum(x0, x1)
+    xMax = numpy.maximum(x0, x1)
+    yMin = numpy.minimum(y0, y1)
+    yMax = numpy.maximum(y0, y1)
+    order = numpy.argsort(xMin, kind="stable")
+    ends = numpy.searchsorted(xMin[order], xMax[order], side="right")
+    counts = ends - numpy.arange(1, len(order) + 1)
+    start = 0
+    while start < len(order):
+        # whole edges per chunk, at least one
+        totals = numpy.cumsum(counts[start:])
+        stop = start + max(1, int(numpy.searchsorted(totals, _booleanPairChunk, side="right")))
+        chunkCounts = counts[start:stop]
+        total = int(chunkCounts.sum())
+        if total:
+            firsts = numpy.repeat(numpy.arange(start, stop), chunkCounts)
+            offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(chunkCounts) - chunkCounts, chunkCounts)
+            seconds = order[firsts + 1 + offsets]
+            firsts = order[firsts]
+            overlap = (yMin[firsts] <= yMax[seconds]) & (yMin[seconds] <= yMax[firsts])
+            yield firsts[overlap], seconds[overlap]
+        start = stop
+
+
+def _edgeSplits(edges):
+    # (edge indexes, parameters, points) of the points where
+    # edges have to be split because another edge crosses or
+    # touches them there
+    splitEdges = []
+    splitParameters = []
+    splitPoints = []
+    epsilon = _booleanEpsilon
+    for first, second in _candidatePairs(edges):
+        p = edges[first, :2]
+        r = edges[first, 2:] - p
+        q = edges[second, :2]
+        s = edges[second, 2:] - q
+        qp = q - p
+        denominator = r[:, 0] * s[:, 1] - r[:, 1] * s[:, 0]
+        qpCrossR = qp[:, 0] * r[:, 1] - qp[:, 1] * r[:, 0]
+        qpCrossS = qp[:, 0] * s[:, 1] - qp[:, 1] * s[:, 0]
+        scale = numpy.hypot(r[:, 0], r[:, 1]) * numpy.hypot(s[:, 0], s[:, 1])
+        parallel = numpy.abs(denominator) <= epsilon * scale
+        # crossing edges
+        crossing = ~parallel
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            t = qpCrossS / denominator
+            u = qpCrossR / denominator
+        crossing &= (t >= -epsilon) & (t <= 1 + epsilon) & (u >= -epsilon) & (u <= 1 + epsilon)
+        t = t[crossing]
+        u = u[crossing]
+        # prefer existing end points over computed points
+        points = p[crossing] + t[:, None] * r[crossing]
+        for parameter, values in ((u, q[crossing]), (u - 1, q[crossing] + s[crossing]), (t, p[crossing]), (t - 1, p[crossing] + r[crossing])):
+            atEnd = numpy.abs(parameter) <= epsilon
+            points[atEnd] = values[atEnd]
+        for edgeIndexes, parameters in ((first[crossing], t), (second[crossing], u)):
+            inside = (parameters > epsilon) & (parameters < 1 - epsilon)
+            splitEdges.append(edgeIndexes[inside])
+            splitParameters.append(parameters[inside])
+            splitPoints.append(points[inside])
+        # overlapping collinear edges split each other
+        # at their end points
+        collinear = parallel & (numpy.abs(qpCrossR) <= epsilon * numpy.hypot(r[:, 0], r[:, 1]) * numpy.maximum(numpy.hypot(qp[:, 0], qp[:, 1]), 1))
+        for target, direction, origin, others in (
+                (first, r, p, (q, q + s)),
+                (second, s, q, (p, p + r))
+            ):
+            lengths = (direction[:, 0] ** 2 + direction[:, 1] ** 2)[collinear]
+            for point in others:
+                point = point[collinear]
+                delta = point - origin[collinear]
+                parameters = (delta[:, 0] * direction[collinear][:, 0] + delta[:, 1] * direction[collinear][:, 1]) / lengths
+                inside = (parameters > epsilon) & (parameters < 1 - epsilon)
+                splitEdges.append(target[collinear][inside])
+                splitParameters.append(parameters[inside])
+                splitPoints.append(point[inside])
+    if not splitEdges:
+        return numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0), numpy.zeros((0, 2))
+    return numpy.concatenate(splitEdges), numpy.concatenate(splitParameters), numpy.concatenate(splitPoints)
+
+
+def _splitEdges(edges):
+    # the edges split at every crossing, as (n, 4) rows,
+    # and the index of the edge each piece came from
+    count = len(edges)
+    splitEdges, splitParameters, splitPoints = _edgeSplits(edges)
+    indexes = numpy.concatenate((numpy.arange(count), numpy.arange(count), splitEdges))
+    parameters = numpy.concatenate((numpy.zeros(count), numpy.ones(count), splitParameters))
+    points = numpy.round(numpy.concatenate((edges[:, :2], edges[:, 2:], splitPoints)), _booleanDecimals)
+    order = numpy.lexsort((parameters, indexes))
+    indexes = indexes[order]
+    points = points[order]
+    following = indexes[:-1] == indexes[1:]
+    pieces = numpy.column_stack((points[:-1][following], points[1:][following]))
+    sources = indexes[:-1][following]
+    keep = (pieces[:, 0] != pieces[:, 2]) | (pieces[:, 1] != pieces[:, 3])
+    return pieces[keep], sources[keep]
+
+
+# the segments crossing the sweep line are kept bottom to top
+# in blocks of up to twice this many, so inserting and removing
+# a segment moves a block, not all of them
+_sweepBlockSize = 256
+
+
+def _sweepPointBelow(segment, x, y, endX, endY):
+    # True when the segment from (x, y) to (endX, endY)
+    # starts below segment, or on it and goes below it
+    x0, y0, x1, y1 = segment
+    side = (x1 - x0) * (y - y0) - (y1 - y0) * (x - x0)
+    if side == 0:
+        side = (x1 - x0) * (endY - y0) - (y1 - y0) * (endX - x0)
+    return side < 0
+
+
+def _sweepWindings(segments, weights):
+    # the winding numbers just above every segment. segments
+    # are (n, 4) rows from their left to their right end
+    # point, weights are the (n, 2) winding changes of both
+    # paths when going up across each segment. with k segments
+    # crossing the sweep line at most, this is
+    # O(n (log k + sqrt k)) rather than the O(n k) of a
+    # single list.
+    count = len(segments)
+    above = numpy.zeros((count, 2), dtype=numpy.intp)
+    if not count:
+        return above
+    coordinates = segments.tolist()
+    lx, ly, rx, ry = segments.T
+    # segments that start at the same point are
+    # inserted from the bottom up
+    insertions = numpy.lexsort((numpy.arctan2(ry - ly, rx - lx), ly, lx)).tolist()
+    removals = numpy.lexsort((ry, rx)).tolist()
+    removalPoints = [(coordinates[index][2], coordinates[index][3]) for index in removals]
+    weightList = weights.tolist()
+    aboveList = [None] * count
+    pointBelow = _sweepPointBelow
+    blocks = []
+    blockOf = {}
+    removalIndex = 0
+    for index in insertions:
+        x, y, endX, endY = coordinates[index]
+        point = (x, y)
+        while removalIndex < count and removalPoints[removalIndex] <= point:
+            removed = removals[removalIndex]
+            block = blockOf.pop(removed)
+            block.remove(removed)
+            if not block:
+                # the other blocks aren't empty, so
+                # only this one compares equal
+                blocks.remove(block)
+            removalIndex += 1
+        # the first block with a segment above the point,
+        # then the first of those segments in the block
+        low = 0
+        high = len(blocks)
+        while low < high:
+            middle = (low + high) // 2
+            if pointBelow(coordinates[blocks[middle][-1]], x, y, endX, endY):
+                high = middle
+            else:
+                low = middle + 1
+        if not blocks:
+            block = []
+            blocks.append(block)
+            blockIndex = position = 0
+        elif low == len(blocks):
+            blockIndex = low - 1
+            block = blocks[blockIndex]
+            position = len(block)
+        else:
+            blockIndex = low
+            block = blocks[blockIndex]
+            low = 0
+            high = len(block) - 1
+            while low < high:
+                middle = (low + high) // 2
+                if pointBelow(coordinates[block[middle]], x, y, endX, endY):
+                    high = middle
+                else:
+                    low = middle + 1
+            position = low
+        weightA, weightB = weightList[index]
+        if position:
+            below = block[position - 1]
+        elif blockIndex:
+            below = blocks[blockIndex - 1][-1]
+        else:
+            below = None
+        if below is None:
+            aboveList[index] = (weightA, weightB)
+        else:
+            belowA, belowB = aboveList[below]
+            aboveList[index] = (belowA + weightA, belowB + weightB)
+        block.insert(position, index)
+        blockOf[index] = block
+        if len(block) > 2 * _sweepBlockSize:
+            moved = block[_sweepBlockSize:]
+            del block[_sweepBlockSize:]
+            blocks.insert(blockIndex + 1, moved)
+            for segment in moved:
+                blockOf[segment] = moved
+    return numpy.array(aboveList, dtype=numpy.intp)
+
+
+def _booleanContours(edgeSets, operation):
+    # point lists of the contours of operation applied
+    # to the fills of one or two sets of edges
+    edges = numpy.concatenate(edgeSets)
+    if not len(edges):
+        return []
+    owners = numpy.repeat(numpy.arange(len(edgeSets)), [len(edgeSet) for edgeSet in edgeSets])
+    pieces, sources = _splitEdges(edges)
+    # every piece from its left to its right end point. going
+    # up across a piece that goes right adds one winding.
+    reverse = (pieces[:, 2] < pieces[:, 0]) | ((pieces[:, 2] == pieces[:, 0]) & (pieces[:, 3] < pieces[:, 1]))
+    pieces[reverse] = pieces[reverse][:, [2, 3, 0, 1]]
+    pieceWeights = numpy.zeros((len(pieces), 2), dtype=numpy.intp)
+    pieceWeights[numpy.arange(len(pieces)), owners[sources]] = numpy.where(reverse, -1, 1)
+    # pieces on top of each other become one segment
+    segments, inverse = numpy.unique(pieces, axis=0, return_inverse=True)
+    weights = numpy.zeros((len(segments), 2), dtype=numpy.intp)
+    numpy.add.at(weights, inverse.reshape(-1), pieceWeights)
+    used = weights.any(axis=1)
+    segments = segments[used]
+    weights = weights[used]
+    above = _sweepWindings(segments, weights)
+    below = above - weights
+    insideAbove = [operation(a != 0, b != 0) for a, b in above.tolist()]
+    insideBelow = [operation(a != 0, b != 0) for a, b in below.tolist()]
+    # link the boundary segments, with the inside on their left
+    outgoing = collections.defaultdict(list)
+    for (x0, y0, x1, y1), inAbove, inBelow in zip(segments.tolist(), insideAbove, insideBelow):
+        if inAbove == inBelow:
+            continue
+        if inAbove:
+            outgoing[(x0, y0)].append((x1, y1))
+        else:
+            outgoing[(x1, y1)].append((x0, y0))
+    contours = []
+    for start in list(outgoing):
+        while outgoing[start]:
+            contour = [start]
+            point = outgoing[start].pop()
+            while point != start:
+                contour.append(point)
+                targets = outgoing.get(point)
+                if not targets:
+                    break
+                point = targets.pop()
+            contour = _removeCollinearPoints(contour)
+            if len(contour) > 2:
+                contours.append(contour)
+    return contours
+
+
+def _removeCollinearPoints(points):
+    result = []
+    count = len(points)
+    for index in range(count):
+        x0, y0 = points[index - 1]
+        x1, y1 = points[index]
+        x2, y2 = points[(index + 1) % count]
+        if (x1 - x0) * (y2 - y1) - (y1 - y0) * (x2 - x1) != 0 or (x1 - x0) * (x2 - x1) + (y1 - y0) * (y2 - y1) < 0:
+            result.append((x1, y1))
+    return result
+
+
+# -----------------
+# Primitive Batches
+# -----------------
+#
+# rects(), ovals(), lines() and points() record all of
+# their items in a single PrimitiveBatch. The items are
+# rows of an (n, 4) array: x, y, w, h for boxes and
+# x1, y1, x2, y2 for lines. Colors are an optional
+# (n, 4) array of RGBA values.
+
+def _packBatchCoordinates(items):
+    return numpy.array(items, dtype=float).reshape(-1, 4)
+
+
+def _normalizeBatchColors(colors):
+    colors = numpy.array(colors, dtype=float)
+    if colors.ndim == 1:
+        colors = colors[:, None]
+    count, channels = colors.shape
+    normalized = numpy.ones((count, 4))
+    if channels == 1:
+        normalized[:, :3] = colors
+    elif channels == 2:
+        normalized[:, :3] = colors[:, :1]
+        normalized[:, 3] = colors[:, 1]
+    elif channels in (3, 4):
+        normalized[:, :channels] = colors
+    else:
+        raise DrawBotError("colors must have 1, 2, 3 or 4 values")
+    return normalized
+
+
+_batchSegmentTypes = dict(
+    rect=(_segmentMoveTo, _segmentLineTo, _segmentLineTo, _segmentLineTo, _segmentClosePath),
+    oval=(_segmentMoveTo, _segmentCurveTo, _segmentCurveTo, _segmentCurveTo, _segmentCurveTo, _segmentClosePath),
+    line=(_segmentMoveTo, _segmentLineTo)
+)
+
+
+class PrimitiveBatch(object):
+
+    def __init__(self, kind, coordinates, colors=None):
+        self.kind = kind
+        self.coordinates = coordinates
+        self.colors = colors
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def _updateHash(self, digest):
+        digest.update(self.kind.encode("utf-8"))
+        digest.update(numpy.ascontiguousarray(self.coordinates).tobytes())
+        if self.colors is not None:
+            digest.update(numpy.ascontiguousarray(self.colors).tobytes())
+
+    def path(self, indexes=None):
+        # all of the items, or the items at indexes, as one path
+        coordinates = self.coordinates
+        if indexes is not None:
+            coordinates = coordinates[indexes]
+        x, y, w, h = coordinates.T
+        if self.kind == "rect":
+            points = (x, y, x + w, y, x + w, y + h, x, y + h)
+        elif self.kind == "oval":
+            rx = w / 2
+            ry = h / 2
+            cx = x + rx
+            cy = y + ry
+            ox = rx * _ovalKappa
+            oy = ry * _ovalKappa
+            points = (
+                cx + rx, cy,
+                cx + rx, cy + oy, cx + ox, cy + ry, cx, cy + ry,
+                cx - ox, cy + ry, cx - rx, cy + oy, cx - rx, cy,
+                cx - rx, cy - oy, cx - ox, cy - ry, cx, cy - ry,
+                cx + ox, cy - ry, cx + rx, cy - oy, cx + rx, cy
+            )
+        else:
+            points = (x, y, w, h)
+        path = BezierPath()
+        path._segmentTypes = array.array("B", _batchSegmentTypes[self.kind] * len(coordinates))
+        path._points.frombytes(numpy.column_stack(points).astype(numpy.float64).tobytes())
+        return path
+
+    def colorGroups(self):
+        # (color, indexes) for every distinct color, in
+        # the order the colors first appear in the batch
+        colors, firstIndexes, inverse = numpy.unique(self.colors, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for group in numpy.argsort(firstIndexes):
+            yield tuple(colors[group]), numpy.flatnonzero(inverse == group)
+
+
+# ----------
+# Path Index
+# ----------
+#
+# A uniform grid over the bounds of many paths. Queries
+# only test the paths in the cells they touch, first by
+# their bounds and then exactly. Paths that would cover
+# too many cells are kept in a list that every query
+# checks instead.
+
+_maximumIndexCells = 64
+
+
+def _edgesCrossBox(edges, xMin, yMin, xMax, yMax):
+    # True when any of the edges crosses or
+    # touches the box, by Liang-Barsky clipping
+    x0, y0, x1, y1 = edges
+    dx = x1 - x0
+    dy = y1 - y0
+    low = numpy.zeros(len(x0))
+    high = numpy.ones(len(x0))
+    inside = numpy.ones(len(x0), dtype=bool)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        for delta, distance in ((-dx, x0 - xMin), (dx, xMax - x0), (-dy, y0 - yMin), (dy, yMax - y0)):
+            parallel = delta == 0
+            inside &= ~(parallel & (distance < 0))
+            ratio = distance / delta
+            entering = delta < 0
+            low = numpy.where(~parallel & entering, numpy.maximum(low, ratio), low)
+            high = numpy.where(~parallel & ~entering, numpy.minimum(high, ratio), high)
+    return bool((inside & (low <= high)).any())
+
+
+class PathIndex(object):
+
+    def __init__(self, paths=(), cellSize=50):
+        self.cellSize = cellSize
+        self._cells = collections.defaultdict(dict)
+        self._oversized = {}
+        self._entries = {}
+        self._order = itertools.count()
+        for path in paths:
+            self.insert(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return id(path) in self._entries
+
+    def __iter__(self):
+        entries = sorted(self._entries.values(), key=lambda entry: entry[1])
+        return iter([entry[0] for entry in entries])
+
+    def _cellRange(self, xMin, yMin, xMax, yMax):
+        cellSize = self.cellSize
+        return (
+            int(math.floor(xMin / cellSize)), int(math.floor(yMin / cellSize)),
+            int(math.floor(xMax / cellSize)), int(math.floor(yMax / cellSize))
+        )
+
+    def _cellKeys(self, cellRange):
+        left, bottom, right, top = cellRange
+        return itertools.product(range(left, right + 1), range(bottom, top + 1))
+
+    def insert(self, path):
+        # a path that is changed after it was inserted
+        # has to be removed and inserted again
+        key = id(path)
+        if key in self._entries:
+            self.remove(path)
+        bounds = path._controlBounds()
+        entry = (path, next(self._order), bounds)
+        if bounds is None:
+            cellRange = None
+        else:
+            cellRange = self._cellRange(*bounds)
+            left, bottom, right, top = cellRange
+            if (right - left + 1) * (top - bottom + 1) > _maximumIndexCells:
+                cellRange = None
+                self._oversized[key] = entry
+            else:
+                for cellKey in self._cellKeys(cellRange):
+                    self._cells[cellKey][key] = entry
+        self._entries[key] = entry + (cellRange,)
+
+    def remove(self, path):
+        key = id(path)
+        if key not in self._entries:
+            raise KeyError("path is not in the index")
+        path, order, bounds, cellRange = self._entries.pop(key)
+        self._oversized.pop(key, None)
+        if cellRange is not None:
+            for cellKey in self._cellKeys(cellRange):
+                cell = self._cells[cellKey]
+                del cell[key]
+                if not cell:
+                    del self._cells[cellKey]
+
+    def _candidates(self, xMin, yMin, xMax, yMax):
+        # the entries whose bounds overlap the box
+        candidates = dict(self._oversized)
+        cells = self._cells
+        cellRange = self._cellRange(xMin, yMin, xMax, yMax)
+        left, bottom, right, top = cellRange
+        if (right - left + 1) * (top - bottom + 1) > len(cells):
+            for cellKey, cell in cells.items():
+                if left <= cellKey[0] <= right and bottom <= cellKey[1] <= top:
+                    candidates.update(cell)
+        else:
+            for cellKey in self._cellKeys(cellRange):
+                cell = cells.get(cellKey)
+                if cell:
+                    candidates.update(cell)
+        found = [
+            entry for entry in candidates.values()
+            if entry[2] is not None and entry[2][0] <= xMax and entry[2][2] >= xMin and entry[2][1] <= yMax and entry[2][3] >= yMin
+        ]
+        found.sort(key=lambda entry: entry[1])
+        return found
+
+    def pathsAt(self, point, evenOdd=False):
+        # the paths that contain point, in the order
+        # they were inserted, so the topmost path of a
+        # drawing is last
+        x, y = point
+        return [
+            path for path, order, bounds in self._candidates(x, y, x, y)
+            if path.pointInside(point, evenOdd)
+        ]
+
+    def pathsInRect(self, box, contained=False):
+        # the paths that overlap the (x, y, w, h) box, or
+        # with contained the paths that are inside of it
+        x, y, w, h = box
+        xMin, xMax = min(x, x + w), max(x, x + w)
+        yMin, yMax = min(y, y + h), max(y, y + h)
+        found = []
+        for path, order, bounds in self._candidates(xMin, yMin, xMax, yMax):
+            if bounds[0] >= xMin and bounds[1] >= yMin and bounds[2] <= xMax and bounds[3] <= yMax:
+                found.append(path)
+                continue
+            pathX, pathY, pathWidth, pathHeight = path.bounds()
+            if contained:
+                if pathX >= xMin and pathY >= yMin and pathX + pathWidth <= xMax and pathY + pathHeight <= yMax:
+                    found.append(path)
+            elif _edgesCrossBox(path._windingEdges(), xMin, yMin, xMax, yMax) or path.pointInside((xMin, yMin)):
+                found.append(path)
+        return found
 
 
 # -------
-# Context
+# Culling
 # -------
+#
+# Contexts skip paths and batch items that can't touch
+# the canvas. Their bounds are widened by the farthest a
+# stroke can reach past them, transformed to device space
+# and widened by another pixel for antialiasing.
+
+_cullingMargin = 1
+
+
+def _strokeOutset(state):
+    if state.strokeColor is None or not state.strokeWidth:
+        return 0
+    outset = abs(state.strokeWidth) / 2
+    if state.lineJoin == "miter":
+        return outset * max(state.miterLimit, math.sqrt(2))
+    if state.lineCap == "square":
+        return outset * math.sqrt(2)
+    return outset
+
+
+def _touchesCanvas(xMin, yMin, xMax, yMax, transform, width, height):
+    # works on numbers and on NumPy arrays of bounds
+    a, b, c, d, tx, ty = transform
+    centerX = (xMin + xMax) / 2
+    centerY = (yMin + yMax) / 2
+    halfWidth = (xMax - xMin) / 2
+    halfHeight = (yMax - yMin) / 2
+    deviceX = a * centerX + c * centerY + tx
+    deviceY = b * centerX + d * centerY + ty
+    extentX = abs(a) * halfWidth + abs(c) * halfHeight + _cullingMargin
+    extentY = abs(b) * halfWidth + abs(d) * halfHeight + _cullingMargin
+    return (
+        (deviceX + extentX > 0) & (deviceX - extentX < width) &
+        (deviceY + extentY > 0) & (deviceY - extentY < height)
+    )
+
+
+def _boxBounds(x, y, w, h):
+    # (xMin, yMin, xMax, yMax) of an (x, y, w, h)
+    # box with a width or height that may be negative
+    return min(x, x + w), min(y, y + h), max(x, x + w), max(y, y + h)
+
+
+def _batchItemBounds(batch):
+    # (xMin, yMin, xMax, yMax) arrays with an entry per item
+    coordinates = batch.coordinates
+    if batch.kind == "line":
+        x1, y1, x2, y2 = coordinates.T
+    else:
+        x1, y1, w, h = coordinates.T
+        x2 = x1 + w
+        y2 = y1 + h
+    return numpy.minimum(x1, x2), numpy.minimum(y1, y2), numpy.maximum(x1, x2), numpy.maximum(y1, y2)
 
-lineJoinStyles = dict(
-    miter=kCGLineJoinMiter,
-    round=kCGLineJoinRound,
-    bevel=kCGLineJoinBevel
+
+# -----------
+# Text Layout
+# -----------
+#
+# Lines are broken at spaces, or between characters for
+# words that don't fit on a line of their own, and at
+# every newline. Widths are the sums of glyph advances
+# without kerning. Advances are measured with UIKit when
+# it is available and come from the Helvetica metrics
+# everywhere else. Advances, word widths and whole
+# layouts are memoized.
+
+_lineHeightFactor = 1.2
+
+_textAlignments = ("left", "center", "right")
+
+# the advances of the printable ASCII characters in
+# Helvetica, per 1000 units of font size
+_helveticaWidths = dict(zip(map(chr, range(32, 127)), (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584
+)))
+_helveticaDefaultWidth = 556
+
+# fonts are measured at this size and scaled
+_measuringFontSize = 100
+
+
+def _textAlignment(align):
+    if align is None:
+        return 0
+    if align not in _textAlignments:
+        raise DrawBotError("align must be one of %s" % ", ".join(repr(alignment) for alignment in _textAlignments))
+    return _textAlignments.index(align)
+
+
+def _helveticaUnitWidth(fontName, text):
+    return sum(_helveticaWidths.get(char, _helveticaDefaultWidth) for char in text) / 1000
+
+
+def _uikitUnitWidth(fontName, text):
+    font = _uikitFont(fontName, _measuringFontSize)
+    string = NSAttributedString.alloc().initWithString_attributes_(text, {NSFontAttributeName: font})
+    return string.size().width / _measuringFontSize
+
+
+def _defaultTextMeasure():
+    if _defaultBackend() == "uikit":
+        _loadBridge()
+        return _uikitUnitWidth
+    return _helveticaUnitWidth
+
+
+class _BoundedCache(object):
+
+    # a dictionary that forgets its least
+    # recently used items beyond maxSize
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        items = self._items
+        value = items.get(key)
+        if value is not None:
+            items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        items = self._items
+        items[key] = value
+        items.move_to_end(key)
+        if len(items) > self.maxSize:
+            items.popitem(last=False)
+
+
+# the words and the runs of white space between them
+_wordPattern = re.compile(r"\s+|\S+")
+
+
+class _TextLayout(object):
+
+    def __init__(self, measure=None, layoutCacheSize=512, wordCacheSize=4096):
+        self._measure = measure
+        self._advances = {}
+        self._wordWidths = _BoundedCache(wordCacheSize)
+        self._layouts = _BoundedCache(layoutCacheSize)
+        self.hits = 0
+        self.misses = 0
+
+    def _unitWidth(self, fontName, text):
+        # the width of text at a font size of 1
+        key = (fontName, text)
+        width = self._wordWidths.get(key)
+        if width is None:
+            if self._measure is None:
+                self._measure = _defaultTextMeasure()
+            advances = self._advances.get(fontName)
+            if advances is None:
+                advances = self._advances[fontName] = {}
+            width = 0
+            for char in text:
+                advance = advances.get(char)
+                if advance is None:
+                    advance = advances[char] = self._measure(fontName, char)
+                width += advance
+            self._wordWidths.set(key, width)
+        return width
+
+    def lines(self, txt, fontName, fontSize, width=None):
+        # (start, end, width) for every line, where
+        # txt[start:end] is the text that is drawn
+        key = (txt, fontName, fontSize, width)
+        lines = self._layouts.get(key)
+        if lines is None:
+            self.misses += 1
+            lines = self._breakLines(txt, fontName, fontSize, width)
+            self._layouts.set(key, lines)
+        else:
+            self.hits += 1
+        return lines
+
+    def fit(self, txt, fontName, fontSize, width, height):
+        # the lines that fit in a box and the
+        # text that is left over
+        lines = self.lines(txt, fontName, fontSize, width)
+        lineHeight = fontSize * _lineHeightFactor
+        if lineHeight:
+            count = int(abs(height) / lineHeight + 1e-9)
+        else:
+            count = len(lines)
+        if count >= len(lines):
+            return lines, ""
+        return lines[:count], txt[lines[count][0]:]
+
+    def _breakLines(self, txt, fontName, fontSize, width):
+        lines = []
+        limit = None
+        if width is not None and fontSize:
+            limit = abs(width) / fontSize
+        unitWidth = self._unitWidth
+        paragraphStart = 0
+        for paragraph in txt.split("\n"):
+            lineStart = lineEnd = paragraphStart
+            lineWidth = 0
+            spaceWidth = 0
+            for match in _wordPattern.finditer(paragraph):
+                word = match.group()
+                wordStart = paragraphStart + match.start()
+                if word[0].isspace():
+                    if lineEnd > lineStart or lineStart == paragraphStart:
+                        spaceWidth += unitWidth(fontName, word)
+                    continue
+                wordWidth = unitWidth(fontName, word)
+                if limit is not None and lineEnd > lineStart and lineWidth + spaceWidth + wordWidth > limit:
+                    lines.append((lineStart, lineEnd, lineWidth * fontSize))
+                    lineStart = lineEnd = wordStart
+                    lineWidth = spaceWidth = 0
+                if limit is not None and lineEnd == lineStart and spaceWidth + wordWidth > limit:
+                    # a word that is too long for any line
+                    # is broken between characters
+                    for index, char in enumerate(word):
+                        charWidth = unitWidth(fontName, char)
+                        if lineEnd > lineStart and lineWidth + spaceWidth + charWidth > limit:
+                            lines.append((lineStart, lineEnd, lineWidth * fontSize))
+                            lineStart = lineEnd = wordStart + index
+                            lineWidth = spaceWidth = 0
+                        lineWidth += spaceWidth + charWidth
+                        spaceWidth = 0
+                        lineEnd = wordStart + index + 1
+                    continue
+                lineWidth += spaceWidth + wordWidth
+                spaceWidth = 0
+                lineEnd = wordStart + len(word)
+            lines.append((lineStart, lineEnd, lineWidth * fontSize))
+            paragraphStart += len(paragraph) + 1
+        return tuple(lines)
+
+
+_textLayout = _TextLayout()
+
+# UIKit objects for drawing text, shared by all contexts
+_fontCache = _BoundedCache(64)
+_textAttributeCache = _BoundedCache(256)
+_attributedStringCache = _BoundedCache(1024)
+
+
+def _uikitFont(fontName, fontSize):
+    key = (fontName, fontSize)
+    font = _fontCache.get(key)
+    if font is None:
+        if fontName is not None:
+            font = NSFont.fontWithName_size_(fontName, fontSize)
+        if font is None:
+            font = NSFont.systemFontOfSize_(fontSize)
+        _fontCache.set(key, font)
+    return font
+
+
+def _textAttributes(fontName, fontSize, color):
+    key = (fontName, fontSize, color)
+    attributes = _textAttributeCache.get(key)
+    if attributes is None:
+        attributes = {
+            NSFontAttributeName : _uikitFont(fontName, fontSize),
+            NSForegroundColorAttributeName : NSColor.colorWithCalibratedRed_green_blue_alpha_(*color)
+        }
+        _textAttributeCache.set(key, attributes)
+    return attributes
+
+
+def _attributedString(txt, fontName, fontSize, color):
+    key = (txt, fontName, fontSize, color)
+    string = _attributedStringCache.get(key)
+    if string is None:
+        string = NSAttributedString.alloc().initWithString_attributes_(txt, _textAttributes(fontName, fontSize, color))
+        _attributedStringCache.set(key, string)
+    return string
+
+
+# -------
+# Context
+# -------
+
+lineJoinStyles = dict(
+    miter=kCGLineJoinMiter,
+    round=kCGLineJoinRound,
+    bevel=kCGLineJoinBevel
 )
 lineCapStyles = dict(
     butt=kCGLineCapButt,
@@ -549,15 +2957,98 @@ lineCapStyles = dict(
     square=kCGLineCapSquare
 )
 
+# the most rect, oval and line paths a
+# context keeps for shapes drawn again
+_shapePathCacheSize = 4096
+
+
 class BaseContext(object):
 
+    profiler = None
+    culling = True
+
     def __init__(self, width, height):
+        self._width = width
+        self._height = height
+        self.culledCount = 0
+        self.drawnCount = 0
+        self._shapePaths = _BoundedCache(_shapePathCacheSize)
         self.reset()
 
     def reset(self):
         self.stateStack = []
         self.state = GraphicsState()
 
+    # State
+
+    def _writableState(self):
+        state = self.state
+        if state.shareCount:
+            state = self.state = state.copy()
+        return state
+
+    def _saveState(self):
+        state = self.state
+        state.shareCount += 1
+        self.stateStack.append(state)
+
+    def _restoreState(self):
+        if not self.stateStack:
+            raise DrawBotError("can't restore graphics state: no matching save()'")
+        state = self.state = self.stateStack.pop()
+        state.shareCount -= 1
+
+    def _concatTransform(self, transformMatrix):
+        # state.ctm maps the current user space to device
+        # space, with the origin at the top left
+        state = self._writableState()
+        state.ctm = _multiplyTransforms(transformMatrix, state.ctm)
+
+    # Culling
+
+    def _cullPath(self, path, state):
+        # True when path can't touch the canvas
+        return self._cullBounds(path._controlBounds(), state)
+
+    def _cullBounds(self, bounds, state):
+        # True when (xMin, yMin, xMax, yMax) user space
+        # bounds can't touch the canvas
+        if self._offCanvas(bounds, state):
+            self.culledCount += 1
+            return True
+        self.drawnCount += 1
+        return False
+
+    def _offCanvas(self, bounds, state):
+        # like _cullBounds, without counting
+        if not self.culling or bounds is None:
+            return False
+        outset = _strokeOutset(state)
+        xMin, yMin, xMax, yMax = bounds
+        return not _touchesCanvas(xMin - outset, yMin - outset, xMax + outset, yMax + outset, state.ctm, self._width, self._height)
+
+    def _cullBatch(self, batch):
+        # the batch without the items that can't touch
+        # the canvas, or None when nothing is left
+        count = len(batch)
+        if not self.culling or not count:
+            self.drawnCount += count
+            return batch if count else None
+        outset = _strokeOutset(self.state)
+        xMin, yMin, xMax, yMax = _batchItemBounds(batch)
+        visible = _touchesCanvas(xMin - outset, yMin - outset, xMax + outset, yMax + outset, self.state.ctm, self._width, self._height)
+        drawn = int(visible.sum())
+        self.drawnCount += drawn
+        self.culledCount += count - drawn
+        if not drawn:
+            return None
+        if drawn < count:
+            colors = batch.colors
+            if colors is not None:
+                colors = colors[visible]
+            batch = PrimitiveBatch(batch.kind, batch.coordinates[visible], colors)
+        return batch
+
     # ------------
     # Instructions
     # ------------
@@ -576,111 +3067,172 @@ class BaseContext(object):
 
     def fill(self, r, g=None, b=None, a=1):
         if r is None:
-            self.state.fillColor = None
+            self._writableState().fillColor = None
             return
-        self.state.fillColor = (r, g, b, a)
+        self._writableState().fillColor = (r, g, b, a)
 
     def stroke(self, r, g=None, b=None, a=1):
         if r is None:
-            self.state.strokeColor = None
+            self._writableState().strokeColor = None
             return
-        self.state.strokeColor = (r, g, b, a)
+        self._writableState().strokeColor = (r, g, b, a)
 
     # Paths
 
     def drawPath(self, path):
-        state = self.state
-        if path is not None:
-            state.path = path
-        if state.path:
-            path = state.path._path
-            path.setMiterLimit_(state.miterLimit)
-            path.setLineJoinStyle_(lineJoinStyles[state.lineJoin])
-            path.setLineCapStyle_(lineCapStyles[state.lineCap])
-            if state.lineDash is not None:
-                dash = state.lineDash
-                count = len(dash)
-                phase = 0
-                dash = (CGFloat * count)(*dash)
-                path.setLineDash_count_phase_(dash, count, phase)
-            if state.fillColor is not None:
-                fillColor = NSColor.colorWithCalibratedRed_green_blue_alpha_(*state.fillColor)
-                fillColor.set()
-                path.fill()
-            if state.strokeColor is not None:
-                strokeColor = NSColor.colorWithCalibratedRed_green_blue_alpha_(*state.strokeColor)
-                strokeColor.set()
-                if state.strokeWidth is not None:
-                    path.setLineWidth_(state.strokeWidth)
-                path.stroke()
+        # drawing doesn't change the graphics state, so it
+        # doesn't copy a state that is shared with a save
+        if path is None:
+            path = self.state.path
+        if path and not self._cullPath(path, self.state):
+            self._drawNativePath(path._nativePath(), self.state)
+
+    # Shapes
+    #
+    # rect, oval and line are replayed with their operands.
+    # by default they draw a path that is kept for shapes
+    # that are drawn again, and that isn't built for shapes
+    # that are culled. contexts that can draw them without
+    # a BezierPath override these.
+
+    def _shapePath(self, kind, a, b, c, d):
+        key = (kind, a, b, c, d)
+        path = self._shapePaths.get(key)
+        if path is None:
+            path = BezierPath()
+            if kind == "line":
+                path.line((a, b), (c, d))
+            else:
+                getattr(path, kind)(a, b, c, d)
+            self._shapePaths.set(key, path)
+        return path
+
+    def _drawShape(self, kind, a, b, c, d, bounds):
+        if self._offCanvas(bounds, self.state):
+            self.culledCount += 1
+            return
+        self.drawPath(self._shapePath(kind, a, b, c, d))
+
+    def rect(self, x, y, w, h):
+        self._drawShape("rect", x, y, w, h, _boxBounds(x, y, w, h))
+
+    def oval(self, x, y, w, h):
+        self._drawShape("oval", x, y, w, h, _boxBounds(x, y, w, h))
+
+    def line(self, x1, y1, x2, y2):
+        self._drawShape("line", x1, y1, x2, y2, (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)))
+
+    def _drawNativePath(self, path, state):
+        path.setMiterLimit_(state.miterLimit)
+        path.setLineJoinStyle_(lineJoinStyles[state.lineJoin])
+        path.setLineCapStyle_(lineCapStyles[state.lineCap])
+        # the native path is shared by every drawing
+        # of the path, so all settings are made again
+        if state.lineDash is not None:
+            dash = state.lineDash
+            count = len(dash)
+            phase = 0
+            dash = (CGFloat * count)(*dash)
+            path.setLineDash_count_phase_(dash, count, phase)
+        else:
+            path.setLineDash_count_phase_(None, 0, 0)
+        if state.fillColor is not None:
+            fillColor = NSColor.colorWithCalibratedRed_green_blue_alpha_(*state.fillColor)
+            fillColor.set()
+            path.fill()
+        if state.strokeColor is not None:
+            strokeColor = NSColor.colorWithCalibratedRed_green_blue_alpha_(*state.strokeColor)
+            strokeColor.set()
+            path.setLineWidth_(state.strokeWidth if state.strokeWidth is not None else 1)
+            path.stroke()
+
+    def drawBatch(self, batch):
+        # items that share a color are drawn as one path
+        batch = self._cullBatch(batch)
+        if batch is None:
+            return
+        if batch.colors is None:
+            self._drawNativePath(batch.path()._nativePath(), self.state)
+            return
+        if batch.kind == "line":
+            colorAttribute = "strokeColor"
+        else:
+            colorAttribute = "fillColor"
+        color = getattr(self.state, colorAttribute)
+        for groupColor, indexes in batch.colorGroups():
+            state = self._writableState()
+            setattr(state, colorAttribute, groupColor)
+            self._drawNativePath(batch.path(indexes)._nativePath(), state)
+        setattr(self._writableState(), colorAttribute, color)
 
     # Path Properties
 
     def strokeWidth(self, value):
-        self.state.strokeWidth = value
+        self._writableState().strokeWidth = value
 
     def miterLimit(self, value):
-        self.state.miterLimit = value
+        self._writableState().miterLimit = value
 
     def lineJoin(self, value):
-        self.state.lineJoin = value
+        self._writableState().lineJoin = value
 
     def lineCap(self, value):
-        self.state.lineCap = value
+        self._writableState().lineCap = value
 
     def lineDash(self, value):
-        if value[0] is None:
+        if value is not None and value[0] is None:
             value = None
-        self.state.lineDash = value
+        self._writableState().lineDash = value
 
     # Text
 
     def font(self, fontName, fontSize):
-        self.state.text_fontName = fontName
+        state = self._writableState()
+        state.text_fontName = fontName
         if fontSize is not None:
-            self.state.text_fontSize = fontSize
+            state.text_fontSize = fontSize
 
     def fontSize(self, fontSize):
-        self.state.text_fontSize = fontSize
+        self._writableState().text_fontSize = fontSize
 
-    def textBox(self, txt, box):
-        CGContextSaveGState(self._context)
+    def textBox(self, txt, box, align="left"):
         x, y, w, h = box
-        self.transform((1, 0, 0, 1, x, y + h))
-        self.transform((1, 0, 0, -1, 0, 0))
-        font = None
-        if self.state.text_fontName is not None:
-            font = NSFont.fontWithName_size_(
-                self.state.text_fontName,
-                self.state.text_fontSize
-            )
-        if font is None:
-            font = NSFont.systemFontOfSize_(self.state.text_fontSize)
-        r, g, b, a = self.state.fillColor
-        fillColor = NSColor.colorWithCalibratedRed_green_blue_alpha_(r, g, b, a)
-        attrs = {
-            NSFontAttributeName : font,
-            NSForegroundColorAttributeName : fillColor
-        }
-        string = NSAttributedString.alloc().initWithString_attributes_(txt, attrs)
-        string.drawInRect_(((0, 0), (w, h)))
+        if self.culling and not _touchesCanvas(min(x, x + w), min(y, y + h), max(x, x + w), max(y, y + h), self.state.ctm, self._width, self._height):
+            self.culledCount += 1
+            return
+        self.drawnCount += 1
+        state = self.state
+        if state.fillColor is None:
+            return
+        fontName = state.text_fontName
+        fontSize = state.text_fontSize
+        lines, overflow = _textLayout.fit(txt, fontName, fontSize, w, h)
+        lineHeight = fontSize * _lineHeightFactor
+        alignment = _textAlignments.index(align) / 2
+        CGContextSaveGState(self._context)
+        for transformMatrix in ((1, 0, 0, 1, x, y + h), (1, 0, 0, -1, 0, 0)):
+            CGContextConcatCTM(self._context, CGAffineTransform(*transformMatrix))
+        for index, (start, end, lineWidth) in enumerate(lines):
+            if start == end:
+                continue
+            string = _attributedString(txt[start:end], fontName, fontSize, state.fillColor)
+            string.drawAtPoint_(CGPoint((w - lineWidth) * alignment, index * lineHeight))
         CGContextRestoreGState(self._context)
 
     # States
 
     def save(self):
-        self.stateStack.append(self.state.copy())
+        self._saveState()
         CGContextSaveGState(self._context)
 
     def restore(self):
-        if not self.stateStack:
-            raise DrawBotError("can't restore graphics state: no matching save()'")
-        self.state = self.stateStack.pop()
+        self._restoreState()
         CGContextRestoreGState(self._context)
 
     # Transformations
 
     def transform(self, transformMatrix):
+        self._concatTransform(transformMatrix)
         transform = CGAffineTransform(*transformMatrix)
         CGContextConcatCTM(self._context, transform)
 
@@ -688,72 +3240,1703 @@ class BaseContext(object):
 class PNGContext(BaseContext):
 
     def __init__(self, width, height):
+        _loadBridge()
         super(PNGContext, self).__init__(width, height)
         self._newContext(width, height)
 
     def _newContext(self, width, height):
         self.reset()
+        self._width = width
+        self._height = height
         UIGraphicsBeginImageContext(CGSize(width, height))
         self._context = UIGraphicsGetCurrentContext()
         self.transform((1, 0, 0, -1, 0, height))
 
-    def _endContext(self):
+    def _endImage(self):
         image = UIGraphicsGetImageFromCurrentImageContext()
         UIGraphicsEndImageContext()
-        png = UIImagePNGRepresentation(image)
+        return image
+
+    def _endPixels(self):
+        image = ObjCInstance(self._endImage())
+        return _imagePixels(image.CGImage())
+
+    def _endContext(self):
+        png = UIImagePNGRepresentation(self._endImage())
         data = objc_util.nsdata_to_bytes(png)
         return data
 
+    # Pages
+
+    def newPage(self, width, height):
+        # every page is drawn into a new image, so the
+        # PNG holds the last page like the raster backend
+        UIGraphicsEndImageContext()
+        self._newContext(width, height)
+
+    # Shapes
+
+    def rect(self, x, y, w, h):
+        state = self.state
+        if not self._cullBounds(_boxBounds(x, y, w, h), state):
+            self._drawNativePath(UIBezierPath.bezierPathWithRect_(CGRect(CGPoint(x, y), CGSize(w, h))), state)
+
+    def oval(self, x, y, w, h):
+        state = self.state
+        if not self._cullBounds(_boxBounds(x, y, w, h), state):
+            self._drawNativePath(UIBezierPath.bezierPathWithOvalInRect_(CGRect(CGPoint(x, y), CGSize(w, h))), state)
+
+    def line(self, x1, y1, x2, y2):
+        state = self.state
+        if not self._cullBounds((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)), state):
+            path = UIBezierPath.bezierPath()
+            path.moveToPoint_(CGPoint(x1, y1))
+            path.addLineToPoint_(CGPoint(x2, y2))
+            self._drawNativePath(path, state)
+
     def imageData(self):
-        return self._endContext()
+        return _profiledEncode(self.profiler, self._endContext)
 
 
 class GIFContext(PNGContext):
 
+    # Frames are read straight out of the bitmap
+    # of each page and streamed into a GIFEncoder.
+
     def __init__(self, width, height, frameDuration):
         super(GIFContext, self).__init__(width, height)
-        self._frameDuration = frameDuration
-        self._writtenImages = []
+        self._file = io.BytesIO()
+        self._encoder = GIFEncoder(self._file, frameDuration)
         self._haveFirstFrame = False
 
     def _storeImage(self):
-        data = self._endContext()
-        pngFile = io.BytesIO(data)
-        png = PILImage.open(pngFile)
-        gifFile = io.BytesIO()
-        png.save(gifFile, "GIF")
-        data = gifFile.getvalue()
-        self._writtenImages.append(data)
+        _profiledEncode(self.profiler, self._encoder.addFrame, self._endPixels())
 
     def newPage(self, width, height):
         if self._haveFirstFrame:
             self._storeImage()
+        else:
+            UIGraphicsEndImageContext()
         self._newContext(width, height)
         self._haveFirstFrame = True
 
     def imageData(self):
         self._storeImage()
-        if not self._writtenImages:
-            return None
-        if len(self._writtenImages) == 1:
-            return self._writtenImages[0]
-        imageObjects = []
-        for data in self._writtenImages:
-            f = io.BytesIO(data)
-            image = PILImage.open(f)
-            imageObjects.append(image)
-        path = tempfile.mkstemp()[1]
-        duration = 0.1
-        data = None
-        try:
-            images2gif.writeGif(path, imageObjects, self._frameDuration)
-            f = open(path, "rb")
-            data = f.read()
-            f.close()
-        finally:
-            os.remove(path)
+        _profiledEncode(self.profiler, self._encoder.close)
+        return self._file.getvalue()
+
+
+def _frameView(pixels):
+    # a read only view of a frame, which may
+    # be shared with the render cache
+    pixels = pixels.view()
+    pixels.flags.writeable = False
+    return pixels
+
+
+def _imagePixels(cgImage):
+    # a (height, width, 4) premultiplied RGBA copy of a CGImage
+    width = CGImageGetWidth(cgImage)
+    height = CGImageGetHeight(cgImage)
+    bytesPerRow = CGImageGetBytesPerRow(cgImage)
+    bitmapInfo = CGImageGetBitmapInfo(cgImage)
+    data = CGDataProviderCopyData(CGImageGetDataProvider(cgImage))
+    try:
+        buffer = (ctypes.c_uint8 * CFDataGetLength(data)).from_address(CFDataGetBytePtr(data))
+        pixels = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        pixels = pixels[:bytesPerRow * height].reshape(height, bytesPerRow)[:, :width * 4].reshape(height, width, 4)
+        # reordering the channels copies the pixels
+        # out of the data, which is released next
+        return _normalizeBitmapPixels(pixels, bitmapInfo)
+    finally:
+        CFRelease(data)
+
+
+def _normalizeBitmapPixels(pixels, bitmapInfo):
+    # reorder the channels of a 32 bit bitmap to premultiplied
+    # RGBA, in a single copy that doesn't share memory with
+    # the bitmap
+    alphaInfo = bitmapInfo & kCGBitmapAlphaInfoMask
+    channels = [0, 1, 2, 3]
+    if bitmapInfo & kCGBitmapByteOrder32Little:
+        channels.reverse()
+    if alphaInfo in (kCGImageAlphaPremultipliedFirst, kCGImageAlphaFirst, kCGImageAlphaNoneSkipFirst):
+        channels = channels[1:] + channels[:1]
+    if channels == [0, 1, 2, 3]:
+        pixels = pixels.copy()
+    else:
+        pixels = numpy.take(pixels, channels, axis=2)
+    if alphaInfo in (kCGImageAlphaNoneSkipLast, kCGImageAlphaNoneSkipFirst):
+        pixels[..., 3] = 255
+    elif alphaInfo in (kCGImageAlphaLast, kCGImageAlphaFirst):
+        alpha = pixels[..., 3:4].astype(numpy.uint16)
+        pixels[..., :3] = (pixels[..., :3] * alpha + 127) // 255
+    return pixels
+
+
+# ------
+# Raster
+# ------
+#
+# An off-device backend that renders into a NumPy
+# buffer of premultiplied RGBA pixels. Fills are
+# rasterized by accumulating signed edge crossings
+# on a few sub-scanlines per pixel row and summing
+# them across each row, so a whole path is covered
+# in a handful of array operations.
+
+_rasterSubsamples = 4
+
+
+def _transformPointArray(points, transform):
+    a, b, c, d, tx, ty = transform
+    x = points[:, 0]
+    y = points[:, 1]
+    return numpy.column_stack((a * x + c * y + tx, b * x + d * y + ty))
+
+
+def _polygonEdges(polygons, transform, orient=False):
+    # polygons are (n, 2) arrays of user space points. the
+    # result is the device space x0, y0, x1, y1 and winding
+    # weight of every edge. when orient is True every polygon
+    # is made to wind in the same direction so that overlapping
+    # polygons form a union.
+    polygons = [polygon for polygon in polygons if len(polygon) > 1]
+    if not polygons:
+        return None
+    lengths = numpy.array([len(polygon) for polygon in polygons])
+    points = _transformPointArray(numpy.concatenate(polygons), transform)
+    firsts = numpy.cumsum(lengths) - lengths
+    following = numpy.arange(1, len(points) + 1)
+    following[firsts + lengths - 1] = firsts
+    x0 = points[:, 0]
+    y0 = points[:, 1]
+    x1 = x0[following]
+    y1 = y0[following]
+    if orient:
+        areas = numpy.add.reduceat(x0 * y1 - x1 * y0, firsts)
+        weights = numpy.repeat(numpy.where(areas < 0, -1.0, 1.0), lengths)
+    else:
+        weights = numpy.ones(len(points))
+    return x0, y0, x1, y1, weights
+
+
+def _polygonArrayEdges(polygons, transform, orient=False):
+    # like _polygonEdges for an (n, k, 2) array
+    # of n polygons that all have k points
+    count, pointCount = polygons.shape[:2]
+    points = _transformPointArray(polygons.reshape(-1, 2), transform).reshape(count, pointCount, 2)
+    following = numpy.roll(points, -1, axis=1)
+    x0 = points[..., 0]
+    y0 = points[..., 1]
+    x1 = following[..., 0]
+    y1 = following[..., 1]
+    if orient:
+        areas = (x0 * y1 - x1 * y0).sum(axis=1)
+        weights = numpy.repeat(numpy.where(areas < 0, -1.0, 1.0), pointCount)
+    else:
+        weights = numpy.ones(count * pointCount)
+    return x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel(), weights
+
+
+def _rasterizeEdges(edges, width, height, evenOdd=False):
+    # returns (coverage, top, left) where coverage is a
+    # float array for the region of the canvas touched
+    # by the edges, or None if nothing is touched.
+    x0, y0, x1, y1, weights = edges
+    vertical = y0 != y1
+    if not vertical.any():
+        return None
+    x0 = x0[vertical]
+    y0 = y0[vertical]
+    x1 = x1[vertical]
+    y1 = y1[vertical]
+    weights = weights[vertical]
+    yMin = numpy.minimum(y0, y1)
+    yMax = numpy.maximum(y0, y1)
+    top = max(int(math.floor(yMin.min())), 0)
+    bottom = min(int(math.ceil(yMax.max())), height)
+    left = max(int(math.floor(min(x0.min(), x1.min()))), 0)
+    right = min(int(math.ceil(max(x0.max(), x1.max()))), width)
+    if top >= bottom or left >= right:
+        return None
+    samples = _rasterSubsamples
+    rowCount = (bottom - top) * samples
+    columnCount = right - left
+    # the sub-scanline range that each edge crosses
+    firstRow = numpy.ceil((yMin - top) * samples - 0.5).astype(numpy.int64)
+    lastRow = numpy.ceil((yMax - top) * samples - 0.5).astype(numpy.int64)
+    numpy.clip(firstRow, 0, rowCount, out=firstRow)
+    numpy.clip(lastRow, 0, rowCount, out=lastRow)
+    counts = lastRow - firstRow
+    crossing = counts > 0
+    if not crossing.any():
+        return None
+    counts = counts[crossing]
+    edgeIndexes = numpy.repeat(numpy.flatnonzero(crossing), counts)
+    offsets = numpy.arange(len(edgeIndexes)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    rows = firstRow[edgeIndexes] + offsets
+    sampleY = top + (rows + 0.5) / samples
+    ex0 = x0[edgeIndexes]
+    ey0 = y0[edgeIndexes]
+    slope = (x1[edgeIndexes] - ex0) / (y1[edgeIndexes] - ey0)
+    x = ex0 + (sampleY - ey0) * slope - left
+    direction = numpy.where(y1[edgeIndexes] > ey0, 1.0, -1.0) * weights[edgeIndexes]
+    # crossings left of the region count from the first
+    # column, crossings right of it can't affect it
+    numpy.clip(x, 0, columnCount, out=x)
+    column = numpy.floor(x)
+    fraction = x - column
+    column = column.astype(numpy.int64)
+    stride = columnCount + 2
+    flat = rows * stride + column
+    accumulation = numpy.bincount(
+        numpy.concatenate((flat, flat + 1)),
+        weights=numpy.concatenate((direction * (1 - fraction), direction * fraction)),
+        minlength=rowCount * stride
+    ).astype(numpy.float32).reshape(rowCount, stride)
+    winding = numpy.cumsum(accumulation[:, :columnCount], axis=1, out=accumulation[:, :columnCount])
+    if evenOdd:
+        winding = numpy.abs(numpy.mod(winding + 1, 2) - 1)
+    else:
+        winding = numpy.minimum(numpy.abs(winding, out=winding), 1, out=winding)
+    coverage = winding.reshape(bottom - top, samples, columnCount).sum(axis=1)
+    coverage *= 1.0 / samples
+    return coverage, top, left
+
+
+def _rasterizeItems(edges, items, width, height):
+    # like _rasterizeEdges, but the edges belong to numbered
+    # items and the coverage of each item is kept apart.
+    # returns the canvas pixel index, item and coverage of
+    # every pixel that an item touches.
+    order = numpy.argsort(items, kind="stable")
+    x0, y0, x1, y1, weights = [values[order] for values in edges]
+    items = items[order]
+    itemIds, starts = numpy.unique(items, return_index=True)
+    edgeItems = numpy.repeat(numpy.arange(len(itemIds)), numpy.diff(numpy.append(starts, len(items))))
+    left = numpy.clip(numpy.floor(numpy.minimum.reduceat(numpy.minimum(x0, x1), starts)), 0, width).astype(numpy.int64)
+    right = numpy.clip(numpy.ceil(numpy.maximum.reduceat(numpy.maximum(x0, x1), starts)), 0, width).astype(numpy.int64)
+    top = numpy.clip(numpy.floor(numpy.minimum.reduceat(numpy.minimum(y0, y1), starts)), 0, height).astype(numpy.int64)
+    bottom = numpy.clip(numpy.ceil(numpy.maximum.reduceat(numpy.maximum(y0, y1), starts)), 0, height).astype(numpy.int64)
+    itemWidths = right - left
+    itemHeights = bottom - top
+    visible = (itemWidths > 0) & (itemHeights > 0)
+    # items are rasterized side by side in rows of one
+    # array. items are grouped by width so that a few
+    # wide items don't widen the rows of many small ones.
+    widthClasses = numpy.ceil(numpy.log2(numpy.maximum(itemWidths, 1))).astype(numpy.int64)
+    results = []
+    for widthClass in numpy.unique(widthClasses[visible]):
+        group = visible & (widthClasses == widthClass)
+        groupEdges = group[edgeItems]
+        result = _rasterizeItemGroup(
+            x0[groupEdges], y0[groupEdges], x1[groupEdges], y1[groupEdges], weights[groupEdges],
+            edgeItems[groupEdges], group, left, top, itemWidths, itemHeights, width
+        )
+        if result is not None:
+            results.append(result)
+    if not results:
+        return None
+    canvasIndexes, groupItems, coverage = [numpy.concatenate(values) for values in zip(*results)]
+    return canvasIndexes, itemIds[groupItems], coverage
+
+
+def _rasterizeItemGroup(x0, y0, x1, y1, weights, edgeItems, group, left, top, itemWidths, itemHeights, width):
+    samples = _rasterSubsamples
+    groupItems = numpy.flatnonzero(group)
+    stride = int(itemWidths[groupItems].max()) + 2
+    # the first sub-scanline of every item in the group
+    rowCounts = numpy.where(group, itemHeights * samples, 0)
+    rowOffsets = numpy.cumsum(rowCounts) - rowCounts
+    rowTotal = int(rowCounts.sum())
+    yLow = numpy.minimum(y0, y1)
+    yHigh = numpy.maximum(y0, y1)
+    edgeTops = top[edgeItems]
+    edgeRowCounts = rowCounts[edgeItems]
+    firstRow = numpy.clip(numpy.ceil((yLow - edgeTops) * samples - 0.5), 0, edgeRowCounts).astype(numpy.int64)
+    lastRow = numpy.clip(numpy.ceil((yHigh - edgeTops) * samples - 0.5), 0, edgeRowCounts).astype(numpy.int64)
+    counts = numpy.where(y0 != y1, lastRow - firstRow, 0)
+    crossing = counts > 0
+    if not crossing.any():
+        return None
+    counts = counts[crossing]
+    edgeIndexes = numpy.repeat(numpy.flatnonzero(crossing), counts)
+    offsets = numpy.arange(len(edgeIndexes)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    rows = firstRow[edgeIndexes] + offsets
+    crossingItems = edgeItems[edgeIndexes]
+    sampleY = top[crossingItems] + (rows + 0.5) / samples
+    ex0 = x0[edgeIndexes]
+    ey0 = y0[edgeIndexes]
+    ey1 = y1[edgeIndexes]
+    x = ex0 + (sampleY - ey0) * (x1[edgeIndexes] - ex0) / (ey1 - ey0) - left[crossingItems]
+    x = numpy.clip(x, 0, itemWidths[crossingItems])
+    direction = numpy.where(ey1 > ey0, 1.0, -1.0) * weights[edgeIndexes]
+    column = numpy.floor(x)
+    fraction = x - column
+    flat = (rowOffsets[crossingItems] + rows) * stride + column.astype(numpy.int64)
+    accumulation = numpy.bincount(
+        numpy.concatenate((flat, flat + 1)),
+        weights=numpy.concatenate((direction * (1 - fraction), direction * fraction)),
+        minlength=rowTotal * stride
+    ).astype(numpy.float32).reshape(rowTotal, stride)
+    winding = numpy.cumsum(accumulation, axis=1, out=accumulation)
+    coverage = numpy.minimum(numpy.abs(winding, out=winding), 1, out=winding)
+    coverage = coverage.reshape(rowTotal // samples, samples, stride).sum(axis=1)
+    coverage *= 1.0 / samples
+    pixelRows, pixelColumns = numpy.nonzero(coverage > 0)
+    pixelRowItems = numpy.repeat(groupItems, itemHeights[groupItems])
+    rowItems = pixelRowItems[pixelRows]
+    inside = pixelColumns < itemWidths[rowItems]
+    pixelRows = pixelRows[inside]
+    pixelColumns = pixelColumns[inside]
+    rowItems = rowItems[inside]
+    canvasRows = top[rowItems] + pixelRows - rowOffsets[rowItems] // samples
+    canvasIndexes = canvasRows * width + left[rowItems] + pixelColumns
+    return canvasIndexes, rowItems, coverage[pixelRows, pixelColumns]
+
+
+def _compositeItems(pixels, canvasIndexes, items, coverage, colors):
+    # composite item coverage in item order. the pixels
+    # are split into layers where each canvas pixel occurs
+    # once: the first item on a pixel, the second and so on.
+    flat = pixels.reshape(-1, 4)
+    order = numpy.argsort(canvasIndexes * (int(items.max()) + 1) + items)
+    canvasIndexes = canvasIndexes[order]
+    items = items[order]
+    coverage = coverage[order]
+    count = len(canvasIndexes)
+    groupStarts = numpy.flatnonzero(numpy.append(True, canvasIndexes[1:] != canvasIndexes[:-1]))
+    layers = numpy.arange(count) - numpy.repeat(groupStarts, numpy.diff(numpy.append(groupStarts, count)))
+    order = numpy.argsort(layers, kind="stable")
+    layerStarts = numpy.searchsorted(layers[order], numpy.arange(layers.max() + 2))
+    for start, end in zip(layerStarts[:-1], layerStarts[1:]):
+        selection = order[start:end]
+        indexes = canvasIndexes[selection]
+        color = colors[items[selection]]
+        alpha = (coverage[selection] * color[:, 3])[:, None]
+        source = color * 255
+        source[:, 3] = 255
+        flat[indexes] = numpy.rint(source * alpha + flat[indexes] * (1 - alpha))
+
+
+# Stroking
+
+def _circlePolygon(x, y, radius, transform):
+    deviceRadius = radius * math.sqrt(abs(transform[0] * transform[3] - transform[1] * transform[2]))
+    steps = max(8, min(64, int(deviceRadius) + 8))
+    angles = numpy.linspace(0, 2 * math.pi, steps, endpoint=False)
+    return numpy.column_stack((x + radius * numpy.cos(angles), y + radius * numpy.sin(angles)))
+
+
+def _dashPolyline(points, closed, dash):
+    # split a polyline into the polylines of its dashes
+    points = points.tolist()
+    if closed:
+        points.append(points[0])
+    dashes = []
+    dashIndex = 0
+    remaining = dash[0]
+    on = True
+    current = [points[0]]
+    for index in range(1, len(points)):
+        x0, y0 = points[index - 1]
+        x1, y1 = points[index]
+        length = math.hypot(x1 - x0, y1 - y0)
+        position = 0
+        while length - position > remaining:
+            position += remaining
+            t = position / length
+            point = (x0 + (x1 - x0) * t, y0 + (y1 - y0) * t)
+            if on:
+                current.append(point)
+                dashes.append(current)
+            else:
+                current = [point]
+            on = not on
+            dashIndex = (dashIndex + 1) % len(dash)
+            remaining = dash[dashIndex]
+        remaining -= length - position
+        if on:
+            current.append((x1, y1))
+    if on and len(current) > 1:
+        dashes.append(current)
+    return dashes
+
+
+def _strokePolygons(contours, state, transform):
+    # outline the stroke of flattened (points, closed)
+    # contours as a list of polygons in user space
+    halfWidth = state.strokeWidth / 2
+    lineJoin = state.lineJoin
+    lineCap = state.lineCap
+    if state.lineDash and sum(state.lineDash) > 0:
+        dashed = []
+        for points, closed in contours:
+            for dash in _dashPolyline(points, closed, state.lineDash):
+                dashed.append((dash, False))
+        contours = dashed
+    polygons = []
+    for points, closed in contours:
+        # remove repeated points
+        points = numpy.array(points, dtype=float)
+        if len(points) > 1:
+            keep = numpy.ones(len(points), dtype=bool)
+            keep[1:] = numpy.any(points[1:] != points[:-1], axis=1)
+            points = points[keep]
+        if closed and len(points) > 2 and (points[0] == points[-1]).all():
+            points = points[:-1]
+        if len(points) < 2:
+            if lineCap == "round" and len(points) == 1:
+                polygons.append(_circlePolygon(points[0][0], points[0][1], halfWidth, transform))
+            continue
+        if closed:
+            starts = points
+            ends = numpy.roll(points, -1, axis=0)
+        else:
+            starts = points[:-1]
+            ends = points[1:]
+        delta = ends - starts
+        lengths = numpy.hypot(delta[:, 0], delta[:, 1])
+        directions = delta / lengths[:, None]
+        normals = numpy.column_stack((-directions[:, 1], directions[:, 0])) * halfWidth
+        if not closed and lineCap == "square":
+            starts = starts.copy()
+            ends = ends.copy()
+            starts[0] -= directions[0] * halfWidth
+            ends[-1] += directions[-1] * halfWidth
+        quads = numpy.stack((starts + normals, ends + normals, ends - normals, starts - normals), axis=1)
+        polygons.extend(quads)
+        # joins
+        if closed:
+            joinIndexes = range(len(starts))
+        else:
+            joinIndexes = range(1, len(starts))
+        for index in joinIndexes:
+            vertex = points[index]
+            before = normals[index - 1]
+            after = normals[index]
+            if lineJoin == "round":
+                polygons.append(_circlePolygon(vertex[0], vertex[1], halfWidth, transform))
+                continue
+            cross = before[0] * after[1] - before[1] * after[0]
+            if abs(cross) < 1e-12:
+                continue
+            sign = 1 if cross < 0 else -1
+            outerBefore = vertex + before * sign
+            outerAfter = vertex + after * sign
+            if lineJoin == "miter":
+                cosine = (before[0] * after[0] + before[1] * after[1]) / (halfWidth * halfWidth)
+                miterLength = 1 / math.sqrt(max((1 + cosine) / 2, 1e-12))
+                if miterLength <= state.miterLimit:
+                    bisector = (before + after) * sign
+                    bisector /= numpy.hypot(bisector[0], bisector[1])
+                    tip = vertex + bisector * halfWidth * miterLength
+                    polygons.append(numpy.array([vertex, outerBefore, tip, outerAfter]))
+                    continue
+            polygons.append(numpy.array([vertex, outerBefore, outerAfter]))
+        if not closed and lineCap == "round":
+            polygons.append(_circlePolygon(points[0][0], points[0][1], halfWidth, transform))
+            polygons.append(_circlePolygon(points[-1][0], points[-1][1], halfWidth, transform))
+    return polygons
+
+
+def _pathStrokePolygons(path, state, tolerance):
+    # the stroke polygons of a path, memoized on the path
+    # for every stroke style. the transform only changes
+    # the number of steps of round joins and caps.
+    transform = state.ctm
+    scale = None
+    if state.lineJoin == "round" or state.lineCap == "round":
+        scale = abs(transform[0] * transform[3] - transform[1] * transform[2])
+    key = (tolerance, state.strokeWidth, state.lineJoin, state.lineCap, state.miterLimit, state.lineDash, scale)
+    polygons = path._strokes.get(key)
+    if polygons is None:
+        polygons = path._strokes[key] = _strokePolygons(path._flattenedContours(tolerance), state, transform)
+    return polygons
+
+
+def _lineStrokePolygons(coordinates, halfWidth, lineCap, transform):
+    # the stroke polygons of (n, 4) line coordinates as
+    # (polygons, line indexes) pairs of (n, k, 2) arrays
+    starts = coordinates[:, :2]
+    ends = coordinates[:, 2:]
+    delta = ends - starts
+    lengths = numpy.hypot(delta[:, 0], delta[:, 1])
+    drawn = numpy.flatnonzero(lengths > 0)
+    result = []
+    if len(drawn):
+        starts = starts[drawn]
+        ends = ends[drawn]
+        directions = delta[drawn] / lengths[drawn, None]
+        normals = numpy.column_stack((-directions[:, 1], directions[:, 0])) * halfWidth
+        if lineCap == "square":
+            starts = starts - directions * halfWidth
+            ends = ends + directions * halfWidth
+        quads = numpy.stack((starts + normals, ends + normals, ends - normals, starts - normals), axis=1)
+        result.append((quads, drawn))
+    if lineCap == "round":
+        circle = _circlePolygon(0, 0, halfWidth, transform)
+        everything = numpy.arange(len(coordinates))
+        for points in (coordinates[:, :2], coordinates[:, 2:]):
+            result.append((points[:, None, :] + circle[None, :, :], everything))
+    return result
+
+
+# Encoding
+
+def _unpremultiply(pixels):
+    pixels = pixels.astype(numpy.float32)
+    alpha = pixels[..., 3:4]
+    scale = numpy.where(alpha > 0, 255 / numpy.maximum(alpha, 1), 0)
+    pixels[..., :3] *= scale
+    return numpy.clip(numpy.rint(pixels), 0, 255).astype(numpy.uint8)
+
+
+def _encodePNG(pixels):
+    # pixels are a (height, width, 4) array of
+    # straight, not premultiplied, RGBA bytes
+    height, width = pixels.shape[:2]
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    rows = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * 4)
+    return b"".join((
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)),
+        chunk(b"IEND", b"")
+    ))
+
+
+class RasterContext(BaseContext):
+
+    def __init__(self, width, height):
+        super(RasterContext, self).__init__(width, height)
+        self._warnedTextBox = False
+        self._newContext(width, height)
+
+    def _newContext(self, width, height):
+        self.reset()
+        self._width = int(math.ceil(width))
+        self._height = int(math.ceil(height))
+        self._pixels = numpy.zeros((self._height, self._width, 4), dtype=numpy.uint8)
+        self.state.ctm = (1, 0, 0, -1, 0, height)
+
+    def _endPixels(self):
+        return self._pixels
+
+    def _endContext(self):
+        return _encodePNG(_unpremultiply(self._pixels))
+
+    def imageData(self):
+        return _profiledEncode(self.profiler, self._endContext)
+
+    # Pages
+
+    def newPage(self, width, height):
+        self._newContext(width, height)
+
+    # Paths
+
+    def _composite(self, polygons, color, orient=False):
+        edges = _polygonEdges(polygons, self.state.ctm, orient)
+        if edges is None:
+            return
+        result = _rasterizeEdges(edges, self._width, self._height)
+        if result is None:
+            return
+        coverage, top, left = result
+        rows, columns = coverage.shape
+        r, g, b, a = color
+        alpha = coverage
+        alpha *= a
+        remaining = 1 - alpha
+        region = self._pixels[top:top + rows, left:left + columns]
+        for channel, value in enumerate((r * 255, g * 255, b * 255, 255)):
+            composite = region[..., channel] * remaining
+            composite += alpha * value
+            composite += 0.5
+            region[..., channel] = composite
+
+    def drawPath(self, path):
+        state = self.state
+        if path is None:
+            path = state.path
+        if not path or self._cullPath(path, state):
+            return
+        tolerance = _deviceTolerance(state.ctm)
+        if state.fillColor is not None:
+            polygons = [points for points, closed in path._flattenedContours(tolerance)]
+            self._composite(polygons, state.fillColor)
+        if state.strokeColor is not None and state.strokeWidth:
+            self._composite(_pathStrokePolygons(path, state, tolerance), state.strokeColor, orient=True)
+
+    def rect(self, x, y, w, h):
+        state = self.state
+        if self._cullBounds(_boxBounds(x, y, w, h), state):
+            return
+        polygon = numpy.array(((x, y), (x + w, y), (x + w, y + h), (x, y + h)))
+        if state.fillColor is not None:
+            self._composite([polygon], state.fillColor)
+        if state.strokeColor is not None and state.strokeWidth:
+            self._composite(_strokePolygons([(polygon, True)], state, state.ctm), state.strokeColor, orient=True)
+
+    def drawBatch(self, batch):
+        # every item is composited on its own, as if it
+        # had been drawn with its own rect(), oval() or
+        # line(), but all of them in one rasterization
+        batch = self._cullBatch(batch)
+        if batch is None:
+            return
+        state = self.state
+        count = len(batch)
+        coordinates = batch.coordinates
+        if batch.kind == "line":
+            fillColors = None
+            strokeColors = batch.colors if batch.colors is not None else state.strokeColor
+        else:
+            fillColors = batch.colors if batch.colors is not None else state.fillColor
+            strokeColors = state.strokeColor
+        # fills are items 2n and strokes 2n + 1
+        colors = numpy.zeros((count * 2, 4))
+        edgeSets = []
+        itemSets = []
+        if fillColors is not None:
+            colors[0::2] = fillColors
+            x, y, w, h = coordinates.T
+            if batch.kind == "rect":
+                polygons = numpy.stack((
+                    numpy.column_stack((x, y)),
+                    numpy.column_stack((x + w, y)),
+                    numpy.column_stack((x + w, y + h)),
+                    numpy.column_stack((x, y + h))
+                ), axis=1)
+            else:
+                # a unit circle with enough points for the largest oval
+                radius = numpy.abs(coordinates[:, 2:]).max() / 2
+                circle = _circlePolygon(0, 0, radius, self.state.ctm) / max(radius, 1e-12)
+                polygons = (
+                    numpy.column_stack((x + w / 2, y + h / 2))[:, None, :] +
+                    circle[None, :, :] * coordinates[:, None, 2:] / 2
+                )
+            edgeSets.append(_polygonArrayEdges(polygons, self.state.ctm))
+            itemSets.append(numpy.repeat(numpy.arange(count) * 2, polygons.shape[1]))
+        if strokeColors is not None and state.strokeWidth:
+            colors[1::2] = strokeColors
+            if batch.kind == "line" and not state.lineDash:
+                for polygons, indexes in _lineStrokePolygons(coordinates, state.strokeWidth / 2, state.lineCap, self.state.ctm):
+                    edgeSets.append(_polygonArrayEdges(polygons, self.state.ctm, orient=True))
+                    itemSets.append(numpy.repeat(indexes * 2 + 1, polygons.shape[1]))
+            else:
+                for index in range(count):
+                    path = batch.path([index])
+                    polygons = _strokePolygons(path._flattenedContours(_deviceTolerance(state.ctm)), state, self.state.ctm)
+                    edges = _polygonEdges(polygons, self.state.ctm, orient=True)
+                    if edges is not None:
+                        edgeSets.append(edges)
+                        itemSets.append(numpy.full(len(edges[0]), index * 2 + 1))
+        if not edgeSets:
+            return
+        edges = [numpy.concatenate(values) for values in zip(*edgeSets)]
+        result = _rasterizeItems(edges, numpy.concatenate(itemSets), self._width, self._height)
+        if result is None:
+            return
+        canvasIndexes, items, coverage = result
+        _compositeItems(self._pixels, canvasIndexes, items, coverage, colors)
+
+    # Text
+
+    def textBox(self, txt, box, align="left"):
+        # warned once per context, not for every label
+        if not self._warnedTextBox:
+            self._warnedTextBox = True
+            warnings.warn("textBox is not supported by the raster backend.")
+
+    # States
+
+    def save(self):
+        self._saveState()
+
+    def restore(self):
+        self._restoreState()
+
+    # Transformations
+
+    def transform(self, transformMatrix):
+        self._concatTransform(transformMatrix)
+
+
+def _renderRasterPage(page, width, height):
+    # renders a standalone page in a worker process
+    context = RasterContext(width, height)
+    page.replay([getattr(context, methodName) for methodName in _instructionMethodNames])
+    return context._pixels, (context.culledCount, context.drawnCount)
+
+
+class RasterGIFContext(RasterContext):
+
+    def __init__(self, width, height, frameDuration):
+        super(RasterGIFContext, self).__init__(width, height)
+        self._file = io.BytesIO()
+        self._encoder = GIFEncoder(self._file, frameDuration)
+        self._haveFirstFrame = False
+
+    def _storeFrame(self, pixels):
+        _profiledEncode(self.profiler, self._encoder.addFrame, pixels)
+
+    def newPage(self, width, height):
+        if self._haveFirstFrame:
+            self._storeFrame(self._pixels)
+        self._newContext(width, height)
+        self._haveFirstFrame = True
+
+    def imageData(self):
+        self._storeFrame(self._pixels)
+        return self._writeFrames()
+
+    def _writeFrames(self):
+        _profiledEncode(self.profiler, self._encoder.close)
+        return self._file.getvalue()
+
+
+# ---
+# GIF
+# ---
+#
+# A streaming GIF encoder. Frames are premultiplied RGBA
+# arrays. Each one is compared with the previous frame,
+# quantized, LZW compressed and written to the file object
+# as frames are added, so only the last two frames are
+# held in memory.
+
+_gifTransparentThreshold = 128
+
+
+def _gifColorKeys(pixels):
+    # 15 bit keys of the straight colors of pixels
+    pixels = _unpremultiply(pixels)
+    r = pixels[..., 0].astype(numpy.int32) >> 3
+    g = pixels[..., 1].astype(numpy.int32) >> 3
+    b = pixels[..., 2].astype(numpy.int32) >> 3
+    return (r << 10) | (g << 5) | b
+
+
+def _gifKeyColors(keys):
+    # the center colors of 15 bit keys
+    r = (keys >> 10) & 31
+    g = (keys >> 5) & 31
+    b = keys & 31
+    return numpy.column_stack((r, g, b)) * 8 + 4
+
+
+def _medianCutPalette(keys, counts, maxColors):
+    # returns the palette and the palette index of every key
+    colors = _gifKeyColors(keys).astype(numpy.float64)
+    lookup = numpy.zeros(len(keys), dtype=numpy.int64)
+    boxes = []
+    finished = []
+    order = itertools.count()
+
+    def addBox(members):
+        memberColors = colors[members]
+        ranges = memberColors.max(axis=0) - memberColors.min(axis=0)
+        channel = int(ranges.argmax())
+        score = ranges[channel] * counts[members].sum()
+        heapq.heappush(boxes, (-score, next(order), members, channel))
+
+    addBox(numpy.arange(len(keys)))
+    while boxes and len(boxes) + len(finished) < maxColors:
+        score, boxOrder, members, channel = heapq.heappop(boxes)
+        if len(members) < 2 or not score:
+            finished.append(members)
+            continue
+        members = members[numpy.argsort(colors[members, channel], kind="stable")]
+        weights = numpy.cumsum(counts[members])
+        split = int(numpy.searchsorted(weights, weights[-1] / 2))
+        split = min(max(split, 1), len(members) - 1)
+        addBox(members[:split])
+        addBox(members[split:])
+    finished.extend(members for score, boxOrder, members, channel in boxes)
+    palette = numpy.zeros((len(finished), 3))
+    for index, members in enumerate(finished):
+        weights = counts[members]
+        palette[index] = (colors[members] * weights[:, None]).sum(axis=0) / weights.sum()
+        lookup[members] = index
+    return numpy.clip(numpy.rint(palette), 0, 255).astype(numpy.uint8), lookup
+
+
+def _nearestPaletteLookup(palette):
+    # the nearest palette index for every 15 bit key
+    keys = numpy.arange(32768)
+    colors = _gifKeyColors(keys).astype(numpy.float32)
+    palette = numpy.asarray(palette, dtype=numpy.float32)
+    lookup = numpy.empty(32768, dtype=numpy.int64)
+    for start in range(0, 32768, 4096):
+        distances = ((colors[start:start + 4096, None, :] - palette[None, :, :]) ** 2).sum(axis=2)
+        lookup[start:start + 4096] = distances.argmin(axis=1)
+    return lookup
+
+
+def _webPalette():
+    levels = numpy.arange(6) * 51
+    r, g, b = numpy.meshgrid(levels, levels, levels, indexing="ij")
+    return numpy.column_stack((r.ravel(), g.ravel(), b.ravel())).astype(numpy.uint8)
+
+
+def _gifTableBits(colorCount):
+    bits = 1
+    while (1 << bits) < colorCount:
+        bits += 1
+    return bits
+
+
+def _gifColorTable(palette, bits):
+    table = numpy.zeros((1 << bits, 3), dtype=numpy.uint8)
+    table[:len(palette)] = palette
+    return table.tobytes()
+
+
+def _lzwEncode(indexes, minimumCodeSize):
+    # GIF flavored LZW of a bytes object of color indexes
+    clearCode = 1 << minimumCodeSize
+    endCode = clearCode + 1
+    output = bytearray()
+    bitBuffer = clearCode
+    bitCount = minimumCodeSize + 1
+    codeSize = minimumCodeSize + 1
+    nextCode = endCode + 1
+    table = {}
+    lookup = table.get
+    prefix = indexes[0]
+    for index in indexes[1:]:
+        key = (prefix << 8) | index
+        code = lookup(key)
+        if code is not None:
+            prefix = code
+            continue
+        bitBuffer |= prefix << bitCount
+        bitCount += codeSize
+        while bitCount >= 8:
+            output.append(bitBuffer & 0xFF)
+            bitBuffer >>= 8
+            bitCount -= 8
+        if nextCode == 4096:
+            bitBuffer |= clearCode << bitCount
+            bitCount += codeSize
+            table = {}
+            lookup = table.get
+            codeSize = minimumCodeSize + 1
+            nextCode = endCode + 1
+        else:
+            if nextCode == 1 << codeSize:
+                codeSize += 1
+            table[key] = nextCode
+            nextCode += 1
+        prefix = index
+    bitBuffer |= prefix << bitCount
+    bitCount += codeSize
+    if nextCode == 1 << codeSize and codeSize < 12:
+        codeSize += 1
+    bitBuffer |= endCode << bitCount
+    bitCount += codeSize
+    while bitCount > 0:
+        output.append(bitBuffer & 0xFF)
+        bitBuffer >>= 8
+        bitCount -= 8
+    return bytes(output)
+
+
+def _gifSubBlocks(data):
+    blocks = []
+    for start in range(0, len(data), 255):
+        block = data[start:start + 255]
+        blocks.append(bytes((len(block),)))
+        blocks.append(block)
+    blocks.append(b"\x00")
+    return b"".join(blocks)
+
+
+def _maskBounds(mask):
+    # the (x, y, w, h) bounding box of the True values in a mask
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return None
+    columns = numpy.flatnonzero(mask.any(axis=0))
+    return columns[0], rows[0], columns[-1] - columns[0] + 1, rows[-1] - rows[0] + 1
+
+
+_gifDisposeNone = 1
+_gifDisposeBackground = 2
+
+
+class _GIFFrame(object):
+
+    def __init__(self, rect, indexes, palette, transparentIndex, delay):
+        self.rect = rect
+        self.indexes = indexes
+        self.palette = palette
+        self.transparentIndex = transparentIndex
+        self.delay = delay
+        self.disposal = _gifDisposeNone
+
+
+class GIFEncoder(object):
+
+    # palette is "adaptive" for a palette per frame, "web"
+    # for the 216 color web palette or a list of up to 255
+    # RGB colors. both of the latter are shared by all frames.
+    #
+    # each frame after the first only covers the area that
+    # changed since the previous one, and unchanged pixels
+    # in that area are transparent so the previous frame
+    # shows through. identical frames extend the duration
+    # of the previous one. a frame is held back until the
+    # next one arrives so that its duration and disposal
+    # can still be changed.
+
+    def __init__(self, fileObject, frameDuration=0.1, palette="adaptive", loop=0):
+        self._file = fileObject
+        self._delay = int(round(frameDuration * 100))
+        self._loop = loop
+        self._size = None
+        self._palette = None
+        self._lookup = None
+        self._previous = None
+        self._pending = None
+        if palette == "web":
+            palette = _webPalette()
+        if not isinstance(palette, str):
+            palette = numpy.asarray(palette, dtype=numpy.uint8).reshape(-1, 3)
+            if len(palette) > 255:
+                raise DrawBotError("a GIF palette can't have more than 255 colors")
+            self._palette = palette
+            self._lookup = _nearestPaletteLookup(palette)
+
+    def _writeHeader(self, width, height):
+        self._size = (width, height)
+        flags = 0
+        if self._palette is not None:
+            bits = _gifTableBits(len(self._palette) + 1)
+            flags = 0x80 | ((bits - 1) << 4) | (bits - 1)
+        self._file.write(b"GIF89a" + struct.pack("<HHBBB", width, height, flags, 0, 0))
+        if self._palette is not None:
+            self._file.write(_gifColorTable(self._palette, bits))
+        self._file.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01" + struct.pack("<H", self._loop) + b"\x00")
+
+    def _fitToScreen(self, pixels):
+        width, height = self._size
+        if pixels.shape[:2] == (height, width):
+            return pixels
+        fitted = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+        pixels = pixels[:height, :width]
+        fitted[:pixels.shape[0], :pixels.shape[1]] = pixels
+        return fitted
+
+    def addFrame(self, pixels):
+        if self._size is None:
+            self._writeHeader(pixels.shape[1], pixels.shape[0])
+        width, height = self._size
+        pixels = self._fitToScreen(pixels)
+        visible = pixels[..., 3] >= _gifTransparentThreshold
+        previous = self._previous
+        if previous is None:
+            draw = visible
+            rect = (0, 0, width, height)
+        else:
+            previousVisible = previous[..., 3] >= _gifTransparentThreshold
+            changed = (pixels != previous).any(axis=2) & (visible | previousVisible)
+            if not changed.any():
+                self._pending.delay += self._delay
+                return
+            cleared = changed & previousVisible & ~visible
+            clearedBounds = _maskBounds(cleared)
+            if clearedBounds is None:
+                draw = visible & changed
+            else:
+                # transparency can only come back by restoring
+                # the previous frame's area to the background,
+                # so that area is grown to cover the cleared
+                # pixels and everything visible in it is drawn
+                # again.
+                pending = self._pending
+                x1, y1, w, h = pending.rect
+                x2, y2 = x1 + w, y1 + h
+                cx, cy, w, h = clearedBounds
+                x1, y1 = min(x1, cx), min(y1, cy)
+                x2, y2 = max(x2, cx + w), max(y2, cy + h)
+                pending.rect = (x1, y1, x2 - x1, y2 - y1)
+                pending.disposal = _gifDisposeBackground
+                draw = visible & changed
+                draw[y1:y2, x1:x2] = visible[y1:y2, x1:x2]
+            rect = _maskBounds(draw)
+            if rect is None:
+                rect = (0, 0, 1, 1)
+        self._writePending()
+        self._previous = pixels
+        self._pending = self._quantizeFrame(pixels, draw, rect)
+
+    def _quantizeFrame(self, pixels, draw, rect):
+        x, y, w, h = rect
+        pixels = pixels[y:y + h, x:x + w]
+        draw = draw[y:y + h, x:x + w]
+        keys = _gifColorKeys(pixels)
+        if self._palette is None:
+            counts = numpy.bincount(keys[draw], minlength=32768)
+            present = numpy.flatnonzero(counts)
+            lookup = numpy.zeros(32768, dtype=numpy.int64)
+            if len(present):
+                palette, presentLookup = _medianCutPalette(present, counts[present], 255)
+                lookup[present] = presentLookup
+            else:
+                palette = numpy.zeros((0, 3), dtype=numpy.uint8)
+        else:
+            palette = self._palette
+            lookup = self._lookup
+        transparentIndex = len(palette)
+        width, height = self._size
+        indexes = numpy.full((height, width), transparentIndex, dtype=numpy.uint8)
+        indexes[y:y + h, x:x + w] = numpy.where(draw, lookup[keys], transparentIndex)
+        return _GIFFrame(rect, indexes, palette, transparentIndex, self._delay)
+
+    def _writePending(self):
+        frame = self._pending
+        if frame is None:
+            return
+        self._pending = None
+        x, y, w, h = frame.rect
+        bits = _gifTableBits(frame.transparentIndex + 1)
+        flags = (frame.disposal << 2) | 0x01
+        self._file.write(b"\x21\xF9\x04" + struct.pack("<BHBB", flags, min(frame.delay, 0xFFFF), frame.transparentIndex, 0))
+        if self._palette is None:
+            self._file.write(b"\x2C" + struct.pack("<HHHHB", x, y, w, h, 0x80 | (bits - 1)))
+            self._file.write(_gifColorTable(frame.palette, bits))
+        else:
+            self._file.write(b"\x2C" + struct.pack("<HHHHB", x, y, w, h, 0))
+        minimumCodeSize = max(2, bits)
+        indexes = numpy.ascontiguousarray(frame.indexes[y:y + h, x:x + w])
+        self._file.write(bytes((minimumCodeSize,)))
+        self._file.write(_gifSubBlocks(_lzwEncode(indexes.tobytes(), minimumCodeSize)))
+
+    def close(self):
+        self._writePending()
+        self._previous = None
+        self._file.write(b"\x3B")
+
+
+# ---
+# SVG
+# ---
+#
+# Pages are written as they are replayed. Consecutive
+# drawing with the same style and transform shares a
+# group. A path that is drawn again on the same page is
+# written once, with an id, and then referenced with
+# <use>. Only the ids of recent paths are remembered,
+# so memory doesn't grow with the size of the drawing.
+
+_svgPathIdCacheSize = 4096
+
+# the baseline of a line of text below its top,
+# relative to the font size
+_svgTextAscent = 0.8
+
+_svgHeader = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+    'width="%s" height="%s" viewBox="0 0 %s %s">\n'
+)
+
+_svgTextAnchors = dict(left="start", center="middle", right="end")
+
+
+def _svgNumber(value):
+    text = ("%.3f" % value).rstrip("0").rstrip(".")
+    if text == "-0":
+        return "0"
+    return text
+
+
+def _svgEscape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def _svgColorAttributes(name, color):
+    if color is None:
+        return ' %s="none"' % name
+    r, g, b, a = color
+    attributes = ' %s="rgb(%d,%d,%d)"' % (name, round(r * 255), round(g * 255), round(b * 255))
+    if a != 1:
+        attributes += ' %s-opacity="%s"' % (name, _svgNumber(a))
+    return attributes
+
+
+def _svgPathData(path):
+    number = _svgNumber
+    data = []
+    for segmentType, points in path._iterSegments():
+        if segmentType == _segmentClosePath:
+            data.append("Z")
+        else:
+            data.append("MLC"[segmentType] + " ".join([number(value) for value in points]))
+    return "".join(data)
+
+
+class SVGContext(BaseContext):
+
+    def __init__(self, width, height, openPage=None):
+        # openPage(pageIndex) returns the binary file a page
+        # is written to. without it pages are written to
+        # memory and imageData returns the last one.
+        super(SVGContext, self).__init__(width, height)
+        self._openPage = openPage
+        self._file = None
+        self._pageIndex = -1
+        self._group = None
+
+    def _write(self, text):
+        self._file.write(text.encode("utf-8"))
+
+    def _endPage(self):
+        if self._file is None:
+            return
+        if self._group is not None:
+            self._write("</g>\n")
+        self._write("</svg>\n")
+        if self._openPage is not None:
+            self._file.close()
+
+    def close(self):
+        self._endPage()
+        self._file = None
+
+    def imageData(self):
+        self._endPage()
+        data = self._file.getvalue()
+        self._file = None
         return data
 
+    # Pages
+
+    def newPage(self, width, height):
+        self._endPage()
+        self.reset()
+        self._width = width
+        self._height = height
+        self._pageIndex += 1
+        if self._openPage is None:
+            self._file = io.BytesIO()
+        else:
+            self._file = self._openPage(self._pageIndex)
+        self._group = None
+        self._pathIds = _BoundedCache(_svgPathIdCacheSize)
+        self._nextPathId = 0
+        self.state.ctm = (1, 0, 0, -1, 0, height)
+        self._write(_svgHeader % tuple(_svgNumber(value) for value in (width, height, width, height)))
+
+    # Groups
+
+    def _useGroup(self, key, attributes):
+        if key == self._group:
+            return
+        if self._group is not None:
+            self._write("</g>\n")
+        self._group = key
+        self._write("<g%s>\n" % attributes)
+
+    def _useStyleGroup(self):
+        state = self.state
+        strokeWidth = state.strokeWidth if state.strokeWidth is not None else 1
+        key = (
+            "style", state.ctm, state.fillColor, state.strokeColor, strokeWidth,
+            state.lineJoin, state.lineCap, state.miterLimit, state.lineDash
+        )
+        if key == self._group:
+            return
+        attributes = ' transform="matrix(%s)"' % " ".join(_svgNumber(value) for value in state.ctm)
+        attributes += _svgColorAttributes("fill", state.fillColor)
+        attributes += _svgColorAttributes("stroke", state.strokeColor)
+        if state.strokeColor is not None:
+            attributes += ' stroke-width="%s" stroke-linejoin="%s" stroke-linecap="%s" stroke-miterlimit="%s"' % (
+                _svgNumber(strokeWidth), state.lineJoin, state.lineCap, _svgNumber(state.miterLimit)
+            )
+            if state.lineDash:
+                attributes += ' stroke-dasharray="%s"' % " ".join(_svgNumber(value) for value in state.lineDash)
+        self._useGroup(key, attributes)
+
+    # Paths
+
+    def drawPath(self, path):
+        state = self.state
+        if path is None:
+            path = state.path
+        if not path or self._cullPath(path, state):
+            return
+        if state.fillColor is None and state.strokeColor is None:
+            return
+        self._useStyleGroup()
+        key = path._contentDigest()
+        pathId = self._pathIds.get(key)
+        if pathId is not None:
+            self._write('<use xlink:href="#p%d"/>\n' % pathId)
+            return
+        pathId = self._nextPathId
+        self._nextPathId += 1
+        self._pathIds.set(key, pathId)
+        self._write('<path id="p%d" d="%s"/>\n' % (pathId, _svgPathData(path)))
+
+    def drawBatch(self, batch):
+        batch = self._cullBatch(batch)
+        if batch is None:
+            return
+        self._useStyleGroup()
+        number = _svgNumber
+        if batch.kind == "line":
+            colorName = "stroke"
+        else:
+            colorName = "fill"
+        colors = batch.colors
+        elements = []
+        for index, (x, y, w, h) in enumerate(batch.coordinates.tolist()):
+            if batch.kind == "rect":
+                element = '<rect x="%s" y="%s" width="%s" height="%s"' % (number(min(x, x + w)), number(min(y, y + h)), number(abs(w)), number(abs(h)))
+            elif batch.kind == "oval":
+                element = '<ellipse cx="%s" cy="%s" rx="%s" ry="%s"' % (number(x + w / 2), number(y + h / 2), number(abs(w) / 2), number(abs(h) / 2))
+            else:
+                element = '<line x1="%s" y1="%s" x2="%s" y2="%s"' % (number(x), number(y), number(w), number(h))
+            if colors is not None:
+                element += _svgColorAttributes(colorName, tuple(colors[index]))
+            elements.append(element + "/>\n")
+        self._write("".join(elements))
+
+    # Text
+
+    def textBox(self, txt, box, align="left"):
+        x, y, w, h = box
+        if self.culling and not _touchesCanvas(min(x, x + w), min(y, y + h), max(x, x + w), max(y, y + h), self.state.ctm, self._width, self._height):
+            self.culledCount += 1
+            return
+        self.drawnCount += 1
+        state = self.state
+        if state.fillColor is None:
+            return
+        fontName = state.text_fontName
+        fontSize = state.text_fontSize
+        lines, overflow = _textLayout.fit(txt, fontName, fontSize, w, h)
+        # the lines are laid out from the top of the box down
+        ctm = _multiplyTransforms((1, 0, 0, -1, x, y + h), state.ctm)
+        attributes = ' transform="matrix(%s)"' % " ".join(_svgNumber(value) for value in ctm)
+        attributes += _svgColorAttributes("fill", state.fillColor)
+        attributes += ' font-family="%s" font-size="%s" text-anchor="%s"' % (
+            _svgEscape(fontName or "Helvetica"), _svgNumber(fontSize), _svgTextAnchors[align]
+        )
+        self._useGroup(("text", ctm, state.fillColor, fontName, fontSize, align), attributes)
+        lineHeight = fontSize * _lineHeightFactor
+        anchorX = _svgNumber(w * _textAlignments.index(align) / 2)
+        for index, (start, end, lineWidth) in enumerate(lines):
+            if start == end:
+                continue
+            baseline = index * lineHeight + fontSize * _svgTextAscent
+            self._write('<text x="%s" y="%s" xml:space="preserve">%s</text>\n' % (anchorX, _svgNumber(baseline), _svgEscape(txt[start:end])))
+
+    # States
+
+    def save(self):
+        self._saveState()
+
+    def restore(self):
+        self._restoreState()
+
+    # Transformations
+
+    def transform(self, transformMatrix):
+        self._concatTransform(transformMatrix)
+
+
+# ---
+# PDF
+# ---
+#
+# Objects are written to the file as soon as they are
+# complete, and pages when they end, with compressed
+# content streams. Fonts and transparency graphics states
+# are written once and shared by all pages. A path that
+# is drawn a second time becomes a form XObject that every
+# later drawing of it uses. Only the offsets of the objects
+# and the recent path hashes are kept in memory.
+
+_pdfXObjectCacheSize = 4096
+
+# the baseline of a line of text below its top,
+# relative to the font size
+_pdfTextAscent = 0.8
+
+_pdfLineJoins = dict(miter=0, round=1, bevel=2)
+_pdfLineCaps = dict(butt=0, round=1, square=2)
+
+
+def _pdfNumber(value):
+    text = ("%.4f" % value).rstrip("0").rstrip(".")
+    if text == "-0":
+        return "0"
+    return text
+
+
+def _pdfNumbers(values):
+    return " ".join([_pdfNumber(value) for value in values])
+
+
+def _pdfName(name):
+    # a PDF name with everything but letters
+    # and digits written as hex codes
+    return "/" + "".join(char if char.isalnum() and ord(char) < 128 else "#%02X" % ord(char) for char in name)
+
+
+def _pdfString(text):
+    data = text.encode("cp1252", "replace")
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def _pdfPathOperators(path):
+    number = _pdfNumber
+    operators = []
+    for segmentType, points in path._iterSegments():
+        if segmentType == _segmentMoveTo:
+            operators.append("%s %s m" % (number(points[0]), number(points[1])))
+        elif segmentType == _segmentLineTo:
+            operators.append("%s %s l" % (number(points[0]), number(points[1])))
+        elif segmentType == _segmentCurveTo:
+            operators.append(_pdfNumbers(points) + " c")
+        else:
+            operators.append("h")
+    return "\n".join(operators)
+
+
+class PDFContext(BaseContext):
+
+    def __init__(self, width, height, fileObject=None):
+        # without a file the document is written to
+        # memory and imageData returns it
+        super(PDFContext, self).__init__(width, height)
+        if fileObject is None:
+            fileObject = io.BytesIO()
+        self._file = fileObject
+        self._position = 0
+        # object offsets by object number, 1 is the
+        # catalog and 2 the page tree
+        self._offsets = [None, None, None]
+        self._pageObjects = []
+        self._fonts = {}
+        self._graphicsStates = {}
+        self._xObjects = _BoundedCache(_pdfXObjectCacheSize)
+        self._content = None
+        self._closed = False
+        self._writeBytes(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    # Objects
+
+    def _writeBytes(self, data):
+        self._file.write(data)
+        self._position += len(data)
+
+    def _newObjectNumber(self):
+        self._offsets.append(None)
+        return len(self._offsets) - 1
+
+    def _writeObject(self, dictionary, stream=None, number=None):
+        if number is None:
+            number = self._newObjectNumber()
+        self._offsets[number] = self._position
+        if stream is None:
+            self._writeBytes(("%d 0 obj\n%s\nendobj\n" % (number, dictionary)).encode("latin-1"))
+        else:
+            stream = zlib.compress(stream)
+            self._writeBytes(("%d 0 obj\n<< %s /Filter /FlateDecode /Length %d >>\nstream\n" % (number, dictionary, len(stream))).encode("latin-1"))
+            self._writeBytes(stream)
+            self._writeBytes(b"\nendstream\nendobj\n")
+        return number
+
+    def _fontResource(self, fontName):
+        # standard fonts aren't embedded, viewers
+        # substitute a font with the same name
+        if fontName is None:
+            fontName = "Helvetica"
+        resource = self._fonts.get(fontName)
+        if resource is None:
+            number = self._writeObject("<< /Type /Font /Subtype /Type1 /BaseFont %s /Encoding /WinAnsiEncoding >>" % _pdfName(fontName))
+            resource = self._fonts[fontName] = ("F%d" % len(self._fonts), number)
+        self._pageResources["Font"][resource[0]] = resource[1]
+        return resource[0]
+
+    def _graphicsStateResource(self, fillAlpha, strokeAlpha):
+        key = (fillAlpha, strokeAlpha)
+        resource = self._graphicsStates.get(key)
+        if resource is None:
+            number = self._writeObject("<< /Type /ExtGState /ca %s /CA %s >>" % (_pdfNumber(fillAlpha), _pdfNumber(strokeAlpha)))
+            resource = self._graphicsStates[key] = ("GS%d" % len(self._graphicsStates), number)
+        self._pageResources["ExtGState"][resource[0]] = resource[1]
+        return resource[0]
+
+    # Pages
+
+    def _endPage(self):
+        if self._content is None:
+            return
+        # close the states that were saved but not restored
+        self._content.extend(["Q"] * len(self.stateStack))
+        contents = self._writeObject("", "\n".join(self._content).encode("latin-1"))
+        resources = []
+        for kind in ("Font", "ExtGState", "XObject"):
+            entries = self._pageResources[kind]
+            if entries:
+                resources.append("/%s << %s >>" % (kind, " ".join("/%s %d 0 R" % item for item in sorted(entries.items()))))
+        self._pageObjects.append(self._writeObject(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] /Contents %d 0 R /Resources << %s >> >>" % (
+                _pdfNumber(self._width), _pdfNumber(self._height), contents, " ".join(resources)
+            )
+        ))
+        self._content = None
+
+    def newPage(self, width, height):
+        self._endPage()
+        self.reset()
+        self._width = width
+        self._height = height
+        self._content = []
+        self._pageResources = dict(Font={}, ExtGState={}, XObject={})
+        # what the content stream has set so far,
+        # saved and restored with q and Q
+        self._written = {}
+        self._writtenStack = []
+
+    def close(self):
+        if self._closed:
+            return
+        self._endPage()
+        self._writeObject("<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join("%d 0 R" % number for number in self._pageObjects), len(self._pageObjects)), number=2)
+        self._writeObject("<< /Type /Catalog /Pages 2 0 R >>", number=1)
+        xref = self._position
+        lines = ["xref", "0 %d" % len(self._offsets), "0000000000 65535 f "]
+        lines.extend("%010d 00000 n " % offset for offset in self._offsets[1:])
+        lines.append("trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(self._offsets), xref))
+        self._writeBytes("\n".join(lines).encode("latin-1"))
+        self._closed = True
+
+    def imageData(self):
+        self.close()
+        return self._file.getvalue()
+
+    # Content
+
+    def _setWritten(self, key, value, operator):
+        if self._written.get(key) != value:
+            self._written[key] = value
+            self._content.append(operator)
+
+    def _writeStyle(self, fill, stroke):
+        state = self.state
+        fillAlpha = 1
+        strokeAlpha = 1
+        if fill:
+            r, g, b, fillAlpha = state.fillColor
+            self._setWritten("fill", (r, g, b), "%s rg" % _pdfNumbers((r, g, b)))
+        if stroke:
+            r, g, b, strokeAlpha = state.strokeColor
+            self._setWritten("stroke", (r, g, b), "%s RG" % _pdfNumbers((r, g, b)))
+            strokeWidth = state.strokeWidth if state.strokeWidth is not None else 1
+            self._setWritten("lineWidth", strokeWidth, "%s w" % _pdfNumber(strokeWidth))
+            self._setWritten("lineJoin", state.lineJoin, "%d j" % _pdfLineJoins[state.lineJoin])
+            self._setWritten("lineCap", state.lineCap, "%d J" % _pdfLineCaps[state.lineCap])
+            self._setWritten("miterLimit", state.miterLimit, "%s M" % _pdfNumber(state.miterLimit))
+            self._setWritten("lineDash", state.lineDash, "[%s] 0 d" % _pdfNumbers(state.lineDash or ()))
+        if fill or stroke:
+            alpha = (fillAlpha, strokeAlpha)
+            if self._written.get("alpha", (1, 1)) != alpha:
+                self._setWritten("alpha", alpha, "/%s gs" % self._graphicsStateResource(*alpha))
+
+    def _paintOperator(self, fill, stroke):
+        if fill and stroke:
+            return "B"
+        if fill:
+            return "f"
+        return "S"
+
+    # Paths
+
+    def drawPath(self, path):
+        state = self.state
+        if path is None:
+            path = state.path
+        if not path or self._cullPath(path, state):
+            return
+        fill = state.fillColor is not None
+        stroke = state.strokeColor is not None
+        if not fill and not stroke:
+            return
+        self._writeStyle(fill, stroke)
+        paint = self._paintOperator(fill, stroke)
+        # a path that was drawn before is drawn with a form
+        # XObject, from its second drawing on. the bounding box
+        # of the XObject covers the stroke, so every stroke
+        # geometry gets its own XObject.
+        strokeGeometry = None
+        if stroke:
+            strokeGeometry = (state.strokeWidth, state.lineJoin, state.miterLimit, state.lineCap)
+        key = (path._contentDigest(), paint, strokeGeometry)
+        entry = self._xObjects.get(key)
+        if entry is None:
+            self._xObjects.set(key, [None])
+            self._content.append("%s\n%s" % (_pdfPathOperators(path), paint))
+            return
+        if entry[0] is None:
+            xMin, yMin, xMax, yMax = path._controlBounds()
+            outset = _strokeOutset(state) + 1
+            number = self._writeObject(
+                "/Type /XObject /Subtype /Form /BBox [%s]" % _pdfNumbers((xMin - outset, yMin - outset, xMax + outset, yMax + outset)),
+                ("%s\n%s" % (_pdfPathOperators(path), paint)).encode("latin-1")
+            )
+            entry[0] = ("X%d" % number, number)
+        name, number = entry[0]
+        self._pageResources["XObject"][name] = number
+        self._content.append("/%s Do" % name)
+
+    def drawBatch(self, batch):
+        batch = self._cullBatch(batch)
+        if batch is None:
+            return
+        state = self.state
+        if batch.kind == "line":
+            fill = False
+            stroke = batch.colors is not None or state.strokeColor is not None
+        else:
+            fill = batch.colors is not None or state.fillColor is not None
+            stroke = state.strokeColor is not None
+        if not fill and not stroke:
+            return
+        paint = self._paintOperator(fill, stroke)
+        colors = batch.colors
+        colorAttribute = "strokeColor" if batch.kind == "line" else "fillColor"
+        color = getattr(state, colorAttribute)
+        number = _pdfNumber
+        for index, (x, y, w, h) in enumerate(batch.coordinates.tolist()):
+            if colors is not None:
+                setattr(self._writableState(), colorAttribute, tuple(colors[index]))
+            self._writeStyle(fill, stroke)
+            if batch.kind == "rect":
+                self._content.append("%s %s %s %s re %s" % (number(x), number(y), number(w), number(h), paint))
+            elif batch.kind == "oval":
+                path = BezierPath()
+                path.oval(x, y, w, h)
+                self._content.append("%s\n%s" % (_pdfPathOperators(path), paint))
+            else:
+                self._content.append("%s %s m %s %s l %s" % (number(x), number(y), number(w), number(h), paint))
+        if colors is not None:
+            setattr(self._writableState(), colorAttribute, color)
+
+    # Text
+
+    def textBox(self, txt, box, align="left"):
+        x, y, w, h = box
+        if self.culling and not _touchesCanvas(min(x, x + w), min(y, y + h), max(x, x + w), max(y, y + h), self.state.ctm, self._width, self._height):
+            self.culledCount += 1
+            return
+        self.drawnCount += 1
+        state = self.state
+        if state.fillColor is None:
+            return
+        fontName = state.text_fontName
+        fontSize = state.text_fontSize
+        lines, overflow = _textLayout.fit(txt, fontName, fontSize, w, h)
+        self._writeStyle(True, False)
+        font = self._fontResource(fontName)
+        lineHeight = fontSize * _lineHeightFactor
+        alignment = _textAlignments.index(align) / 2
+        operators = ["BT", "/%s %s Tf" % (font, _pdfNumber(fontSize))]
+        for index, (start, end, lineWidth) in enumerate(lines):
+            if start == end:
+                continue
+            baseline = y + h - index * lineHeight - fontSize * _pdfTextAscent
+            operators.append("1 0 0 1 %s %s Tm" % (_pdfNumber(x + (w - lineWidth) * alignment), _pdfNumber(baseline)))
+            operators.append(_pdfString(txt[start:end]).decode("latin-1") + " Tj")
+        operators.append("ET")
+        self._content.append("\n".join(operators))
+
+    # States
+
+    def save(self):
+        self._saveState()
+        self._writtenStack.append(dict(self._written))
+        self._content.append("q")
+
+    def restore(self):
+        self._restoreState()
+        self._written = self._writtenStack.pop()
+        self._content.append("Q")
+
+    # Transformations
+
+    def transform(self, transformMatrix):
+        self._concatTransform(transformMatrix)
+        self._content.append("%s cm" % _pdfNumbers(transformMatrix))
+
+
+_vectorContexts = dict(SVG=SVGContext, PDF=PDFContext)
+
+
+# --------
+# Backends
+# --------
+#
+# A backend is a dictionary of context classes by format.
+# Loaders are registered by name and only called the first
+# time their backend is used, so nothing platform specific
+# is imported until then.
+
+_backendLoaders = {}
+_backends = {}
+_defaultBackendName = None
+
+
+def registerBackend(name, loader):
+    _backendLoaders[name] = loader
+    _backends.pop(name, None)
+
+
+def _getBackend(name):
+    backend = _backends.get(name)
+    if backend is None:
+        loader = _backendLoaders.get(name)
+        if loader is None:
+            raise NotImplementedError("backend '%s' is not supported" % name)
+        backend = _backends[name] = loader()
+    return backend
+
+
+def _defaultBackend():
+    # uikit in Pythonista, raster everywhere else
+    global _defaultBackendName
+    if _defaultBackendName is None:
+        if importlib.util.find_spec("objc_util") is not None:
+            _defaultBackendName = "uikit"
+        else:
+            _defaultBackendName = "raster"
+    return _defaultBackendName
+
+
+def _loadUIKitBackend():
+    _loadBridge()
+    return dict(PNG=PNGContext, GIF=GIFContext)
+
+
+def _loadRasterBackend():
+    return dict(PNG=RasterContext, GIF=RasterGIFContext)
+
+
+registerBackend("uikit", _loadUIKitBackend)
+registerBackend("raster", _loadRasterBackend)
+
 
 # ----
 # Main
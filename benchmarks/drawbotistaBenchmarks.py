@@ -0,0 +1,1144 @@
+# Benchmarks for drawbotista.
+#
+# Run all of them:
+#
+#   python benchmarks/drawbotistaBenchmarks.py
+#
+# Or some of them by name:
+#
+#   python benchmarks/drawbotistaBenchmarks.py displayListMemory
+#
+# Save the results as a baseline, then compare a later run
+# against it. The comparison fails when a time or memory
+# result is worse than the baseline by more than the
+# tolerance:
+#
+#   python benchmarks/drawbotistaBenchmarks.py --save baseline.json
+#   python benchmarks/drawbotistaBenchmarks.py --compare baseline.json --tolerance 0.25
+#
+# Outside of Pythonista the uikit backend runs against the
+# stand-in modules in benchmarks/shim. They don't draw, so
+# uikit results only measure drawbotista's own overhead.
+
+import os
+import io
+import sys
+import gc
+import json
+import time
+import random
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+benchmarksDirectory = os.path.dirname(os.path.abspath(__file__))
+libDirectory = os.path.join(benchmarksDirectory, "..", "Lib")
+shimDirectory = os.path.join(benchmarksDirectory, "shim")
+sys.path.insert(0, libDirectory)
+sys.path.append(shimDirectory)
+
+import drawbotista
+
+
+# -------
+# Helpers
+# -------
+
+_benchmarks = []
+
+
+class BenchmarkRegression(Exception):
+    pass
+
+
+def benchmark(function):
+    _benchmarks.append(function)
+    return function
+
+
+def bestTime(function, repeat=3):
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peakBytes(function):
+    gc.collect()
+    tracemalloc.start()
+    function()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def timeAndMemory(results, name, function, repeat=3):
+    results["%s seconds" % name] = bestTime(function, repeat)
+    results["%s peak kilobytes" % name] = peakBytes(function) / 1024
+
+
+def allocatedBytes(function):
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+class NullContext(drawbotista.BaseContext):
+
+    # Runs the graphics state machinery of
+    # BaseContext but doesn't draw anything.
+
+    def drawPath(self, path):
+        pass
+
+    def rect(self, x, y, w, h):
+        pass
+
+    def oval(self, x, y, w, h):
+        pass
+
+    def line(self, x1, y1, x2, y2):
+        pass
+
+    def textBox(self, txt, box, align="left"):
+        pass
+
+    def save(self):
+        self._saveState()
+
+    def restore(self):
+        self._restoreState()
+
+    def transform(self, transformMatrix):
+        self._concatTransform(transformMatrix)
+
+
+class TupleInstructionRecorder(object):
+
+    # The (callback, args, kwargs) recording that
+    # the drawing tool used before the display list.
+
+    def __init__(self):
+        self._instructionStack = []
+
+    def _addInstruction(self, callback, *args, **kwargs):
+        if callback == "newPage" or not self._instructionStack:
+            self._instructionStack.append([])
+        self._instructionStack[-1].append((callback, args, kwargs))
+
+    def fill(self, r, g=None, b=None, alpha=1):
+        self._addInstruction("fill", r, g, b, alpha)
+
+    def rect(self, x, y, w, h):
+        path = drawbotista.BezierPath()
+        path.rect(x, y, w, h)
+        self._addInstruction("drawPath", path)
+
+    def translate(self, x=0, y=0):
+        self._addInstruction("transform", (1, 0, 0, 1, x, y))
+
+    def _drawInContext(self, context):
+        context.newPage(500, 500)
+        for instructionSet in self._instructionStack:
+            for callback, args, kwargs in instructionSet:
+                method = getattr(context, callback)
+                method(*args, **kwargs)
+
+
+def recordRectScript(bot, count):
+    # a fill, a rect and a translate per iteration
+    for i in range(count):
+        bot.fill(i % 2, 0, 0, 1)
+        bot.rect(i, i, 10, 10)
+        bot.translate(1, 0)
+    return count * 3
+
+
+def drawScene(bot, seed=0):
+    # a bit of everything the drawing tool records
+    rng = random.Random(seed)
+    bot.fill(1)
+    bot.rect(0, 0, 500, 500)
+    for i in range(200):
+        with bot.savedState():
+            bot.translate(rng.uniform(0, 450), rng.uniform(0, 450))
+            bot.rotate(rng.uniform(0, 90))
+            bot.fill(rng.random(), rng.random(), rng.random(), 0.7)
+            if i % 3:
+                bot.oval(0, 0, rng.uniform(5, 50), rng.uniform(5, 50))
+            else:
+                bot.rect(0, 0, rng.uniform(5, 50), rng.uniform(5, 50))
+    bot.fill(None)
+    bot.stroke(0, 0, 0, 0.5)
+    bot.strokeWidth(3)
+    bot.lineDash(6, 3)
+    bot.lineJoin("round")
+    bot.polygon(*[(rng.uniform(0, 500), rng.uniform(0, 500)) for i in range(40)])
+    bot.lineDash(None)
+    path = drawbotista.BezierPath()
+    path.moveTo((50, 50))
+    for i in range(20):
+        path.curveTo((rng.uniform(0, 500), rng.uniform(0, 500)), (rng.uniform(0, 500), rng.uniform(0, 500)), (rng.uniform(0, 500), rng.uniform(0, 500)))
+    bot.drawPath(path)
+
+
+def sceneTool():
+    bot = drawbotista.DrawBotDrawingTool()
+    bot.setImageDataCache(False)
+    bot.newPage(500, 500)
+    drawScene(bot)
+    return bot
+
+
+# ---------
+# Recording
+# ---------
+
+@benchmark
+def recording(count=20000):
+    results = {}
+    bot = drawbotista.DrawBotDrawingTool()
+
+    def recorder(draw):
+        def record():
+            bot.newDrawing()
+            for i in range(count):
+                draw(i)
+        return record
+
+    def drawPath(i):
+        path = drawbotista.BezierPath()
+        path.moveTo((i, 0))
+        path.lineTo((i, 10))
+        path.curveTo((i + 5, 15), (i + 10, 15), (i + 10, 10))
+        path.closePath()
+        bot.drawPath(path)
+
+    timeAndMemory(results, "rect", recorder(lambda i: bot.rect(i, i, 10, 10)))
+    timeAndMemory(results, "oval", recorder(lambda i: bot.oval(i, i, 10, 10)))
+    timeAndMemory(results, "polygon", recorder(lambda i: bot.polygon((i, 0), (i, 10), (i + 10, 10), (i + 10, 0), close=True)))
+    timeAndMemory(results, "BezierPath", recorder(drawPath))
+    return results
+
+
+# ------
+# Replay
+# ------
+
+@benchmark
+def replay():
+    # _drawInContext for one scene in every context,
+    # without the final encode
+    results = {}
+    bot = sceneTool()
+
+    def nullReplay():
+        bot._drawInContext(NullContext(500, 500))
+
+    def uikitReplay():
+        context = drawbotista.PNGContext(500, 500)
+        bot._drawInContext(context)
+        context._endImage()
+
+    def rasterReplay():
+        bot._drawInContext(drawbotista.RasterContext(500, 500))
+
+    timeAndMemory(results, "null", nullReplay)
+    timeAndMemory(results, "uikit", uikitReplay)
+    timeAndMemory(results, "raster", rasterReplay)
+    return results
+
+
+# --------------
+# Graphics State
+# --------------
+
+@benchmark
+def graphicsStateChurn(count=20000):
+    # nested save and restore with a few state
+    # changes in between, replayed into BaseContext
+    results = {}
+    bot = drawbotista.DrawBotDrawingTool()
+    for i in range(count):
+        bot.save()
+        bot.fill(i % 2, 0, 0)
+        bot.strokeWidth(i % 5)
+        bot.translate(1, 1)
+        bot.save()
+        bot.lineDash(2, 2)
+        bot.restore()
+        bot.restore()
+
+    def uikitReplay():
+        context = drawbotista.PNGContext(500, 500)
+        bot._drawInContext(context)
+        context._endImage()
+
+    timeAndMemory(results, "null", lambda: bot._drawInContext(NullContext(500, 500)))
+    timeAndMemory(results, "uikit", uikitReplay)
+    timeAndMemory(results, "raster", lambda: bot._drawInContext(drawbotista.RasterContext(500, 500)))
+    return results
+
+
+class EagerGraphicsState(object):
+
+    # The graphics state that was copied
+    # attribute by attribute on every save.
+
+    def __init__(self):
+        self._loadAttributes(None)
+
+    def _loadAttributes(self, other=None):
+        attributesAndFallbacks = dict(
+            fillColor=(0, 0, 0, 1),
+            strokeColor=None,
+            strokeWidth=1,
+            miterLimit=10,
+            lineJoin="miter",
+            lineCap="butt",
+            lineDash=None,
+            path=None,
+            text_fontName=None,
+            text_fontSize=10
+        )
+        for attr, fallback in attributesAndFallbacks.items():
+            value = fallback
+            if other is not None and hasattr(other, attr):
+                value = getattr(other, attr)
+            setattr(self, attr, value)
+
+    def copy(self):
+        new = self.__class__()
+        new._loadAttributes(self)
+        return new
+
+
+class EagerCopyContext(NullContext):
+
+    def reset(self):
+        self.stateStack = []
+        self.state = EagerGraphicsState()
+
+    def _writableState(self):
+        return self.state
+
+    def save(self):
+        self.stateStack.append(self.state.copy())
+
+    def restore(self):
+        self.state = self.stateStack.pop()
+
+
+def saveRestoreScript(context, count, depth=8):
+    # nested saves where only the innermost
+    # level changes anything
+    for i in range(count):
+        for level in range(depth):
+            context.save()
+        context.fill(i % 2, 0, 0)
+        context.strokeWidth(2)
+        for level in range(depth):
+            context.restore()
+
+
+@benchmark
+def saveRestore(count=10000):
+    results = {}
+    for name, contextClass in (("eager copy", EagerCopyContext), ("copy on write", NullContext)):
+        seconds = bestTime(lambda: saveRestoreScript(contextClass(500, 500), count))
+        results["%s saves per second" % name] = count * 8 / seconds
+    return results
+
+
+# ---------
+# Optimizer
+# ---------
+
+def drawGeneratedScript(bot, seed, count=300):
+    # the kind of redundancy generated scripts have:
+    # repeated state, transform chains and saves
+    # around nothing
+    rng = random.Random(seed)
+    bot.newPage(300, 300)
+    for i in range(count):
+        choice = rng.random()
+        bot.fill(rng.choice((0, 0.5, 1)), 0, 0, 1)
+        bot.stroke(None)
+        bot.strokeWidth(rng.choice((1, 1, 1, 4)))
+        bot.lineJoin(rng.choice(("miter", "miter", "round")))
+        with bot.savedState():
+            bot.translate(rng.uniform(0, 250), rng.uniform(0, 250))
+            bot.rotate(rng.choice((0, 0, 15, 45)))
+            bot.scale(rng.choice((1, 1, 0.5, 2)))
+            bot.translate(-5, -5)
+            if choice < 0.3:
+                with bot.savedState():
+                    bot.fill(0, 1, 0)
+                    bot.translate(1, 1)
+            elif choice < 0.6:
+                bot.stroke(0, 0, 1, 0.5)
+                bot.lineDash(rng.choice((None, 2)), 3)
+                bot.oval(0, 0, 20, 10)
+            else:
+                bot.rect(0, 0, 10, 10)
+        bot.translate(0, 0)
+        bot.fontSize(12)
+        bot.fontSize(12)
+
+
+@benchmark
+def displayListOptimizer(scriptCount=5):
+    # the optimizer must not change a single pixel
+    results = {}
+    removed = 0
+    total = 0
+    originalSeconds = 0
+    optimizedSeconds = 0
+    for seed in range(scriptCount):
+        original = drawbotista.DrawBotDrawingTool()
+        optimized = drawbotista.DrawBotDrawingTool()
+        drawGeneratedScript(original, seed)
+        drawGeneratedScript(optimized, seed)
+        report = optimized.optimizeDisplayList()
+        removed += report["before"] - report["after"]
+        total += report["before"]
+        for tool in (original, optimized):
+            tool.setImageDataCache(False)
+        originalPixels = drawbotista._renderRasterPage(original._instructionStack[0], 300, 300)[0]
+        optimizedPixels = drawbotista._renderRasterPage(optimized._instructionStack[0], 300, 300)[0]
+        if originalPixels.tobytes() != optimizedPixels.tobytes():
+            raise BenchmarkRegression("the optimized display list for seed %d draws different pixels" % seed)
+        originalSeconds += bestTime(lambda: original._drawInContext(NullContext(300, 300)))
+        optimizedSeconds += bestTime(lambda: optimized._drawInContext(NullContext(300, 300)))
+    # pages the optimizer empties completely
+    for name, script in (("save and restore", lambda bot: (bot.save(), bot.restore())), ("identity transform", lambda bot: bot.translate(0, 0))):
+        original = drawbotista.DrawBotDrawingTool()
+        optimized = drawbotista.DrawBotDrawingTool()
+        script(original)
+        script(optimized)
+        optimized.optimizeDisplayList()
+        for tool in (original, optimized):
+            tool.setImageDataCache(False)
+        if original.imageData("PNG", backend="raster") != optimized.imageData("PNG", backend="raster"):
+            raise BenchmarkRegression("the optimized display list of a page with only a %s draws different pixels" % name)
+    results["instructions removed percent"] = removed / total * 100
+    results["original replay seconds"] = originalSeconds
+    results["optimized replay seconds"] = optimizedSeconds
+    return results
+
+
+# ----------
+# Flattening
+# ----------
+
+@benchmark
+def curveFlattening(curveCount=5000):
+    results = {}
+    rng = random.Random(0)
+    path = drawbotista.BezierPath()
+    path.moveTo((0, 0))
+    for i in range(curveCount):
+        path.curveTo(*[(rng.uniform(0, 500), rng.uniform(0, 500)) for j in range(3)])
+
+    def flatten():
+        path._changed()
+        return path._flattenedContours()
+
+    timeAndMemory(results, "flatten", flatten)
+    results["memoized seconds"] = bestTime(path._flattenedContours)
+    results["points per curve"] = len(flatten()[0][0]) / curveCount
+    return results
+
+
+# -----------
+# Hit-Testing
+# -----------
+
+@benchmark
+def hitTesting(pathCount=50000, queryCount=1000, linearQueryCount=3):
+    # the index must find the same paths as a linear scan
+    results = {}
+    rng = random.Random(0)
+    paths = []
+    for i in range(pathCount):
+        path = drawbotista.BezierPath()
+        x = rng.uniform(0, 5000)
+        y = rng.uniform(0, 5000)
+        if i % 2:
+            path.oval(x, y, rng.uniform(5, 60), rng.uniform(5, 60))
+        else:
+            path.polygon((x, y), (x + rng.uniform(-60, 60), y + rng.uniform(-60, 60)), (x + rng.uniform(-60, 60), y))
+        paths.append(path)
+    points = [(rng.uniform(0, 5000), rng.uniform(0, 5000)) for i in range(queryCount)]
+    timeAndMemory(results, "index build", lambda: drawbotista.PathIndex(paths), repeat=1)
+    index = drawbotista.PathIndex(paths)
+
+    def linearScan(point):
+        return [path for path in paths if path.pointInside(point)]
+
+    for point in points[:linearQueryCount]:
+        if index.pathsAt(point) != linearScan(point):
+            raise BenchmarkRegression("the path index found different paths at %r" % (point,))
+    linearSeconds = bestTime(lambda: [linearScan(point) for point in points[:linearQueryCount]], repeat=1) / linearQueryCount
+    indexSeconds = bestTime(lambda: [index.pathsAt(point) for point in points]) / queryCount
+    results["linear query seconds"] = linearSeconds
+    results["index query seconds"] = indexSeconds
+    results["index speedup"] = linearSeconds / indexSeconds
+    results["index rect query seconds"] = bestTime(lambda: [index.pathsInRect((x, y, 100, 100)) for x, y in points]) / queryCount
+    return results
+
+
+# ------------------
+# Boolean Operations
+# ------------------
+
+def pathArea(path):
+    import numpy
+    area = 0
+    for points, closed in path._flattenedContours():
+        x = points[:, 0]
+        y = points[:, 1]
+        area += (x * numpy.roll(y, -1) - numpy.roll(x, -1) * y).sum() / 2
+    return area
+
+
+def scatteredOvals(count, rng):
+    ovals = []
+    for i in range(count):
+        path = drawbotista.BezierPath()
+        path.oval(rng.uniform(0, 1000), rng.uniform(0, 1000), 30, 30)
+        ovals.append(path)
+    return ovals
+
+
+@benchmark
+def booleanOperations(pairwiseCount=100, sweepCount=2000):
+    # a union of many overlapping ovals in one sweep, and
+    # folded pair by pair the way user code would do it
+    # without removeOverlap. both must cover the same area.
+    results = {}
+    rng = random.Random(0)
+    ovals = scatteredOvals(pairwiseCount, rng)
+
+    def sweep(ovals):
+        path = drawbotista.BezierPath()
+        for oval in ovals:
+            path.appendPath(oval)
+        return path.removeOverlap()
+
+    def pairwise():
+        path = ovals[0]
+        for oval in ovals[1:]:
+            path = path | oval
+        return path
+
+    sweepArea = pathArea(sweep(ovals))
+    pairwiseArea = pathArea(pairwise())
+    if abs(sweepArea - pairwiseArea) > sweepArea * 1e-6:
+        raise BenchmarkRegression("the sweep and pairwise unions cover different areas: %r and %r" % (sweepArea, pairwiseArea))
+    results["%d ovals pairwise seconds" % pairwiseCount] = bestTime(pairwise, repeat=1)
+    results["%d ovals sweep seconds" % pairwiseCount] = bestTime(lambda: sweep(ovals))
+    manyOvals = scatteredOvals(sweepCount, rng)
+    results["%d ovals sweep seconds" % sweepCount] = bestTime(lambda: sweep(manyOvals), repeat=1)
+    return results
+
+
+# ----
+# Text
+# ----
+
+_labels = ["Label %d with a few words in it" % i for i in range(20)]
+
+
+def drawLabels(bot, pageCount):
+    # the same labels on every page
+    for page in range(pageCount):
+        bot.newPage(300, 300)
+        bot.fontSize(12)
+        for index, label in enumerate(_labels):
+            bot.textBox(label, (10, index * 14, 80, 28), align="center")
+
+
+@benchmark
+def textLayout(pageCount=300):
+    # recording lays out every label with the layout
+    # cache and without it, then the UIKit context draws
+    # the labels with its font and attribute caches
+    results = {}
+    original = drawbotista._textLayout
+    try:
+        for name, layout in (
+                ("uncached", drawbotista._TextLayout(drawbotista._helveticaUnitWidth, layoutCacheSize=0, wordCacheSize=0)),
+                ("cached", drawbotista._TextLayout(drawbotista._helveticaUnitWidth))
+            ):
+            drawbotista._textLayout = layout
+            bot = drawbotista.DrawBotDrawingTool()
+            results["%s record seconds" % name] = bestTime(lambda: (bot.newDrawing(), drawLabels(bot, pageCount)), repeat=1)
+        context = drawbotista.PNGContext(300, 300)
+        page = bot._instructionStack[0]
+        methods = [getattr(context, methodName) for methodName in drawbotista._instructionMethodNames]
+        results["uikit page replay seconds"] = bestTime(lambda: page.replay(methods))
+    finally:
+        drawbotista._textLayout = original
+    return results
+
+
+# -------
+# Culling
+# -------
+
+def drawScatteredScene(bot, count=1500, size=400):
+    # shapes spread over nine times the page, so most of
+    # them end up off canvas after the transforms
+    bot.newPage(size, size)
+    bot.translate(size / 2, size / 2)
+    bot.rotate(30)
+    bot.scale(1.5)
+    bot.stroke(0, 0, 0, 0.5)
+    bot.strokeWidth(6)
+    bot.lineJoin("miter")
+    for i in range(count):
+        x = random.uniform(-size * 1.5, size * 1.5)
+        y = random.uniform(-size * 1.5, size * 1.5)
+        bot.fill(random.random(), random.random(), random.random(), 0.5)
+        if i % 3:
+            bot.rect(x, y, 12, 12)
+        else:
+            path = drawbotista.BezierPath()
+            path.oval(x, y, 10, 16)
+            bot.drawPath(path)
+    bot.rects([(random.uniform(-size * 1.5, size * 1.5), random.uniform(-size * 1.5, size * 1.5), 8, 8) for i in range(count)])
+
+
+class UnculledRasterContext(drawbotista.RasterContext):
+
+    culling = False
+
+
+@benchmark
+def viewportCulling():
+    # culling must not change a single pixel
+    results = {}
+    bot = drawbotista.DrawBotDrawingTool()
+    drawScatteredScene(bot)
+    page = bot._instructionStack[0]
+    pixels = {}
+
+    def render(contextClass):
+        context = contextClass(400, 400)
+        page.replay([getattr(context, methodName) for methodName in drawbotista._instructionMethodNames])
+        pixels[contextClass] = context._pixels
+        return context
+
+    context = render(drawbotista.RasterContext)
+    render(UnculledRasterContext)
+    if pixels[drawbotista.RasterContext].tobytes() != pixels[UnculledRasterContext].tobytes():
+        raise BenchmarkRegression("culling changed the pixels of the scattered scene")
+    results["culled percent"] = context.culledCount / (context.culledCount + context.drawnCount) * 100
+    results["unculled seconds"] = bestTime(lambda: render(UnculledRasterContext), repeat=1)
+    results["culled seconds"] = bestTime(lambda: render(drawbotista.RasterContext), repeat=1)
+    return results
+
+
+def drawMotifs(bot, count, size=400):
+    # a few motifs built again for every drawing, the
+    # way a helper function that returns a path would
+    rng = random.Random(0)
+    bot.newPage(size, size)
+    bot.stroke(0)
+    for i in range(count):
+        with bot.savedState():
+            bot.translate(rng.uniform(0, size), rng.uniform(0, size))
+            bot.rotate(rng.uniform(0, 360))
+            path = drawbotista.BezierPath()
+            path.oval(-10, -5, 20, 10 + i % 4)
+            path.rect(-2, -2, 4, 4)
+            bot.fill(i % 2, 0, 0, 0.5)
+            bot.drawPath(path)
+
+
+class UninternedDrawingTool(drawbotista.DrawBotDrawingTool):
+
+    def _internPath(self, path):
+        return path
+
+
+@benchmark
+def pathInstancing(count=10000):
+    # paths with the same geometry are recorded once and
+    # share what the contexts derive from them
+    results = {}
+    pixels = {}
+    for name, toolClass in (("uninterned", UninternedDrawingTool), ("interned", drawbotista.DrawBotDrawingTool)):
+        bot = toolClass()
+        bot.setImageDataCache(False)
+        results["%s record seconds" % name] = bestTime(lambda: drawMotifs(toolClass(), count), repeat=1)
+        drawMotifs(bot, count)
+        results["%s objects" % name] = len(bot._objects)
+        page = bot._instructionStack[0]
+
+        def replay():
+            context = drawbotista.RasterContext(400, 400)
+            page.replay([getattr(context, methodName) for methodName in drawbotista._instructionMethodNames])
+            pixels[name] = context._pixels
+
+        results["%s raster seconds" % name] = bestTime(replay, repeat=1)
+        results["%s SVG seconds" % name] = bestTime(lambda: bot.imageData("SVG"), repeat=1)
+    if results["interned objects"] != 4:
+        raise BenchmarkRegression("%d motifs were recorded as %d paths" % (4, results["interned objects"]))
+    if pixels["interned"].tobytes() != pixels["uninterned"].tobytes():
+        raise BenchmarkRegression("interning changed the pixels of the motifs")
+    return results
+
+
+# --------
+# Encoding
+# --------
+
+@benchmark
+def encoding():
+    results = {}
+    bot = sceneTool()
+    pixels = drawbotista._renderRasterPage(bot._instructionStack[0], 500, 500)[0]
+
+    def encodeGIF():
+        f = io.BytesIO()
+        encoder = drawbotista.GIFEncoder(f)
+        encoder.addFrame(pixels)
+        encoder.close()
+
+    timeAndMemory(results, "PNG", lambda: drawbotista._encodePNG(drawbotista._unpremultiply(pixels)))
+    timeAndMemory(results, "GIF", encodeGIF)
+    return results
+
+
+@benchmark
+def pixelAccess():
+    # once a page is rendered its pixels are handed
+    # out without encoding or copying them
+    results = {}
+    bot = sceneTool()
+    bot.setImageDataCache(False)
+    for backend in ("raster", "uikit"):
+        results["%s render seconds" % backend] = bestTime(lambda: bot.imagePixels(backend=backend), repeat=1)
+        timeAndMemory(results, "%s cached" % backend, lambda: bot.imagePixels(backend=backend))
+        timeAndMemory(results, "%s PNG" % backend, lambda: bot.imageData("PNG", backend=backend), repeat=1)
+        # hashing the page allocates a little, a copy
+        # of the 500 by 500 frame would take 977 kilobytes
+        if results["%s cached peak kilobytes" % backend] > 500 * 500 * 4 / 1024 / 4:
+            raise BenchmarkRegression("imagePixels copied the cached %s pixels" % backend)
+    bot = drawbotista.DrawBotDrawingTool()
+    bot.size(100, 100)
+    bot.fill(1, 0.5, 0, 0.5)
+    bot.rect(20, 20, 40, 40)
+    color = bot.imagePixelColor(bot.imagePixels(backend="raster"), (30, 30))
+    if max(abs(a - b) for a, b in zip(color, (1, 0.5, 0, 0.5))) > 0.01:
+        raise BenchmarkRegression("imagePixelColor returned %r instead of (1, 0.5, 0, 0.5)" % (color,))
+    return results
+
+
+# ---------
+# Animation
+# ---------
+
+@benchmark
+def animation(frameCount=12):
+    results = {}
+    bot = drawbotista.DrawBotDrawingTool()
+    bot.setImageDataCache(False)
+    drawAnimation(bot, frameCount)
+    timeAndMemory(results, "uikit GIF", lambda: bot.imageData("GIF", backend="uikit"), repeat=1)
+    timeAndMemory(results, "raster GIF", lambda: bot.imageData("GIF", backend="raster"), repeat=1)
+    return results
+
+
+# ------------
+# Display List
+# ------------
+
+@benchmark
+def displayListMemory(count=100000):
+    results = {}
+    for name, recorderClass in (("tuples", TupleInstructionRecorder), ("displayList", drawbotista.DrawBotDrawingTool)):
+        recorder, size = allocatedBytes(lambda: _recordedTool(recorderClass, count))
+        results["%s bytes per instruction" % name] = size / (count * 3)
+    return results
+
+
+@benchmark
+def displayListThroughput(count=100000, rasterCount=20000):
+    # rect() paths are built while recording with tuples,
+    # the display list replays rect() with its operands. the
+    # raster replay is the first one of a new recording, as
+    # paths keep what they have drawn.
+    results = {}
+    for name, recorderClass in (("tuples", TupleInstructionRecorder), ("displayList", drawbotista.DrawBotDrawingTool)):
+        recordSeconds = bestTime(lambda: _recordedTool(recorderClass, count))
+        recorder = _recordedTool(recorderClass, count)
+        replaySeconds = bestTime(lambda: recorder._drawInContext(NullContext(500, 500)))
+        results["%s record instructions per second" % name] = count * 3 / recordSeconds
+        results["%s replay instructions per second" % name] = count * 3 / replaySeconds
+        results["%s total instructions per second" % name] = count * 3 / (recordSeconds + replaySeconds)
+        del recorder
+        rasterSeconds = _firstReplayTime(recorderClass, rasterCount, drawbotista.RasterContext)
+        results["%s raster replay instructions per second" % name] = rasterCount * 3 / rasterSeconds
+    return results
+
+
+def _firstReplayTime(recorderClass, count, contextClass, repeat=3):
+    times = []
+    for i in range(repeat):
+        recorder = _recordedTool(recorderClass, count)
+        gc.collect()
+        start = time.perf_counter()
+        recorder._drawInContext(contextClass(500, 500))
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _recordedTool(recorderClass, count):
+    recorder = recorderClass()
+    recordRectScript(recorder, count)
+    return recorder
+
+
+# ------------------
+# Parallel Rendering
+# ------------------
+
+def drawAnimation(bot, frameCount):
+    for frame in range(frameCount):
+        bot.newPage(500, 500)
+        bot.fill(1)
+        bot.rect(0, 0, 500, 500)
+        for i in range(100):
+            bot.fill(i / 100, 0, 1 - i / 100, 0.5)
+            bot.oval((i * 37 + frame * 5) % 450, (i * 53) % 450, 50, 50)
+        bot.fill(None)
+        bot.stroke(0, 0, 0, 0.5)
+        bot.strokeWidth(8)
+        bot.lineJoin("round")
+        bot.polygon(*[((i * 91 + frame) % 500, (i * 47) % 500) for i in range(30)])
+
+
+@benchmark
+def parallelRendering(frameCount=32):
+    results = {}
+    bot = drawbotista.DrawBotDrawingTool()
+    bot.setImageDataCache(False)
+    drawAnimation(bot, frameCount)
+    serial = bestTime(lambda: bot.imageData("GIF", backend="raster"), repeat=1)
+    results["serial seconds"] = serial
+    for workers in (1, 2, 4, 8):
+        seconds = bestTime(lambda: bot.imageData("GIF", backend="raster", workers=workers), repeat=1)
+        results["%d workers seconds" % workers] = seconds
+        results["%d workers speedup" % workers] = serial / seconds
+    return results
+
+
+@benchmark
+def frameStreaming(frameCount=12):
+    # the first frame must arrive long before the last one,
+    # and a consumer that stops must stop the rendering
+    import asyncio
+    results = {}
+
+    def firstFrame(frames):
+        start = time.perf_counter()
+        next(frames)
+        seconds = time.perf_counter() - start
+        frames.close()
+        return seconds
+
+    bot = drawbotista.DrawBotDrawingTool()
+    drawAnimation(bot, frameCount)
+    results["first frame seconds"] = firstFrame(bot.iterFrames(backend="raster"))
+    results["all frames seconds"] = bestTime(lambda: list(bot.iterFrames(backend="raster")), repeat=1)
+    results["2 workers first frame seconds"] = firstFrame(bot.iterFrames(backend="raster", workers=2))
+
+    async def consume(stopAfter):
+        start = time.perf_counter()
+        count = 0
+        async for frame in bot.renderAsync(backend="raster"):
+            count += 1
+            if count == 1:
+                results["async first frame seconds"] = time.perf_counter() - start
+            if count == stopAfter:
+                break
+            # the event loop stays free while the next frame renders
+            await asyncio.sleep(0)
+
+    bot = drawbotista.DrawBotDrawingTool()
+    drawAnimation(bot, frameCount)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(consume(2))
+        # let the frame that was rendered ahead finish
+        loop.run_until_complete(asyncio.sleep(results["first frame seconds"] * 2))
+    finally:
+        loop.close()
+    rendered = bot.renderCacheInfo()["misses"]
+    results["pages rendered for 2 frames"] = rendered
+    if rendered > 3:
+        raise BenchmarkRegression("renderAsync rendered %d pages for a consumer that took 2 frames" % rendered)
+    return results
+
+
+# ---
+# GIF
+# ---
+
+def drawSmallMotion(bot, frameCount, size=1000):
+    # a large still background with one small moving dot
+    for frame in range(frameCount):
+        bot.newPage(size, size)
+        bot.fill(0.9, 0.9, 1)
+        bot.rect(0, 0, size, size)
+        bot.fill(0, 0, 0.5)
+        for i in range(20):
+            bot.rect(i * 50, 0, 25, size)
+        bot.fill(1, 0, 0)
+        bot.oval(100 + frame * 10, 500, 40, 40)
+
+
+@benchmark
+def gifDeltaEncoding(frameCount=30):
+    # every frame encoded on its own is what the
+    # encoder would write without frame differencing
+    results = {}
+    bot = drawbotista.DrawBotDrawingTool()
+    drawSmallMotion(bot, frameCount)
+    frames = [drawbotista._renderRasterPage(page, 1000, 1000)[0] for page in bot._instructionStack]
+
+    def encode(frames):
+        f = io.BytesIO()
+        encoder = drawbotista.GIFEncoder(f)
+        for pixels in frames:
+            encoder.addFrame(pixels)
+        encoder.close()
+        return len(f.getvalue())
+
+    for name, encodeFrames in (
+            ("full frames", lambda: sum(encode([pixels]) for pixels in frames)),
+            ("delta frames", lambda: encode(frames))
+        ):
+        results["%s seconds" % name] = bestTime(encodeFrames, repeat=1)
+        results["%s kilobytes" % name] = encodeFrames() / 1024
+    return results
+
+
+# ---
+# SVG
+# ---
+
+def drawRepeatedShapes(bot, count):
+    # a handful of distinct shapes drawn over and over
+    rng = random.Random(0)
+    shapes = []
+    for i in range(10):
+        path = drawbotista.BezierPath()
+        path.oval(0, 0, rng.uniform(5, 30), rng.uniform(5, 30))
+        shapes.append(path)
+    bot.newPage(1000, 1000)
+    for i in range(count):
+        with bot.savedState():
+            bot.translate(rng.uniform(0, 1000), rng.uniform(0, 1000))
+            bot.fill(rng.choice((0, 0.5, 1)), 0, 0)
+            bot.drawPath(rng.choice(shapes))
+
+
+@benchmark
+def svgExport(counts=(5000, 20000)):
+    # the peak memory of streaming a page to a
+    # file must not grow with the size of the page
+    results = {}
+    for count in counts:
+        bot = drawbotista.DrawBotDrawingTool()
+        drawRepeatedShapes(bot, count)
+
+        def export():
+            context = drawbotista.SVGContext(1000, 1000, lambda pageIndex: open(os.devnull, "wb"))
+            bot._drawInContext(context)
+            context.close()
+
+        timeAndMemory(results, "%d shapes" % count, export)
+    bot.setImageDataCache(False)
+    results["%d shapes kilobytes" % count] = len(bot.imageData("SVG")) / 1024
+    first, last = counts[0], counts[-1]
+    if results["%d shapes peak kilobytes" % last] > results["%d shapes peak kilobytes" % first] * 2:
+        raise BenchmarkRegression("streaming %d shapes to SVG took more than twice the memory of %d shapes" % (last, first))
+    return results
+
+
+def drawReport(bot, pageCount):
+    # pages that repeat the same shapes and fonts
+    shapes = []
+    for i in range(5):
+        path = drawbotista.BezierPath()
+        path.oval(0, 0, 20 + i * 10, 20 + i * 5)
+        shapes.append(path)
+    for page in range(pageCount):
+        bot.newPage(612, 792)
+        bot.fill(0)
+        bot.font("Helvetica")
+        bot.fontSize(10)
+        bot.textBox("Page %d of a report with the same shapes and fonts on every page." % (page + 1), (50, 700, 500, 50))
+        for i in range(50):
+            with bot.savedState():
+                bot.translate(50 + (i % 10) * 50, 100 + (i // 10) * 100)
+                bot.fill(i % 3 / 2, 0, 0, 0.5)
+                bot.drawPath(shapes[i % len(shapes)])
+
+
+@benchmark
+def pdfExport(pageCounts=(100, 500)):
+    # pages are written as they end, so the peak memory
+    # must not grow with the number of pages
+    results = {}
+    for pageCount in pageCounts:
+        bot = drawbotista.DrawBotDrawingTool()
+        drawReport(bot, pageCount)
+
+        def export():
+            with open(os.devnull, "wb") as f:
+                context = drawbotista.PDFContext(612, 792, f)
+                bot._drawInContext(context)
+                context.close()
+
+        timeAndMemory(results, "%d pages" % pageCount, export)
+    bot.setImageDataCache(False)
+    results["%d pages kilobytes" % pageCount] = len(bot.imageData("PDF")) / 1024
+    first, last = pageCounts[0], pageCounts[-1]
+    if results["%d pages peak kilobytes" % last] > results["%d pages peak kilobytes" % first] * 2:
+        raise BenchmarkRegression("writing %d pages to PDF took more than twice the memory of %d pages" % (last, first))
+    return results
+
+
+# ------
+# Import
+# ------
+
+importTimeLimit = 0.05
+
+_importScript = """
+import time
+start = time.perf_counter()
+import drawbotista
+print(time.perf_counter() - start)
+"""
+
+@benchmark
+def importTime(repeat=5):
+    # a fresh interpreter for every import, without any
+    # of the Pythonista modules on the path
+    times = []
+    for i in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", _importScript],
+            env=dict(os.environ, PYTHONPATH=libDirectory)
+        )
+        times.append(float(output))
+    seconds = min(times)
+    if seconds > importTimeLimit:
+        raise BenchmarkRegression("importing drawbotista took %.3f seconds, the limit is %.3f" % (seconds, importTimeLimit))
+    return {"milliseconds": seconds * 1000}
+
+
+# --------
+# Baseline
+# --------
+
+def environment():
+    import numpy
+    return dict(
+        python=platform.python_version(),
+        numpy=numpy.__version__,
+        machine=platform.machine(),
+        system=platform.system()
+    )
+
+
+def resultIsBetterWhenLower(key):
+    # None for results that aren't a measurement
+    if key.endswith("per second") or key.endswith("speedup"):
+        return False
+    if key.endswith("seconds") or key.endswith("kilobytes") or key.endswith("milliseconds") or key.endswith("bytes per instruction"):
+        return True
+    return None
+
+
+def compareResult(key, value, baselineValue, tolerance):
+    # the relative change, and whether it is a regression
+    lower = resultIsBetterWhenLower(key)
+    if lower is None or not baselineValue:
+        return None, False
+    change = (value - baselineValue) / baselineValue
+    if lower:
+        return change, change > tolerance
+    return change, -change > tolerance
+
+
+# ----
+# Main
+# ----
+
+def main(names, save=None, compare=None, tolerance=0.25):
+    baseline = {}
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+        if baseline.get("environment") != environment():
+            print("warning: the baseline was made in a different environment: %s" % baseline.get("environment"))
+        baseline = baseline["results"]
+    allResults = {}
+    regressions = []
+    for function in _benchmarks:
+        name = function.__name__
+        if names and name not in names:
+            continue
+        print(name)
+        random.seed(0)
+        try:
+            results = function()
+        except BenchmarkRegression as error:
+            print("    regression: %s" % error)
+            regressions.append(name)
+            continue
+        allResults[name] = results
+        baselineResults = baseline.get(name, {})
+        for key, value in results.items():
+            line = "    %s: %.6g" % (key, value)
+            if key in baselineResults:
+                change, regressed = compareResult(key, value, baselineResults[key], tolerance)
+                if change is not None:
+                    line += " (%+.0f%%)" % (change * 100)
+                if regressed:
+                    line += " regression"
+                    regressions.append("%s %s" % (name, key))
+            print(line)
+    if save is not None:
+        with open(save, "w") as f:
+            json.dump(dict(environment=environment(), results=allResults), f, indent=4, sort_keys=True)
+    if regressions:
+        print("%d regressions:" % len(regressions))
+        for regression in regressions:
+            print("    %s" % regression)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for drawbotista.")
+    parser.add_argument("names", nargs="*", help="the benchmarks to run, all of them by default")
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--compare", help="compare the results with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="the relative change that counts as a regression")
+    arguments = parser.parse_args()
+    sys.exit(main(arguments.names, arguments.save, arguments.compare, arguments.tolerance))
@@ -0,0 +1,4 @@
+# A stand-in for Pythonista's console module.
+
+def quicklook(path):
+    pass
@@ -0,0 +1,176 @@
+# A stand-in for Pythonista's objc_util that lets the
+# drawbotista uikit backend run anywhere. C functions and
+# Objective-C messages don't do anything, except for the
+# image context functions. Those hand out blank 32 bit
+# bitmaps of the requested size, so that the code reading
+# pixels back from an image works on real buffers.
+
+import ctypes
+
+CGFloat = ctypes.c_double
+
+
+class CGPoint(ctypes.Structure):
+    _fields_ = [("x", CGFloat), ("y", CGFloat)]
+
+
+class CGSize(ctypes.Structure):
+    _fields_ = [("width", CGFloat), ("height", CGFloat)]
+
+
+class CGRect(ctypes.Structure):
+    _fields_ = [("origin", CGPoint), ("size", CGSize)]
+
+
+class CGAffineTransform(ctypes.Structure):
+    _fields_ = [(name, CGFloat) for name in ("a", "b", "c", "d", "tx", "ty")]
+
+
+# Handles
+
+_handles = {}
+
+
+def _handle(obj):
+    handle = id(obj)
+    _handles[handle] = obj
+    return handle
+
+
+class _Bitmap(object):
+
+    # premultiplied BGRA, like a UIKit image context
+
+    bitmapInfo = 2 | (2 << 12)
+
+    def __init__(self, width, height):
+        self.width = int(width)
+        self.height = int(height)
+        self.bytesPerRow = self.width * 4
+        self.buffer = (ctypes.c_uint8 * (self.bytesPerRow * self.height))()
+
+
+_imageContexts = []
+_endedImageContexts = []
+
+
+def _beginImageContext(size):
+    _imageContexts.append(_Bitmap(size.width, size.height))
+
+
+def _endImageContext():
+    # the image of an ended context can still be read
+    # until the next one ends
+    for bitmap in _endedImageContexts:
+        _handles.pop(id(bitmap), None)
+    _endedImageContexts[:] = [_imageContexts.pop()]
+
+
+def _currentContext():
+    if not _imageContexts:
+        return None
+    return _handle(_imageContexts[-1])
+
+
+def _bitmap(handle):
+    return _handles[handle]
+
+
+_implementations = dict(
+    UIGraphicsBeginImageContext=_beginImageContext,
+    UIGraphicsEndImageContext=_endImageContext,
+    UIGraphicsGetCurrentContext=_currentContext,
+    UIGraphicsGetImageFromCurrentImageContext=_currentContext,
+    UIImagePNGRepresentation=lambda image: image,
+    CGImageGetWidth=lambda image: _bitmap(image).width,
+    CGImageGetHeight=lambda image: _bitmap(image).height,
+    CGImageGetBytesPerRow=lambda image: _bitmap(image).bytesPerRow,
+    CGImageGetBitmapInfo=lambda image: _bitmap(image).bitmapInfo,
+    CGImageGetDataProvider=lambda image: image,
+    CGDataProviderCopyData=lambda provider: provider,
+    CFDataGetBytePtr=lambda data: ctypes.addressof(_bitmap(data).buffer),
+    CFDataGetLength=lambda data: len(_bitmap(data).buffer)
+)
+
+
+# C Functions
+
+class _CFunction(object):
+
+    def __init__(self, name):
+        self.__name__ = name
+        self.restype = None
+        self.argtypes = []
+        self._implementation = _implementations.get(name)
+
+    def __call__(self, *args):
+        if self._implementation is not None:
+            return self._implementation(*args)
+        return None
+
+
+class _CLibrary(object):
+
+    _handle = 0
+
+    def __getattr__(self, name):
+        function = _CFunction(name)
+        setattr(self, name, function)
+        return function
+
+
+c = _CLibrary()
+
+# there is no Foundation to look constants up in
+ctypes.c_void_p.in_dll = classmethod(lambda cls, library, name: cls(None))
+
+
+# Objective-C
+
+class _ObjCObject(object):
+
+    def __init__(self, name, target=None, arguments=()):
+        self._name = name
+        self._target = target
+        self._arguments = arguments
+
+    def __getattr__(self, name):
+        if name == "CGImage" and self._target is not None:
+            return lambda: _handle(self._target)
+        if name == "size" and self._name == "initWithString_attributes_":
+            return self._stringSize
+
+        def method(*args):
+            return _ObjCObject(name, arguments=args)
+
+        return method
+
+    def _stringSize(self):
+        # every character is half as wide as the font size
+        string, attributes = self._arguments
+        fontSize = 12
+        for value in attributes.values():
+            if isinstance(value, _ObjCObject) and value._name in ("fontWithName_size_", "systemFontOfSize_"):
+                fontSize = value._arguments[-1]
+        return CGSize(len(string) * fontSize / 2, fontSize * 1.2)
+
+
+def ObjCClass(name):
+    return _ObjCObject(name)
+
+
+def ObjCInstance(pointer):
+    if isinstance(pointer, _ObjCObject):
+        return pointer
+    if isinstance(pointer, ctypes.c_void_p):
+        pointer = pointer.value
+    return _ObjCObject("instance", _handles.get(pointer))
+
+
+NSMutableData = ObjCClass("NSMutableData")
+
+
+def nsdata_to_bytes(data):
+    if data._target is None:
+        return b""
+    return bytes(data._target.buffer)
@@ -0,0 +1,4 @@
+# A stand-in for Pythonista's ui module.
+
+def get_screen_size():
+    return (1024, 768)